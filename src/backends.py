@@ -0,0 +1,475 @@
+"""
+Chat backends for the inference engine.
+
+The request pipeline in infer.py (concurrency limits, retries, caching, the
+result writers) only depends on the ChatBackend protocol:
+`await backend.chat(model, messages, **params)` returning an OpenAI ChatCompletion.
+An optional `on_first_byte` callback is called when the response starts
+arriving, for time-to-first-byte telemetry. With an `until` callback the
+response is streamed instead: `until(text_so_far)` runs after every chunk, and
+once it returns an offset the stream is closed and the content cut there, so a
+model that keeps talking after its answer is not waited for (or billed).
+
+    OpenAIBackend  any OpenAI-compatible HTTP endpoint through the pooled clients;
+                   presets for Together, OpenAI and a llama.cpp server
+    OllamaBackend  a local Ollama server through ollama.AsyncClient
+    MockBackend    in-process and deterministic, with configurable latency, error
+                   rate, 429 injection and capacity, for exercising the scheduler,
+                   retries and writers without network access
+
+make_backend(kind, ...) builds any of them by name.
+
+Every backend also has prepare()/release() hooks, called before and after
+all datasets of a model have been run. Ollama uses them to load the model once
+with a keep-alive and unload it before the next model, instead of reloading it
+between datasets.
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Protocol, Union, runtime_checkable
+
+import ollama
+from openai.types.chat import ChatCompletion
+
+from clients import get_async_client
+from rate_limiter import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OLLAMA_PARALLEL = 4  # keep in line with OLLAMA_NUM_PARALLEL on the server
+DEFAULT_OLLAMA_KEEP_ALIVE = "30m"
+# OpenAI sampling parameter names that Ollama spells differently
+OLLAMA_OPTION_NAMES = {"max_tokens": "num_predict"}
+OPENAI_FINISH_REASONS = {"stop", "length", "tool_calls", "content_filter", "function_call"}
+
+# name -> (base URL, environment variable holding the API key)
+OPENAI_COMPATIBLE_PRESETS = {
+    "together": ("https://api.together.xyz/v1", "TOGETHER_API_KEY"),
+    "openai": ("https://api.openai.com/v1", "OPENAI_API_KEY"),
+    "llamacpp": ("http://localhost:8080/v1", "LLAMACPP_API_KEY"),
+}
+BACKEND_KINDS = tuple(OPENAI_COMPATIBLE_PRESETS) + ("ollama", "mock")
+# llama.cpp's server ignores the key, but the OpenAI client refuses to start without one
+PLACEHOLDER_API_KEY = "no-key"
+# until(text streamed so far) -> offset just past the answer, or None to keep reading
+StreamUntil = Callable[[str], Optional[int]]
+
+
+@runtime_checkable
+class ChatBackend(Protocol):
+    """What the inference pipeline needs from a model provider"""
+
+    name: str  # provider name, used to key rate limiters
+
+    async def chat(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_first_byte: Optional[Callable[[], None]] = None,
+        until: Optional[StreamUntil] = None,
+        **params,
+    ) -> ChatCompletion:
+        """One chat completion; errors should carry a `status_code` so retries can be classified"""
+        ...
+
+    async def prepare(self, model: str) -> None:
+        """Called once before a model's datasets are run"""
+        ...
+
+    async def release(self, model: str) -> None:
+        """Called once after a model's datasets are done"""
+        ...
+
+
+class OpenAIBackend:
+    """Any OpenAI-compatible chat completions endpoint, through the shared pooled client"""
+
+    def __init__(self, base_url: Optional[str] = None, api_key: Optional[str] = None, name: str = "openai"):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.name = name
+
+    @property
+    def client(self):
+        # Looked up per call: pooled clients belong to the running event loop
+        return get_async_client(self.base_url, self.api_key)
+
+    async def chat(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_first_byte: Optional[Callable[[], None]] = None,
+        until: Optional[StreamUntil] = None,
+        **params,
+    ) -> ChatCompletion:
+        if until is not None:
+            return await self.stream_chat(model, messages, on_first_byte, until, **params)
+        if on_first_byte is None:
+            return await self.client.chat.completions.create(model=model, messages=messages, **params)
+        # The streaming variant returns once the headers are in, before the body is read
+        async with self.client.chat.completions.with_streaming_response.create(
+            model=model, messages=messages, **params
+        ) as response:
+            on_first_byte()
+            return await response.parse()
+
+    async def stream_chat(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_first_byte: Optional[Callable[[], None]],
+        until: StreamUntil,
+        **params,
+    ) -> ChatCompletion:
+        stream = await self.client.chat.completions.create(
+            model=model, messages=messages, stream=True, stream_options={"include_usage": True}, **params
+        )
+
+        async def deltas():
+            async for chunk in stream:
+                usage = chunk.usage.model_dump() if chunk.usage else None
+                if not chunk.choices:
+                    yield "", None, usage
+                    continue
+                choice = chunk.choices[0]
+                yield choice.delta.content or "", choice.finish_reason, usage
+
+        try:
+            return await collect_stream(model, messages, deltas(), on_first_byte, until)
+        finally:
+            # Closing before the end drops the connection, which stops generation on the server
+            await stream.close()
+
+    async def prepare(self, model: str) -> None:
+        pass
+
+    async def release(self, model: str) -> None:
+        pass
+
+
+async def collect_stream(
+    model: str,
+    messages: List[Dict[str, str]],
+    deltas: AsyncIterator,
+    on_first_byte: Optional[Callable[[], None]],
+    until: StreamUntil,
+) -> ChatCompletion:
+    """
+    Read (text, finish_reason, usage) deltas until the stream ends or until() finds the answer.
+
+    An early stop has no provider usage, so completion tokens are estimated from the
+    text received.
+    """
+    text = ""
+    finish_reason = None
+    usage = None
+    first = True
+    async for content, reason, chunk_usage in deltas:
+        if first and on_first_byte:
+            on_first_byte()
+        first = False
+        finish_reason = reason or finish_reason
+        usage = chunk_usage or usage
+        if not content:
+            continue
+        text += content
+        end = until(text)
+        if end is not None:
+            text = text[:end]
+            finish_reason = "stop"
+            break
+    if usage is None:
+        prompt_tokens = sum(estimate_text_tokens(str(message.get("content") or "")) for message in messages)
+        completion_tokens = estimate_text_tokens(text)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+    return ChatCompletion.model_validate({
+        "id": f"stream-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": finish_reason if finish_reason in OPENAI_FINISH_REASONS else "stop",
+            "message": {"role": "assistant", "content": text},
+        }],
+        "usage": usage,
+    })
+
+
+class OllamaBackend:
+    """Local Ollama server; responses are converted to ChatCompletion so the pipeline treats them alike"""
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        keep_alive: Union[str, float, None] = DEFAULT_OLLAMA_KEEP_ALIVE,
+        unload_after: bool = True,
+    ):
+        self.host = host
+        self.keep_alive = keep_alive
+        self.unload_after = unload_after
+        self.name = "ollama"
+        self._client: Optional[ollama.AsyncClient] = None
+
+    @property
+    def client(self) -> ollama.AsyncClient:
+        if self._client is None:
+            self._client = ollama.AsyncClient(host=self.host)
+        return self._client
+
+    async def chat(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_first_byte: Optional[Callable[[], None]] = None,
+        until: Optional[StreamUntil] = None,
+        **params,
+    ) -> ChatCompletion:
+        options = {OLLAMA_OPTION_NAMES.get(key, key): value for key, value in params.items() if value is not None}
+        if until is not None:
+            return await self.stream_chat(model, messages, options, on_first_byte, until)
+        response = await self.client.chat(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=self.keep_alive,
+        )
+        # Non-streaming: the whole answer arrives at once
+        if on_first_byte:
+            on_first_byte()
+        return to_chat_completion(model, response)
+
+    async def stream_chat(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        options: Dict[str, Any],
+        on_first_byte: Optional[Callable[[], None]],
+        until: StreamUntil,
+    ) -> ChatCompletion:
+        parts = await self.client.chat(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=self.keep_alive,
+            stream=True,
+        )
+
+        async def deltas():
+            async for part in parts:
+                usage = None
+                if part.get("done"):
+                    prompt_tokens = part.get("prompt_eval_count") or 0
+                    completion_tokens = part.get("eval_count") or 0
+                    usage = {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    }
+                yield part["message"]["content"], part.get("done_reason"), usage
+
+        try:
+            return await collect_stream(model, messages, deltas(), on_first_byte, until)
+        finally:
+            # Leaving the generator closes the HTTP response, so Ollama stops generating
+            await parts.aclose()
+
+    async def prepare(self, model: str) -> None:
+        """Load the model before the first request so it is not loaded per dataset"""
+        start = time.time()
+        # An empty prompt only loads the model
+        await self.client.generate(model=model, prompt="", keep_alive=self.keep_alive)
+        logger.info(f"Loaded {model} in Ollama in {time.time() - start:.1f}s (keep_alive={self.keep_alive})")
+
+    async def release(self, model: str) -> None:
+        """Free the model's memory before the next model is loaded"""
+        if not self.unload_after:
+            return
+        await self.client.generate(model=model, prompt="", keep_alive=0)
+        logger.info(f"Unloaded {model} from Ollama")
+
+
+def to_chat_completion(model: str, response: Any) -> ChatCompletion:
+    """Wrap an Ollama chat response in the OpenAI ChatCompletion shape"""
+    prompt_tokens = response.get("prompt_eval_count") or 0
+    completion_tokens = response.get("eval_count") or 0
+    done_reason = response.get("done_reason")
+    return ChatCompletion.model_validate({
+        "id": f"ollama-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": done_reason if done_reason in OPENAI_FINISH_REASONS else "stop",
+            "message": {"role": "assistant", "content": response["message"]["content"]},
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    })
+
+
+class MockAPIError(Exception):
+    """Injected failure, shaped like the OpenAI SDK's status errors"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(f"Error code: {status_code} - {message}")
+        self.status_code = status_code
+
+
+def mock_logprobs(content: str, answers: List[str], rng: random.Random, top_logprobs: int) -> Dict[str, Any]:
+    """OpenAI-style logprobs for a one-token answer, most of the mass on the answer given"""
+    weights = {answer: rng.random() for answer in answers}
+    weights[content] = sum(weights.values())
+    total = sum(weights.values())
+    alternatives = sorted(
+        ({"token": answer, "logprob": math.log(weight / total), "bytes": None} for answer, weight in weights.items()),
+        key=lambda entry: -entry["logprob"],
+    )[:top_logprobs]
+    return {"content": [{"token": content, "logprob": math.log(weights[content] / total), "bytes": None,
+                         "top_logprobs": alternatives}]}
+
+
+class MockBackend:
+    """
+    Deterministic in-process provider.
+
+    Latency and failures are drawn from a random stream seeded by the seed, the
+    request content and the attempt number, so a rerun with the same seed sees the
+    same outcomes while a retried request can succeed. `capacity` answers 429 once
+    more than that many requests are in flight, like a provider enforcing concurrency.
+    A `tail_rate` fraction of attempts takes `tail_latency` seconds instead, like the
+    occasional stuck request on a shared endpoint.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        latency_jitter: float = 0.5,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        capacity: Optional[int] = None,
+        seed: int = 0,
+        answers: Optional[List[str]] = None,
+        tail_rate: float = 0.0,
+        tail_latency: float = 5.0,
+    ):
+        self.name = "mock"
+        self.latency = latency
+        self.latency_jitter = latency_jitter  # +/- fraction of latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.capacity = capacity
+        self.seed = seed
+        self.answers = answers or ["A", "B", "C", "D"]
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.in_flight = 0
+        self.calls = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self._attempts: Dict[str, int] = {}
+
+    async def chat(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_first_byte: Optional[Callable[[], None]] = None,
+        until: Optional[StreamUntil] = None,
+        **params,
+    ) -> ChatCompletion:
+        self.calls += 1
+        key = hashlib.sha256(f"{model}\x00{messages!r}".encode("utf-8")).hexdigest()
+        attempt = self._attempts.get(key, 0)
+        self._attempts[key] = attempt + 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+
+        if self.capacity is not None and self.in_flight >= self.capacity:
+            self.rate_limited += 1
+            raise MockAPIError("rate limit exceeded: too many concurrent requests", 429)
+        self.in_flight += 1
+        try:
+            latency = self.latency * (1 + self.latency_jitter * (2 * rng.random() - 1))
+            if self.tail_rate and rng.random() < self.tail_rate:
+                latency = self.tail_latency
+            await asyncio.sleep(max(0.0, latency))
+            roll = rng.random()
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                raise MockAPIError("rate limit exceeded", 429)
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                raise MockAPIError("internal server error", 500)
+        finally:
+            self.in_flight -= 1
+
+        if on_first_byte:
+            on_first_byte()
+        content = self.answers[int(key[:8], 16) % len(self.answers)]
+        if until is not None:
+            # The whole answer arrives as one chunk
+            end = until(content)
+            content = content[:end] if end is not None else content
+        prompt_tokens = sum(estimate_text_tokens(str(message.get("content") or "")) for message in messages)
+        completion_tokens = estimate_text_tokens(content)
+        choice = {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": content},
+        }
+        if params.get("logprobs"):
+            choice["logprobs"] = mock_logprobs(content, self.answers, rng, params.get("top_logprobs") or 0)
+        return ChatCompletion.model_validate({
+            "id": f"mock-{key[:12]}-{attempt}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    async def prepare(self, model: str) -> None:
+        pass
+
+    async def release(self, model: str) -> None:
+        pass
+
+    def summary(self) -> str:
+        return f"Mock backend: {self.calls} calls, {self.rate_limited} rate limited, {self.errors} errors"
+
+
+def make_backend(
+    kind: str,
+    base_url: Optional[str] = None,
+    api_key: Optional[str] = None,
+    ollama_host: Optional[str] = None,
+    ollama_keep_alive: Union[str, float, None] = DEFAULT_OLLAMA_KEEP_ALIVE,
+    **mock_options,
+) -> ChatBackend:
+    """Build a backend by name; base_url/api_key override the OpenAI-compatible presets"""
+    if kind in OPENAI_COMPATIBLE_PRESETS:
+        preset_url, key_env = OPENAI_COMPATIBLE_PRESETS[kind]
+        api_key = api_key or os.getenv(key_env) or (PLACEHOLDER_API_KEY if kind == "llamacpp" else None)
+        return OpenAIBackend(base_url or preset_url, api_key, kind)
+    if kind == "ollama":
+        return OllamaBackend(ollama_host or base_url, ollama_keep_alive)
+    if kind == "mock":
+        return MockBackend(**mock_options)
+    raise ValueError(f"Unknown backend {kind!r}, expected one of {BACKEND_KINDS}")
@@ -0,0 +1,411 @@
+"""
+Provider batch-API mode for benchmark inference (`infer.py --batch`).
+
+Follows the same steps as OpenAIBatchProcessor in
+translation/hellaswag/dev/process_batch.py: upload -> create batch -> poll ->
+download. The difference is that the input is built from PromptType prompts and
+the output is merged into the normal results files. Batched requests cost about
+half as much and do not count against live rate limits, which suits large,
+non-urgent sweeps.
+
+    1. The dataset's requests (minus completed ones with --resume) are written to
+       <results>_batch/input_<n>.jsonl, split to stay under the provider's limits.
+       Each line's custom_id is "<index>:<question_id>".
+    2. Each file is uploaded and a batch created; ids go to <results>_batch/state.json
+       after every step, so an interrupted run picks the same batches up again.
+    3. Batches are polled until they reach a terminal status, then their output and
+       error files are downloaded next to the inputs.
+    4. Every line becomes a normal result record. Failures go to the dead-letter file,
+       so `--replay_dead_letter` can retry them live. The per-model CSV is then rebuilt
+       in dataset order, with question IDs taken from the custom_ids. Token usage goes
+       to the usage ledger in the "batch" price tier, and the telemetry files are
+       written as for a live run, with each request's total time being its batch's
+       turnaround.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from openai import OpenAIError
+from openai.types.chat import ChatCompletion
+
+from backends import OpenAIBackend
+from clients import get_async_client
+from infer import (
+    GENERATION_PARAMS,
+    InferenceOptions,
+    RequestItem,
+    build_dead_letter_record,
+    count_lines,
+    dead_letter_path,
+    iter_dataset_requests,
+    load_completed_question_ids,
+    generation_settings,
+    observe_request,
+    make_run_info,
+    parquet_path,
+    prepare_output_file,
+    record_builder,
+    render_prompts,
+    restore_stop_sequence,
+    score_options,
+    results_file_path,
+    save_results_to_csv,
+    telemetry_paths,
+    write_sidecar,
+)
+from result_writer import ResultWriter
+from telemetry import RunTelemetry
+from usage_ledger import TaggedLedger
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+DEFAULT_COMPLETION_WINDOW = "24h"
+MAX_BATCH_REQUESTS = 50000  # OpenAI's per-batch limits
+MAX_BATCH_BYTES = 190 * 1024 ** 2  # under the 200 MB input file limit
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+API_RETRIES = 5
+DEFAULT_POLL_INTERVAL = 5.0  # seconds, growing by 1.5x per poll
+MAX_POLL_INTERVAL = 60.0
+
+
+def make_custom_id(index: int, question_id: Any) -> str:
+    return f"{index}:{question_id}"
+
+
+def parse_custom_id(custom_id: str) -> Tuple[int, str]:
+    index, _, question_id = custom_id.partition(":")
+    return int(index), question_id
+
+
+def batch_dir(output_file: str) -> str:
+    """Folder holding the batch input/output files and state of a results JSONL"""
+    return f"{os.path.splitext(output_file)[0]}_batch"
+
+
+class BatchState:
+    """Progress of one dataset's batches, saved to state.json after every change"""
+
+    def __init__(self, path: str, data: Dict[str, Any]):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def load(cls, path: str) -> Optional["BatchState"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(path, json.load(f))
+
+    @property
+    def chunks(self):
+        return self.data["chunks"]
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def write_batch_inputs(requests: Iterable[Dict[str, Any]], directory: str, completed: set) -> list:
+    """Write provider batch input files, one per chunk; returns the chunk entries for the state"""
+    chunks = []
+    f = None
+    size = count = 0
+    for index, req in enumerate(requests, 1):
+        question_id = req["metadata"]["question_id"]
+        if question_id in completed:
+            continue
+        line = json.dumps({
+            "custom_id": make_custom_id(index, question_id),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {"model": req["model"], "messages": req["messages"], **GENERATION_PARAMS, **req["params"]},
+        }, ensure_ascii=False) + "\n"
+        data = line.encode("utf-8")
+        if f is None or count >= MAX_BATCH_REQUESTS or size + len(data) > MAX_BATCH_BYTES:
+            if f is not None:
+                f.close()
+            path = os.path.join(directory, f"input_{len(chunks) + 1}.jsonl")
+            chunks.append({"input_file": path, "requests": 0})
+            f = open(path, "wb")
+            size = count = 0
+        f.write(data)
+        size += len(data)
+        count += 1
+        chunks[-1]["requests"] += 1
+    if f is not None:
+        f.close()
+    return chunks
+
+
+async def with_retries(call, what: str, retries: int = API_RETRIES):
+    """Await call() with exponential backoff on API errors"""
+    for attempt in range(retries):
+        try:
+            return await call()
+        except OpenAIError as e:
+            if attempt == retries - 1:
+                logger.error(f"Max retries exceeded for {what}: {e}")
+                raise
+            wait_time = 2 ** attempt
+            logger.warning(f"Failed to {what}: {e}. Retrying in {wait_time}s")
+            await asyncio.sleep(wait_time)
+
+
+class BatchInferenceProcessor:
+    """Upload, create, poll and download provider batches through the pooled async client"""
+
+    def __init__(self, base_url: Optional[str], api_key: Optional[str],
+                 completion_window: str = DEFAULT_COMPLETION_WINDOW,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.completion_window = completion_window
+        self.poll_interval = poll_interval
+
+    @property
+    def client(self):
+        return get_async_client(self.base_url, self.api_key)
+
+    async def submit(self, state: BatchState) -> None:
+        """Upload and create every chunk's batch that is not created yet"""
+        for chunk in state.chunks:
+            if not chunk.get("input_file_id"):
+                async def upload():
+                    with open(chunk["input_file"], "rb") as file:
+                        return await self.client.files.create(file=file, purpose="batch")
+                uploaded = await with_retries(upload, "upload batch input")
+                chunk["input_file_id"] = uploaded.id
+                state.save()
+                logger.info(f"Uploaded {chunk['input_file']} ({chunk['requests']} requests) as {uploaded.id}")
+            if not chunk.get("batch_id"):
+                batch = await with_retries(
+                    lambda: self.client.batches.create(
+                        input_file_id=chunk["input_file_id"],
+                        endpoint=BATCH_ENDPOINT,
+                        completion_window=self.completion_window,
+                    ),
+                    "create batch",
+                )
+                chunk["batch_id"] = batch.id
+                chunk["status"] = batch.status
+                state.save()
+                logger.info(f"Created batch {batch.id}")
+
+    async def wait(self, state: BatchState) -> None:
+        """Poll until every batch reaches a terminal status"""
+        interval = self.poll_interval
+        while True:
+            pending = [chunk for chunk in state.chunks if chunk.get("status") not in TERMINAL_STATUSES]
+            if not pending:
+                return
+            for chunk in pending:
+                batch = await with_retries(lambda: self.client.batches.retrieve(chunk["batch_id"]), "retrieve batch")
+                counts = batch.request_counts
+                if batch.status != chunk.get("status"):
+                    logger.info(
+                        f"Batch {batch.id}: {chunk.get('status')} -> {batch.status}"
+                        + (f" ({counts.completed}/{counts.total} done, {counts.failed} failed)" if counts else "")
+                    )
+                chunk["status"] = batch.status
+                chunk["output_file_id"] = batch.output_file_id
+                chunk["error_file_id"] = batch.error_file_id
+                chunk["created_at"] = batch.created_at
+                chunk["finished_at"] = (batch.completed_at or batch.failed_at or batch.expired_at
+                                        or batch.cancelled_at)
+            state.save()
+            if any(chunk["status"] not in TERMINAL_STATUSES for chunk in state.chunks):
+                await asyncio.sleep(interval)
+                interval = min(interval * 1.5, MAX_POLL_INTERVAL)
+
+    async def download(self, state: BatchState) -> None:
+        """Fetch the output and error files of finished batches"""
+        for chunk in state.chunks:
+            for kind in ("output", "error"):
+                file_id = chunk.get(f"{kind}_file_id")
+                if not file_id or chunk.get(f"{kind}_file"):
+                    continue
+                content = await with_retries(lambda: self.client.files.content(file_id), f"download batch {kind}")
+                path = chunk["input_file"].replace("input_", f"{kind}_")
+                with open(path, "wb") as f:
+                    f.write(content.content)
+                chunk[f"{kind}_file"] = path
+                state.save()
+                logger.info(f"Downloaded batch {kind} {file_id} to {path}")
+
+
+def load_batch_results(state: BatchState) -> Dict[int, Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """(result line, batch chunk) of every downloaded output and error file, by request index"""
+    results = {}
+    for chunk in state.chunks:
+        for kind in ("output", "error"):
+            path = chunk.get(f"{kind}_file")
+            if not path:
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        index, _ = parse_custom_id(result["custom_id"])
+                        results[index] = result, chunk
+    return results
+
+
+def to_request_item(index: int, req: Dict[str, Any], result: Optional[Dict[str, Any]], started: float,
+                    finished: float) -> RequestItem:
+    """A pipeline RequestItem holding a batch result line, so it is written like a live result"""
+    item = RequestItem(id=index, messages=req["messages"], model=req["model"], metadata=req["metadata"],
+                       start_time=started, end_time=finished, attempts=1, params=req["params"],
+                       option_labels=req["option_labels"])
+    response = (result or {}).get("response") or {}
+    if result is None:
+        item.error = "Missing from the batch output (expired or cancelled batch)"
+    elif result.get("error"):
+        item.error = json.dumps(result["error"])
+    elif response.get("status_code") != 200:
+        item.status_code = response.get("status_code")
+        item.error = f"Error code: {item.status_code} - {json.dumps(response.get('body'))}"
+    else:
+        item.result = ChatCompletion.model_validate(response["body"])
+        restore_stop_sequence(item.result, item.params.get("stop"))
+        score_options(item)
+    if item.result is None:
+        item.error_class = f"http_{item.status_code}" if item.status_code else "batch"
+    return item
+
+
+async def merge_batch_results(state: BatchState, requests: Iterable[Dict[str, Any]], output_file: str,
+                              record_format: str, completed: set, telemetry: Optional[RunTelemetry] = None,
+                              usage_ledger: Optional[TaggedLedger] = None) -> Tuple[int, int]:
+    """
+    Append every batch result to the results JSONL (and failures to the dead-letter file).
+
+    telemetry, if given, observes each request with its batch's turnaround as the
+    total time, and usage_ledger records its tokens.
+    """
+    results = load_batch_results(state)
+    writer = ResultWriter(output_file, record_builder(record_format)).start()
+    dead_letter_writer = ResultWriter(dead_letter_path(output_file), build_dead_letter_record).start()
+    finished = time.time()
+    successful = failed = 0
+    try:
+        for index, req in enumerate(requests, 1):
+            question_id = req["metadata"]["question_id"]
+            if question_id in completed:
+                continue
+            result, chunk = results.pop(index, (None, {}))
+            if result is not None and parse_custom_id(result["custom_id"])[1] != str(question_id):
+                logger.warning(f"custom_id {result['custom_id']} does not match question {question_id} at index {index}; "
+                               "has the dataset changed since the batch was submitted?")
+            item = to_request_item(index, req, result, chunk.get("created_at") or finished,
+                                   chunk.get("finished_at") or finished)
+            if telemetry is not None:
+                observe_request(telemetry, item)
+            if usage_ledger is not None and item.result is not None:
+                usage_ledger.record(item.model, item.result.usage)
+            await writer.write(item)
+            if item.result is None:
+                failed += 1
+                await dead_letter_writer.write(item)
+            else:
+                successful += 1
+    finally:
+        await writer.close()
+        await dead_letter_writer.close()
+        if usage_ledger is not None:
+            usage_ledger.flush()
+    if results:
+        logger.warning(f"{len(results)} batch results did not match a dataset index and were ignored")
+    return successful, failed
+
+
+async def batch_infer_async(
+    dataset_name,
+    model_name,
+    file_path,
+    output_csv,
+    system_message,
+    input_msg,
+    process_question,
+    dir_save,
+    options: Optional[InferenceOptions] = None,
+    completion_window: str = DEFAULT_COMPLETION_WINDOW,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    gen_profile=None,
+):
+    """
+    Run one dataset through one model with the provider's batch API and write the per-model CSV.
+
+    Re-running the same command resumes tracking batches that were already submitted.
+    """
+    options = options or InferenceOptions()
+    backend = options.make_backend()
+    if not isinstance(backend, OpenAIBackend):
+        raise ValueError(f"--batch needs an OpenAI-compatible backend, not {options.backend}")
+    processor = BatchInferenceProcessor(backend.base_url, backend.api_key, completion_window, poll_interval)
+
+    output_file = results_file_path(dir_save, dataset_name, model_name)
+    params, _, mcq_logprobs = generation_settings(gen_profile, model_name, options)
+    requests = lambda: iter_dataset_requests(file_path, model_name, system_message, input_msg, process_question,
+                                             params, mcq_logprobs)
+    directory = batch_dir(output_file)
+    state = BatchState.load(os.path.join(directory, "state.json"))
+    if state is not None and state.data.get("merged"):
+        state = None
+
+    if state is None:
+        completed = load_completed_question_ids(output_file) if options.resume and os.path.exists(output_file) else set()
+        os.makedirs(directory, exist_ok=True)
+        chunks = write_batch_inputs(requests(), directory, completed)
+        state = BatchState(os.path.join(directory, "state.json"), {
+            "dataset_name": dataset_name,
+            "model": model_name,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "resume": options.resume,
+            "completed_question_ids": len(completed),
+            "chunks": chunks,
+            "merged": False,
+        })
+        state.save()
+        prepare_output_file(output_file, options.resume)
+        write_sidecar(output_file, options.record_format, make_run_info(dataset_name, file_path, model_name, system_message, input_msg, params))
+        logger.info(f"{dataset_name} / {model_name}: {sum(c['requests'] for c in chunks)} of {count_lines(file_path)} "
+                    f"requests in {len(chunks)} batch files")
+    else:
+        logger.info(f"Resuming {len(state.chunks)} submitted batches from {state.path}")
+
+    await processor.submit(state)
+    await processor.wait(state)
+    await processor.download(state)
+
+    # Questions that were already done when the batch was built are not in it
+    completed = load_completed_question_ids(output_file) if state.data.get("resume") else set()
+    telemetry = RunTelemetry(dataset_name)
+    # The run started when its first batch was created, possibly by an earlier invocation
+    telemetry.started = min((chunk["created_at"] for chunk in state.chunks if chunk.get("created_at")),
+                            default=telemetry.started)
+    successful, failed = await merge_batch_results(state, requests(), output_file, options.record_format, completed,
+                                                   telemetry, options.open_usage_ledger(dataset_name, tier="batch"))
+    state.data["merged"] = True
+    state.save()
+    telemetry.log_summary()
+    metrics_file, summary_file = telemetry_paths(output_file)
+    telemetry.write_openmetrics(metrics_file)
+    telemetry.write_json(summary_file)
+    logger.info(f"Merged batch results for {dataset_name} / {model_name}: {successful} successful, {failed} failed")
+    if failed:
+        logger.warning(f"{failed} failed requests written to {dead_letter_path(output_file)}; "
+                       "rerun with --replay_dead_letter to retry them live")
+
+    prompts = ((qid, prompt) for prompt, _, qid in render_prompts(file_path, input_msg, process_question))
+    await asyncio.to_thread(
+        save_results_to_csv, output_file, output_csv, dataset_name, model_name, system_message,
+        prompts, parquet_path(output_csv) if options.parquet else None
+    )
@@ -0,0 +1,317 @@
+"""
+Throughput benchmark for the inference engine.
+
+Starts the local stand-in server (stand_in_server.py) in a child process, replays
+a real dataset's prompts, rendered by PromptType exactly as infer.py renders
+them, through infer_async() and reports:
+
+    rps                completed requests per second of wall time
+    latency            p50/p95/p99/mean/max per request, retries and backoff included
+    retries            attempts beyond the first, over all requests
+    peak_rss_mib       peak resident memory of the benchmark process
+    loop_lag           how late a 10 ms timer fires on the engine's event loop
+
+The report is written as JSON together with the git commit, so two commits can be
+compared with --baseline:
+
+    python src/bench_infer.py --dataset_name mmlu --dataset_path mmlu.jsonl --limit 2000 \
+        --latency lognormal:0.3:0.6 --server_rpm 3000 --output bench/head.json --baseline bench/main.json
+
+--backend llamacpp (or openai/together) with --base_url sends the same load to a
+real server instead of the stand-in.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from backends import BACKEND_KINDS
+from clients import close_clients
+from infer import InferenceOptions, infer_async, iter_result_records, record_succeeded
+from prompt_types import PromptType
+from scheduling import SCHEDULES
+from stand_in_server import DEFAULT_LATENCY, fetch_stats, parse_model_latency, serve_in_process
+from telemetry import distribution
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = 0.01  # seconds between event-loop lag probes
+STAND_IN = "standin"
+# Metrics compared against a baseline report; True where higher is better
+COMPARED_METRICS = {
+    "rps": True,
+    "latency.p50": False,
+    "latency.p95": False,
+    "latency.p99": False,
+    "retries": False,
+    "peak_rss_mib": False,
+    "loop_lag.p99": False,
+}
+
+
+def peak_rss_mib() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def git_revision() -> Dict[str, Any]:
+    """Commit the benchmark ran on, and whether the tree had local changes"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": dirty}
+
+
+async def monitor_loop_lag(samples: List[float], stop: asyncio.Event) -> None:
+    """Record how much later than scheduled a short sleep wakes up"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        samples.append(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+
+def write_dataset_sample(dataset_path: str, limit: Optional[int], dir_save: str) -> str:
+    """First `limit` rows of the dataset, cycling through it again if it is shorter"""
+    if not limit:
+        return dataset_path
+    with open(dataset_path, "r", encoding="utf-8") as file:
+        rows = [line.strip() for line in file if line.strip()]
+    sample_path = os.path.join(dir_save, os.path.basename(dataset_path))
+    with open(sample_path, "w", encoding="utf-8") as file:
+        for i in range(limit):
+            file.write(rows[i % len(rows)] + "\n")
+    return sample_path
+
+
+def summarize_results(results_files: List[str]) -> Dict[str, Any]:
+    """Per-request latency, attempts and outcomes from the engine's own result records"""
+    latencies, attempts = [], []
+    successful = failed = 0
+    for results_file in results_files:
+        for record in iter_result_records(results_file):
+            latencies.append(record.get("latency", record.get("duration", 0.0)))
+            attempts.append(record.get("attempts", 1))
+            if record_succeeded(record):
+                successful += 1
+            else:
+                failed += 1
+    return {
+        "requests": len(latencies),
+        "successful": successful,
+        "failed": failed,
+        "latency": distribution(latencies),
+        "retries": sum(max(0, n - 1) for n in attempts),
+        "attempts_per_request": round(sum(attempts) / len(attempts), 3) if attempts else None,
+    }
+
+
+async def run_benchmark(args, base_url: Optional[str], dir_save: str) -> Dict[str, Any]:
+    pt = PromptType(args.language)
+    options = InferenceOptions(
+        max_concurrency=args.max_concurrency,
+        adaptive=not args.fixed_concurrency,
+        concurrency_ceiling=args.concurrency_ceiling,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        queue_size=args.queue_size,
+        record_format=args.record_format,
+        stream=args.stream,
+        schedule=args.schedule,
+        backend="llamacpp" if args.backend == STAND_IN else args.backend,
+        base_url=base_url,
+    )
+    limiters = options.make_limiters()
+    backend = options.make_backend()
+    dataset_path = write_dataset_sample(args.dataset_path, args.limit, dir_save)
+
+    jobs = []
+    for model_name in args.model:
+        output_csv = os.path.join(dir_save, f"{args.dataset_name}_{model_name.replace('/', '-')}_responses.csv")
+        jobs.append(infer_async(
+            args.dataset_name,
+            model_name,
+            dataset_path,
+            output_csv,
+            pt.get_sys_msg(args.dataset_name),
+            pt.get_inp_msg(args.dataset_name),
+            pt.get_process_func(args.dataset_name),
+            True,
+            dir_save,
+            options,
+            limiters,
+            backend,
+            pt.get_gen_profile(args.dataset_name),
+        ))
+
+    lag_samples: List[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples, stop))
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*jobs)
+    finally:
+        wall_time = time.perf_counter() - start
+        stop.set()
+        await monitor
+        limiters.log_summary()
+        await close_clients()
+
+    results_files = [
+        os.path.join(dir_save, f"{args.dataset_name}_{model_name.replace('/', '-')}_results.jsonl")
+        for model_name in args.model
+    ]
+    report = summarize_results(results_files)
+    report["wall_time"] = round(wall_time, 3)
+    report["rps"] = round(report["requests"] / wall_time, 2) if wall_time > 0 else None
+    report["peak_rss_mib"] = peak_rss_mib()
+    report["loop_lag"] = distribution(lag_samples)
+    return report
+
+
+def lookup(report: Dict[str, Any], dotted: str) -> Optional[float]:
+    value: Any = report
+    for key in dotted.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def log_comparison(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """Log each compared metric next to the baseline's, marking regressions"""
+    logger.info(f"Compared with {baseline.get('commit') or 'baseline'}:")
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        now, before = lookup(current["results"], metric), lookup(baseline.get("results", {}), metric)
+        if now is None or before is None:
+            continue
+        change = (now - before) / before * 100 if before else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        marker = " (worse)" if worse and abs(change) >= 5 else ""
+        logger.info(f"  {metric:<14} {before:>10.4g} -> {now:<10.4g} {change:+.1f}%{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark inference throughput against a local stand-in server.")
+    parser.add_argument("--dataset_name", required=True)
+    parser.add_argument("--dataset_path", required=True)
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Number of prompts to send (cycles through the dataset if it is shorter)")
+    parser.add_argument("--model", nargs="+", default=["bench-model"],
+                        help="Model names; with several, the jobs run concurrently like --sweep")
+    parser.add_argument("--backend", choices=(STAND_IN,) + BACKEND_KINDS, default=STAND_IN,
+                        help="standin starts the local stand-in; anything else sends the load to --base_url")
+    parser.add_argument("--base_url", type=str, default=None,
+                        help="Endpoint for an OpenAI-compatible backend, e.g. a llama.cpp server")
+    parser.add_argument("--latency", type=str, default=DEFAULT_LATENCY,
+                        help="Stand-in latency: const:S, uniform:LO:HI, exp:MEAN or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--model_latency", nargs="*", default=None,
+                        help="Per-model stand-in latency as model=spec")
+    parser.add_argument("--server_rpm", type=int, default=None,
+                        help="Stand-in answers 429 beyond this many requests per minute")
+    parser.add_argument("--server_capacity", type=int, default=None,
+                        help="Stand-in answers 429 beyond this many concurrent requests")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="Fraction of stand-in requests answered with a 500")
+    parser.add_argument("--token_delay", type=float, default=0.0,
+                        help="Stand-in seconds per word of an answer")
+    parser.add_argument("--prompt_delay", type=float, default=0.0,
+                        help="Stand-in extra seconds per 1000 prompt characters, to measure --schedule")
+    parser.add_argument("--answers", nargs="+", default=None,
+                        help="Stand-in responses, e.g. verbose ones to measure --stream")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream responses and close them once the answer is complete")
+    parser.add_argument("--schedule", choices=SCHEDULES, default="fifo",
+                        help="Request order (see scheduling.py)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_concurrency", type=int, default=10)
+    parser.add_argument("--concurrency_ceiling", type=int, default=64)
+    parser.add_argument("--fixed_concurrency", action="store_true")
+    parser.add_argument("--rpm", type=int, default=None, help="Client-side requests-per-minute budget per model")
+    parser.add_argument("--tpm", type=int, default=None, help="Client-side tokens-per-minute budget per model")
+    parser.add_argument("--queue_size", type=int, default=InferenceOptions.queue_size)
+    parser.add_argument("--record_format", choices=["compact", "full"], default="compact")
+    parser.add_argument("--output", type=str, default="bench_results.json",
+                        help="Where to write the JSON report")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Earlier JSON report to compare against")
+    parser.add_argument("--keep_outputs", type=str, default=None,
+                        help="Directory for the run's results files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if args.backend == STAND_IN:
+        state_options = {
+            "latency": args.latency,
+            "model_latency": parse_model_latency(args.model_latency),
+            "rpm": args.server_rpm,
+            "capacity": args.server_capacity,
+            "error_rate": args.error_rate,
+            "seed": args.seed,
+            "token_delay": args.token_delay,
+            "prompt_delay": args.prompt_delay,
+            "answers": args.answers,
+        }
+        # A separate process, so the server's threads do not compete with the measured event loop
+        parent_conn, child_conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve_in_process, args=(child_conn, "127.0.0.1", 0, state_options), daemon=True)
+        server.start()
+        base_url = parent_conn.recv()
+        logger.info(f"Stand-in server at {base_url} (latency {args.latency})")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dir_save = args.keep_outputs or tmp_dir
+            os.makedirs(dir_save, exist_ok=True)
+            results = asyncio.run(run_benchmark(args, base_url, dir_save))
+            if server is not None:
+                results["server"] = fetch_stats(base_url)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    report = {
+        **git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "keep_outputs")},
+        "results": results,
+    }
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    logger.info(
+        f"{results['requests']} requests in {results['wall_time']:.2f}s: {results['rps']} req/s, "
+        f"p50 {results['latency']['p50']}s, p95 {results['latency']['p95']}s, p99 {results['latency']['p99']}s, "
+        f"{results['retries']} retries, peak RSS {results['peak_rss_mib']} MiB, "
+        f"loop lag p99 {results['loop_lag']['p99']}s"
+    )
+    logger.info(f"Report written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            log_comparison(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
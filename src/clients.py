@@ -0,0 +1,100 @@
+"""
+Process-wide registry of pooled OpenAI-compatible clients.
+
+Building a new AsyncOpenAI/OpenAI client per batch throws away the HTTP
+connection pool, TLS sessions and keep-alive connections. Clients here are
+created once per (base_url, api_key) with tuned httpx connection limits and
+reused by inference, judging and translation code. Async clients are bound to
+the event loop that first uses them, so callers run everything in one loop and
+await close_clients() at shutdown; sync clients are closed at interpreter exit.
+"""
+
+import atexit
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+logger = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = 256
+MAX_KEEPALIVE_CONNECTIONS = 128
+KEEPALIVE_EXPIRY = 120  # seconds an idle connection stays open
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = 600
+
+_async_clients: Dict[Tuple[Optional[str], str], AsyncOpenAI] = {}
+_sync_clients: Dict[Tuple[Optional[str], str], OpenAI] = {}
+
+
+def _client_key(base_url: Optional[str], api_key: Optional[str]) -> Tuple[Optional[str], str]:
+    key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12] if api_key else ""
+    return base_url, key_id
+
+
+def _limits(max_connections: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=min(max_connections, MAX_KEEPALIVE_CONNECTIONS),
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def get_async_client(
+    base_url: Optional[str] = None,
+    api_key: Optional[str] = None,
+    max_connections: int = MAX_CONNECTIONS,
+) -> AsyncOpenAI:
+    """Return the shared AsyncOpenAI client for (base_url, api_key), creating it on first use"""
+    key = _client_key(base_url, api_key)
+    if key not in _async_clients:
+        http_client = httpx.AsyncClient(limits=_limits(max_connections), timeout=_timeout())
+        _async_clients[key] = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=0,  # retries are handled by the caller's own backoff
+        )
+        logger.info(f"Created pooled async client for {base_url or 'default base URL'} (max_connections={max_connections})")
+    return _async_clients[key]
+
+
+def get_client(
+    base_url: Optional[str] = None,
+    api_key: Optional[str] = None,
+    max_connections: int = MAX_CONNECTIONS,
+) -> OpenAI:
+    """Return the shared thread-safe OpenAI client for (base_url, api_key), creating it on first use"""
+    key = _client_key(base_url, api_key)
+    if key not in _sync_clients:
+        http_client = httpx.Client(limits=_limits(max_connections), timeout=_timeout())
+        _sync_clients[key] = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=0,
+        )
+        logger.info(f"Created pooled client for {base_url or 'default base URL'} (max_connections={max_connections})")
+    return _sync_clients[key]
+
+
+async def close_clients() -> None:
+    """Close every async client; call from the event loop that used them"""
+    while _async_clients:
+        _, client = _async_clients.popitem()
+        await client.close()
+
+
+def close_sync_clients() -> None:
+    while _sync_clients:
+        _, client = _sync_clients.popitem()
+        client.close()
+
+
+atexit.register(close_sync_clients)
@@ -0,0 +1,342 @@
+"""
+Adaptive concurrency control for the inference engine.
+
+AdaptiveConcurrencyLimiter is an AIMD (additive increase, multiplicative decrease)
+limiter: while request latency and the error rate stay healthy it lets one more
+request in flight per window of completions, and on a rate-limit response it
+halves the number of in-flight requests. ConcurrencyRegistry keeps one limiter
+per model so a slow 70B endpoint backing off does not throttle a fast 3B one,
+with an optional global cap on in-flight requests across all models of a sweep.
+
+CircuitBreaker stops sending to a model endpoint that looks down. After
+`failure_threshold` consecutive timeouts, connection errors or 5xx responses it
+opens: the model's requests are parked before taking a slot, and one probe
+request is let through every `probe_interval` seconds. The first answer closes
+it again. Parked requests hold no global slot, so the other models of a sweep
+keep their full speed. An endpoint that stays down for `give_up_after` seconds
+is given up on and its requests fail with CircuitOpenError, except for a probe
+every `probe_interval` seconds; the circuit closes as usual once one answers.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INITIAL_CONCURRENCY = 10
+DEFAULT_MIN_CONCURRENCY = 1
+DEFAULT_MAX_CONCURRENCY = 64
+RATE_LIMIT_DECREASE_FACTOR = 0.5
+ERROR_DECREASE_FACTOR = 0.75
+LATENCY_TOLERANCE = 2.0  # healthy while latency stays under 2x the best observed
+ERROR_RATE_THRESHOLD = 0.1
+OUTCOME_WINDOW = 50
+DECREASE_COOLDOWN = 5.0  # seconds, one cut per burst of 429s
+DEFAULT_BREAKER_THRESHOLD = 5  # consecutive endpoint failures before the circuit opens
+DEFAULT_PROBE_INTERVAL = 30.0  # seconds between probe requests while open
+DEFAULT_BREAKER_GIVE_UP = 1800.0  # seconds open before the model's requests fail instead of waiting
+
+
+class CircuitOpenError(Exception):
+    """Raised for requests to a model endpoint its circuit breaker has given up on"""
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on the number of in-flight requests for one model"""
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = DEFAULT_INITIAL_CONCURRENCY,
+        min_limit: int = DEFAULT_MIN_CONCURRENCY,
+        max_limit: int = DEFAULT_MAX_CONCURRENCY,
+        adaptive: bool = True,
+    ):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.adaptive = adaptive
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        self._outcomes = deque(maxlen=OUTCOME_WINDOW)
+        self._latency_ewma: Optional[float] = None
+        self._best_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._start_time = time.time()
+        self.completed = 0
+        # (seconds since start, limit) every time the integer limit changes
+        self.history: List[Tuple[float, int]] = [(0.0, self.limit)]
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def release(self) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    def on_success(self, latency: float) -> None:
+        """Record a successful attempt and grow the limit if the endpoint looks healthy"""
+        self.completed += 1
+        self._outcomes.append(False)
+        self._latency_ewma = latency if self._latency_ewma is None else 0.8 * self._latency_ewma + 0.2 * latency
+        if self._best_latency is None or self._latency_ewma < self._best_latency:
+            self._best_latency = self._latency_ewma
+        if self._latency_ewma <= self._best_latency * LATENCY_TOLERANCE and self._error_rate() <= ERROR_RATE_THRESHOLD:
+            # +1 per `limit` successes, i.e. roughly one step per round trip
+            self._set_limit(self._limit + 1.0 / max(self._limit, 1.0), "healthy")
+
+    def on_rate_limit(self) -> None:
+        """Cut the limit sharply after a 429"""
+        self._outcomes.append(True)
+        self._decrease(RATE_LIMIT_DECREASE_FACTOR, "rate limited")
+
+    def on_error(self) -> None:
+        """Record a failed attempt and back off gently if errors pile up"""
+        self._outcomes.append(True)
+        if self._error_rate() > ERROR_RATE_THRESHOLD:
+            self._decrease(ERROR_DECREASE_FACTOR, f"error rate {self._error_rate():.0%}")
+
+    def summary(self) -> str:
+        """Time-weighted average and peak limit plus achieved throughput"""
+        elapsed = time.time() - self._start_time
+        points = self.history + [(elapsed, self.limit)]
+        weighted = sum((t1 - t0) * level for (t0, level), (t1, _) in zip(points, points[1:]))
+        avg_limit = weighted / elapsed if elapsed > 0 else float(self.limit)
+        peak = max(level for _, level in self.history)
+        throughput = self.completed / elapsed if elapsed > 0 else 0.0
+        return (
+            f"[{self.name}] concurrency avg {avg_limit:.1f}, peak {peak}, final {self.limit}; "
+            f"{self.completed} completions at {throughput:.2f} req/s"
+        )
+
+    def _error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+
+    def _decrease(self, factor: float, reason: str) -> None:
+        now = time.time()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self._set_limit(self._limit * factor, reason)
+
+    def _set_limit(self, value: float, reason: str) -> None:
+        if not self.adaptive:
+            return
+        old = self.limit
+        self._limit = min(max(value, float(self.min_limit)), float(self.max_limit))
+        if self.limit != old:
+            self.history.append((time.time() - self._start_time, self.limit))
+            logger.info(f"[{self.name}] concurrency {old} -> {self.limit} ({reason}, {self._in_flight} in flight)")
+            if self.limit > old:
+                # Wake waiters without blocking the caller on the condition lock
+                asyncio.ensure_future(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Closed, open (requests parked) or half-open (one probe in flight) state of one model endpoint"""
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = DEFAULT_BREAKER_THRESHOLD,
+        probe_interval: float = DEFAULT_PROBE_INTERVAL,
+        give_up_after: Optional[float] = DEFAULT_BREAKER_GIVE_UP,
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.probe_interval = probe_interval
+        self.give_up_after = give_up_after
+        self.state = "closed"
+        self.failures = 0  # consecutive
+        self.opened_at: Optional[float] = None
+        self.next_probe = 0.0
+        self.probe_sent = 0.0
+        self.given_up = False
+        self.give_ups = 0
+        self.times_opened = 0
+        self.probes = 0
+        self.open_seconds = 0.0
+        self._condition = asyncio.Condition()
+
+    async def wait_ready(self) -> None:
+        """Return once a request may be sent: the circuit is closed or this request is the probe"""
+        async with self._condition:
+            while self.state != "closed":
+                now = time.time()
+                if self.state == "half_open" and now - self.probe_sent >= self.probe_interval:
+                    # The probe never reported (cancelled by a timeout or a hedge): count it as failed
+                    logger.warning(f"[{self.name}] probe unanswered after {self.probe_interval:.0f}s, sending another")
+                    self.state = "open"
+                    self.next_probe = now
+                if self.state == "open":
+                    if not self.given_up and self.give_up_after is not None and now - self.opened_at >= self.give_up_after:
+                        self.given_up = True
+                        self.give_ups += 1
+                        self.open_seconds += now - self.opened_at
+                        self.next_probe = now + self.probe_interval
+                        logger.error(f"[{self.name}] circuit breaker gave up after {now - self.opened_at:.0f}s open")
+                        self._condition.notify_all()
+                    if now >= self.next_probe:
+                        # Probes go on after giving up, so a later job finds the endpoint once it is back
+                        self.state = "half_open"
+                        self.probe_sent = now
+                        self.probes += 1
+                        logger.info(f"[{self.name}] circuit half-open, sending a probe request")
+                        return
+                if self.given_up:
+                    raise CircuitOpenError(f"{self.name} endpoint down for over {self.give_up_after:.0f}s")
+                if self.state == "open":
+                    timeout = self.next_probe - now
+                    if self.give_up_after is not None:
+                        timeout = min(timeout, self.opened_at + self.give_up_after - now)
+                else:
+                    timeout = self.probe_sent + self.probe_interval - now  # unless the probe's outcome notifies first
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def on_success(self) -> None:
+        """The endpoint answered (any response short of a 5xx counts)"""
+        self.failures = 0
+        if self.state != "closed":
+            now = time.time()
+            if not self.given_up:
+                # A breaker that gave up counted its open time then
+                self.open_seconds += now - self.opened_at
+            logger.info(f"[{self.name}] circuit closed, endpoint answered after {now - self.opened_at:.0f}s open")
+            self.state = "closed"
+            self.opened_at = None
+            self.given_up = False
+            asyncio.ensure_future(self._notify())
+
+    def on_failure(self) -> None:
+        """A timeout, connection error or 5xx from the endpoint"""
+        self.failures += 1
+        now = time.time()
+        if self.state == "half_open":
+            self.state = "open"
+            self.next_probe = now + self.probe_interval
+            logger.warning(f"[{self.name}] probe failed, next probe in {self.probe_interval:.0f}s")
+            asyncio.ensure_future(self._notify())
+        elif self.state == "closed" and self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = now
+            self.next_probe = now + self.probe_interval
+            self.times_opened += 1
+            logger.warning(f"[{self.name}] circuit open after {self.failures} consecutive failures; "
+                           f"parking its requests, probing every {self.probe_interval:.0f}s")
+
+    def summary(self) -> str:
+        still_open = self.opened_at is not None and not self.given_up
+        open_seconds = self.open_seconds + (time.time() - self.opened_at if still_open else 0.0)
+        return (f"[{self.name}] circuit breaker opened {self.times_opened} times, {open_seconds:.0f}s open, "
+                f"{self.probes} probes" + (f", gave up {self.give_ups} times" if self.give_ups else ""))
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+
+class ConcurrencyRegistry:
+    """
+    One AdaptiveConcurrencyLimiter and CircuitBreaker per model, created on first
+    use, plus an optional global cap
+    """
+
+    def __init__(
+        self,
+        initial: int = DEFAULT_INITIAL_CONCURRENCY,
+        min_limit: int = DEFAULT_MIN_CONCURRENCY,
+        max_limit: int = DEFAULT_MAX_CONCURRENCY,
+        adaptive: bool = True,
+        global_limit: Optional[int] = None,
+        breaker_threshold: Optional[int] = DEFAULT_BREAKER_THRESHOLD,
+        probe_interval: float = DEFAULT_PROBE_INTERVAL,
+        breaker_give_up: Optional[float] = DEFAULT_BREAKER_GIVE_UP,
+    ):
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.adaptive = adaptive
+        self.global_limit = global_limit
+        self._global = asyncio.Semaphore(global_limit) if global_limit else None
+        self._limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+        # breaker_threshold None disables the breakers
+        self.breaker_threshold = breaker_threshold
+        self.probe_interval = probe_interval
+        self.breaker_give_up = breaker_give_up
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, model: str) -> AdaptiveConcurrencyLimiter:
+        if model not in self._limiters:
+            self._limiters[model] = AdaptiveConcurrencyLimiter(
+                model, self.initial, self.min_limit, self.max_limit, self.adaptive
+            )
+        return self._limiters[model]
+
+    def breaker(self, model: str) -> Optional[CircuitBreaker]:
+        if self.breaker_threshold is None:
+            return None
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(
+                model, self.breaker_threshold, self.probe_interval, self.breaker_give_up
+            )
+        return self._breakers[model]
+
+    @asynccontextmanager
+    async def slot(self, model: str):
+        """
+        Hold one of the model's slots and, if set, one of the global slots
+
+        While the model's circuit breaker is open, this waits holding only the model
+        slot, so at most the probe gets past it, and raises CircuitOpenError once the
+        breaker gives up.
+        """
+        limiter = self.get(model)
+        breaker = self.breaker(model)
+        # Model first, so requests parked behind a saturated model do not hold global slots
+        async with limiter:
+            if breaker is not None:
+                await breaker.wait_ready()
+            if self._global is None:
+                yield limiter
+            else:
+                async with self._global:
+                    yield limiter
+
+    def log_summary(self) -> None:
+        for limiter in self._limiters.values():
+            logger.info(limiter.summary())
+        for breaker in self._breakers.values():
+            if breaker.times_opened:
+                logger.info(breaker.summary())
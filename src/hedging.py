@@ -0,0 +1,176 @@
+"""
+Request hedging for the inference engine.
+
+A few requests on a shared endpoint take ten or thirty times the median, and a
+run cannot write its table until the last one is back. When an attempt is still
+unanswered after its model's rolling p95 latency, a second copy of the request
+is sent. The first answer wins, and the other call is cancelled, which closes
+its connection or stream.
+
+The extra requests are capped by a budget: per model, at most `budget` hedges
+per attempt sent (10% by default). Hedging only starts once the model has
+HEDGE_MIN_SAMPLES latencies, so the p95 is not a guess. An attempt that is
+still running when the window fills or the budget frees up is hedged then.
+
+Usage:
+    hedger = Hedger(budget=0.1)
+    response, hedge_won = await hedger.call(model, lambda: backend.chat(model, messages))
+    hedger.log_summary()
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from telemetry import percentile
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_HEDGE_BUDGET = 0.1  # hedges per attempt sent; p95 alone would use about half
+HEDGE_PERCENTILE = 95
+HEDGE_WINDOW = 200  # recent latencies the percentile is taken over
+HEDGE_MIN_SAMPLES = 20
+HEDGE_RECHECK_INTERVAL = 1.0  # seconds between checks while hedging is not possible yet
+
+
+class ModelHedge:
+    """Rolling latency window, hedge budget and outcomes of one model"""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.attempts = 0
+        self.hedged = 0
+        self.won = 0
+        # Latencies of the requests a hedge answered, from the first call to the hedge's answer
+        self.won_latencies = []
+        # First-call answers slower than the p95 at the time, which the saving is estimated from
+        self.slow_latencies = []
+
+    def delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None while there are too few samples"""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(sorted(self.latencies), HEDGE_PERCENTILE)
+
+    def can_hedge(self) -> bool:
+        return self.hedged < self.budget * self.attempts
+
+    def observe(self, latency: float) -> None:
+        """Record the latency of an answer to the first call"""
+        delay = self.delay()
+        if delay is None or latency > delay:
+            self.slow_latencies.append(latency)
+        self.latencies.append(latency)
+
+    def estimated_saving(self) -> Optional[float]:
+        """
+        Seconds the won hedges saved, estimated from the first calls that answered late.
+
+        The first call of a won hedge is cancelled, so its latency is only known to
+        exceed the hedge's. It is estimated as the mean of the slow first calls that
+        took longer still; hedges with no such call to compare with are left out.
+        None if that leaves none.
+        """
+        savings = []
+        for latency in self.won_latencies:
+            slower = [slow for slow in self.slow_latencies if slow > latency]
+            if slower:
+                savings.append(sum(slower) / len(slower) - latency)
+        return round(sum(savings), 2) if savings else None
+
+    def summary(self) -> Dict[str, float]:
+        delay = self.delay()
+        saved = self.estimated_saving()
+        return {
+            "attempts": self.attempts,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.attempts, 4) if self.attempts else 0.0,
+            "hedges_won": self.won,
+            "delay": round(delay, 4) if delay is not None else None,
+            "estimated_seconds_saved": saved,
+        }
+
+
+class Hedger:
+    """Sends a second copy of attempts that outlive their model's rolling p95 latency"""
+
+    def __init__(self, budget: float = DEFAULT_HEDGE_BUDGET):
+        self.budget = budget
+        self._models: Dict[str, ModelHedge] = {}
+
+    def model(self, name: str) -> ModelHedge:
+        if name not in self._models:
+            self._models[name] = ModelHedge(self.budget)
+        return self._models[name]
+
+    async def call(self, model: str, make_call: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """
+        Await make_call(), hedged with a second make_call() if it is slow.
+
+        Returns the first successful result and whether it came from the hedge. If
+        both calls fail, the first call's error is raised.
+        """
+        state = self.model(model)
+        state.attempts += 1
+        start = time.time()
+        primary = asyncio.ensure_future(make_call())
+        hedge = None
+        try:
+            while not primary.done():
+                # Re-checked while waiting: a stuck attempt is hedged once the window fills or budget frees up
+                delay = state.delay()
+                elapsed = time.time() - start
+                if delay is not None and elapsed >= delay and state.can_hedge():
+                    break
+                timeout = delay - elapsed if delay is not None and elapsed < delay else HEDGE_RECHECK_INTERVAL
+                await asyncio.wait({primary}, timeout=timeout)
+            if primary.done():
+                result = await primary
+                state.observe(time.time() - start)
+                return result, False
+
+            state.hedged += 1
+            hedge = asyncio.ensure_future(make_call())
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in (primary, hedge):
+                    if task in done and task.exception() is None:
+                        latency = time.time() - start
+                        if task is hedge:
+                            state.won += 1
+                            state.won_latencies.append(latency)
+                        else:
+                            state.observe(latency)
+                        return task.result(), task is hedge
+            return primary.result(), False  # both failed: raises the first call's error
+        finally:
+            # Cancel the loser (or both calls when the caller is cancelled)
+            for task in (primary, hedge):
+                if task is None:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # retrieved, so a failed loser is not logged as unhandled
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {name: state.summary() for name, state in self._models.items()}
+
+    def log_summary(self) -> None:
+        for name, summary in self.summary().items():
+            if not summary["hedged"]:
+                logger.info(f"[{name}] hedging: no hedges sent ({summary['attempts']} attempts)")
+                continue
+            saved = summary["estimated_seconds_saved"]
+            logger.info(
+                f"[{name}] hedged {summary['hedged']} of {summary['attempts']} attempts "
+                f"({summary['hedge_rate']:.1%}) after p{HEDGE_PERCENTILE} {summary['delay']:.2f}s; "
+                f"{summary['hedges_won']} hedges answered first, "
+                + (f"about {saved:.1f}s of latency saved" if saved is not None else "latency saved unknown (no slow first call to compare with)")
+            )
@@ -1,20 +1,32 @@
 import os
 import json
-import csv
 import logging
+import math
 import time
 import random
 import asyncio
 from tqdm import tqdm
 from dotenv import load_dotenv, find_dotenv
 import backoff
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Callable
 from dataclasses import dataclass, field
-from openai import OpenAI, AsyncOpenAI
 from openai.types.chat import ChatCompletion
-import ollama
 import ast
-import pandas as pd
+import re
+import shutil
+from collections import OrderedDict
+from backends import ChatBackend, MockBackend, make_backend, BACKEND_KINDS, DEFAULT_OLLAMA_KEEP_ALIVE, DEFAULT_OLLAMA_PARALLEL
+from clients import close_clients
+from concurrency import (AdaptiveConcurrencyLimiter, CircuitBreaker, CircuitOpenError, ConcurrencyRegistry,
+                         DEFAULT_BREAKER_GIVE_UP, DEFAULT_BREAKER_THRESHOLD, DEFAULT_PROBE_INTERVAL)
+from rate_limiter import RateLimiter, get_rate_limiter, estimate_tokens, usage_total_tokens
+from result_writer import ResultWriter, OrderedTableWriter
+from response_cache import ResponseCache, get_response_cache, make_cache_key, DEFAULT_CACHE_FILENAME, DEFAULT_MAX_BYTES
+from hedging import DEFAULT_HEDGE_BUDGET, Hedger
+from prompt_types import is_reasoning_model, option_labels
+from scheduling import DEFAULT_SCHEDULE_WINDOW, SCHEDULES, schedule_requests
+from telemetry import RunTelemetry
+from usage_ledger import TaggedLedger, get_usage_ledger, DEFAULT_LEDGER_FILENAME
 
 load_dotenv(find_dotenv())
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
@@ -32,6 +44,25 @@ MAX_RETRIES = 10
 MAX_RETRY_TIME = 600  # 10 minutes
 RATE_LIMIT_INITIAL_BACKOFF = 3  # seconds
 GENERAL_ERROR_INITIAL_BACKOFF = 2  # seconds
+MAX_BACKOFF = 60  # seconds
+DEFAULT_ATTEMPT_TIMEOUT = 300  # seconds per attempt, hedges included
+# Transient statuses worth retrying; any other 4xx (bad request, context length, auth) is fatal
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429}
+RECORD_FORMATS = ("compact", "full")
+CSV_COLUMNS = [
+    "Question ID",
+    "Dataset Name",
+    "Model Name",
+    "System Prompt",
+    "Prompt",
+    "Model Response",
+    "Ground Truth",
+]
+EMPTY_RESPONSE = "EMPTY RESPONSE"
+DEFAULT_QUEUE_SIZE = 256  # requests rendered ahead of the workers / results waiting to be written
+DEDUP_MAX_ANSWERS = 65536  # successful answers remembered for later copies of their prompt
+# Sampling parameters sent with every request; part of the response cache key
+GENERATION_PARAMS = {"temperature": 0}
 
 @dataclass
 class RequestItem:
@@ -45,6 +76,21 @@ class RequestItem:
     start_time: float = field(default_factory=time.time)
     end_time: Optional[float] = None
     attempts: int = 0
+    status_code: Optional[int] = None  # HTTP status of the last failed attempt
+    cached: bool = False  # served from the response cache
+    enqueued_at: Optional[float] = None  # when it last joined the request queue
+    queue_wait: float = 0.0  # time queued before attempts were sent, summed over attempts
+    ttfb: Optional[float] = None  # time to first byte of the last attempt
+    error_class: Optional[str] = None  # class of the last failed attempt
+    params: Dict[str, Any] = field(default_factory=dict)  # generation limits on top of GENERATION_PARAMS (max_tokens, stop)
+    extractor: Optional[Callable[[str], Optional[int]]] = None  # stream, and stop once it finds the answer
+    truncated_at: Optional[int] = None  # characters kept when the stream was closed at the answer
+    streamed_chars: Optional[int] = None  # characters received before the stream was closed
+    duplicate_of: Optional[int] = None  # index of the request with the same prompt whose result this shares
+    option_labels: Optional[List[str]] = None  # answer with the most likely of these labels (logprob MCQ scoring)
+    option_probs: Optional[Dict[str, float]] = None  # first-token probability per label, normalised over the labels
+    option_mass: Optional[float] = None  # first-token probability on any label, before normalising
+    hedge_won: bool = False  # answered by the hedge sent when the attempt outlived the model's p95
     
     @property
     def duration(self) -> float:
@@ -53,17 +99,170 @@ class RequestItem:
             return self.end_time - self.start_time
         return time.time() - self.start_time
 
+# on_result(index, metadata, messages, response content or None on failure)
+ResultCallback = Callable[[int, Optional[Dict[str, Any]], List[Dict[str, str]], Optional[str]], None]
+
+@dataclass
+class InferenceOptions:
+    """Engine settings shared by infer(), parallel_process_chat() and the CLI"""
+    max_concurrency: int = 10  # starting in-flight requests per model
+    adaptive: bool = True  # AIMD; False keeps exactly max_concurrency
+    concurrency_ceiling: int = 64
+    rpm: Optional[int] = None  # requests-per-minute budget per model
+    tpm: Optional[int] = None  # tokens-per-minute budget per model
+    resume: bool = False  # skip question IDs that already succeeded
+    replay_dead_letter: bool = False  # re-send the stored dead-letter requests instead of the dataset
+    global_concurrency: Optional[int] = None  # cap across all models sharing a ConcurrencyRegistry
+    queue_size: int = DEFAULT_QUEUE_SIZE  # bound on pending requests and unwritten results
+    record_format: str = "compact"  # "full" keeps the request messages and the whole response per record
+    parquet: bool = False  # also stream the per-model table to a .parquet file next to the CSV
+    backend: str = "together"  # one of backends.BACKEND_KINDS
+    base_url: Optional[str] = None  # overrides the backend preset's URL
+    ollama_host: Optional[str] = None  # defaults to OLLAMA_HOST / localhost:11434
+    ollama_keep_alive: str = DEFAULT_OLLAMA_KEEP_ALIVE
+    mock_options: Dict[str, Any] = field(default_factory=dict)  # MockBackend settings
+    cache_mode: str = "off"  # response cache: "readwrite", "write" or "off"
+    cache_path: Optional[str] = None  # defaults to response_cache.sqlite next to the output file
+    cache_max_bytes: Optional[int] = DEFAULT_MAX_BYTES
+    usage_ledger_path: Optional[str] = None  # SQLite token/cost ledger; None records nothing
+    journal_mode: str = "WAL"  # of the cache and usage ledger; DELETE when other machines write them too
+    stream: bool = False  # stream responses and close them once the dataset's answer extractor finds the answer
+    dedup: bool = True  # send each distinct prompt once per run and share its result
+    mcq_logprobs: bool = False  # score MCQ datasets from one token's label logprobs instead of generated text
+    hedge: bool = False  # send a second copy of attempts slower than the model's rolling p95
+    hedge_budget: float = DEFAULT_HEDGE_BUDGET  # hedges per attempt sent, per model
+    attempt_timeout: Optional[float] = DEFAULT_ATTEMPT_TIMEOUT  # deadline per attempt; None waits for the client
+    breaker_threshold: Optional[int] = DEFAULT_BREAKER_THRESHOLD  # consecutive endpoint failures; None disables
+    probe_interval: float = DEFAULT_PROBE_INTERVAL  # seconds between probes while a model's circuit is open
+    breaker_give_up: Optional[float] = DEFAULT_BREAKER_GIVE_UP  # seconds open before its requests fail
+    schedule: str = "fifo"  # request order, one of scheduling.SCHEDULES
+    schedule_window: int = DEFAULT_SCHEDULE_WINDOW  # requests reordered together
+    language: Optional[str] = None  # dataset language, for tagging the usage ledger
+
+    def open_cache(self, output_file: str) -> Optional[ResponseCache]:
+        path = self.cache_path or os.path.join(os.path.dirname(output_file), DEFAULT_CACHE_FILENAME)
+        return get_response_cache(path, self.cache_mode, self.cache_max_bytes, self.journal_mode)
+    
+    def open_usage_ledger(self, dataset: Optional[str], tier: str = "live") -> Optional[TaggedLedger]:
+        if not self.usage_ledger_path:
+            return None
+        return get_usage_ledger(self.usage_ledger_path, self.journal_mode).tagged("infer", dataset, self.language, tier)
+
+    def make_backend(self, kind: Optional[str] = None) -> ChatBackend:
+        kind = kind or self.backend
+        return make_backend(
+            kind,
+            base_url=self.base_url,
+            api_key=main_api_key if kind == "together" else None,
+            ollama_host=self.ollama_host,
+            ollama_keep_alive=self.ollama_keep_alive,
+            **(self.mock_options if kind == "mock" else {}),
+        )
+
+    def make_limiters(self) -> ConcurrencyRegistry:
+        return ConcurrencyRegistry(
+            initial=self.max_concurrency,
+            max_limit=self.concurrency_ceiling if self.adaptive else self.max_concurrency,
+            adaptive=self.adaptive,
+            global_limit=self.global_concurrency,
+            breaker_threshold=self.breaker_threshold,
+            probe_interval=self.probe_interval,
+            breaker_give_up=self.breaker_give_up
+        )
+
+@dataclass
+class RunStats:
+    """Running totals of a parallel_process_chat run, updated as each result is persisted"""
+    successful: int = 0
+    failed: int = 0
+    cached: int = 0
+    deduplicated: int = 0
+    truncated: int = 0
+    total_duration: float = 0.0
+    total_attempts: int = 0
+    
+    @property
+    def count(self) -> int:
+        return self.successful + self.failed
+    
+    def add(self, result: RequestItem) -> None:
+        if result.result is not None:
+            self.successful += 1
+        else:
+            self.failed += 1
+        if result.cached:
+            self.cached += 1
+        if result.duplicate_of is not None:
+            self.deduplicated += 1
+        if result.truncated_at is not None:
+            self.truncated += 1
+        self.total_duration += result.duration
+        self.total_attempts += result.attempts
+
 class APIException(Exception):
     """Base exception for API errors"""
-    def __init__(self, message, is_rate_limit=False, status_code=None):
+    def __init__(self, message, is_rate_limit=False, status_code=None, retryable=True):
         self.message = message
         self.is_rate_limit = is_rate_limit
         self.status_code = status_code
+        self.retryable = retryable
         super().__init__(self.message)
+    
+    @property
+    def endpoint_failure(self) -> bool:
+        """The endpoint did not answer: timeout, connection error or 5xx (counted by the circuit breaker)"""
+        if self.is_rate_limit:
+            return False
+        return self.status_code is None or self.status_code == 408 or self.status_code >= 500
+    
+    @property
+    def error_class(self) -> str:
+        """Coarse label for telemetry: rate_limit, timeout, connection or http_<status>"""
+        if self.is_rate_limit:
+            return "rate_limit"
+        if self.status_code == 408 or "timed out" in self.message.lower() or "timeout" in self.message.lower():
+            return "timeout"
+        if self.status_code is None:
+            return "connection"
+        return f"http_{self.status_code}"
 
-def save_result(result: RequestItem, output_file: str) -> None:
-    """Save a single result to the output file"""
-    result_dict = {
+def classify_error(error: Exception) -> APIException:
+    """Map any client exception to an APIException with its status code and retryability"""
+    if isinstance(error, APIException):
+        return error
+    error_message = str(error)
+    status_code = getattr(error, "status_code", None)
+    
+    # Fall back to the status code embedded in the message
+    if status_code is None:
+        match = re.search(r"(?:status_code=|Error code: )(\d{3})", error_message)
+        if match:
+            status_code = int(match.group(1))
+    
+    is_rate_limit = status_code == 429 or "rate limit" in error_message.lower()
+    if status_code is None:
+        # Connection resets, timeouts and the like
+        retryable = True
+    else:
+        retryable = is_rate_limit or status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    return APIException(error_message, is_rate_limit, status_code, retryable)
+
+def retry_backoff(request: RequestItem, error: APIException) -> float:
+    """Backoff before the next attempt: exponential by attempt count, with jitter"""
+    if error.is_rate_limit:
+        # Longer backoff for rate limits (exponential with base 2)
+        backoff_time = RATE_LIMIT_INITIAL_BACKOFF * (2 ** (request.attempts - 1))
+    else:
+        # Shorter backoff for other errors (exponential with base 1.5)
+        backoff_time = GENERAL_ERROR_INITIAL_BACKOFF * (1.5 ** (request.attempts - 1))
+    
+    # Add jitter to prevent synchronized retries
+    backoff_time = backoff_time * (0.8 + 0.4 * random.random())
+    return min(backoff_time, MAX_BACKOFF)
+
+def build_result_record(result: RequestItem) -> Dict[str, Any]:
+    """JSONL record for a finished request"""
+    return {
         'request': {
             'model': result.model,
             'messages': result.messages
@@ -71,212 +270,868 @@ def save_result(result: RequestItem, output_file: str) -> None:
         'response': result.result.model_dump() if result.result else None,
         'error': result.error,
         'duration': result.duration,
+        'queue_wait': round(result.queue_wait, 3),
+        'ttfb': round(result.ttfb, 3) if result.ttfb is not None else None,
         'attempts': result.attempts,
+        'error_class': result.error_class,
+        'cached': result.cached,
+        'duplicate_of': result.duplicate_of,
+        'option_probs': result.option_probs,
+        'option_mass': result.option_mass,
+        'hedge_won': result.hedge_won,
+        'truncated_at': result.truncated_at,
+        'streamed_chars': result.streamed_chars,
         'metadata': result.metadata
     }
+
+def build_compact_record(result: RequestItem) -> Dict[str, Any]:
+    """JSONL record with only the per-question fields; the shared prompt parts live in the sidecar"""
+    metadata = dict(result.metadata or {})
+    record = {
+        'question_id': metadata.pop('question_id', None),
+        'index': result.id,
+        'content': None,
+        'finish_reason': None,
+        'usage': None,
+    }
+    if result.result is not None and result.result.choices:
+        choice = result.result.choices[0]
+        record['content'] = choice.message.content
+        record['finish_reason'] = choice.finish_reason
+    if result.result is not None and result.result.usage is not None:
+        usage = result.result.usage
+        record['usage'] = {
+            'prompt_tokens': usage.prompt_tokens,
+            'completion_tokens': usage.completion_tokens,
+            'total_tokens': usage.total_tokens,
+        }
+    record['latency'] = round(result.duration, 3)
+    record['queue_wait'] = round(result.queue_wait, 3)
+    record['ttfb'] = round(result.ttfb, 3) if result.ttfb is not None else None
+    record['attempts'] = result.attempts
+    record['error'] = result.error if result.result is None else None
+    if result.error_class:
+        record['error_class'] = result.error_class
+    if result.cached:
+        record['cached'] = True
+    if result.duplicate_of is not None:
+        record['duplicate_of'] = result.duplicate_of
+    if result.option_probs is not None:
+        record['option_probs'] = result.option_probs
+        record['option_mass'] = result.option_mass
+    if result.hedge_won:
+        record['hedge_won'] = True
+    if result.truncated_at is not None:
+        record['truncated_at'] = result.truncated_at
+        record['streamed_chars'] = result.streamed_chars
+    if metadata:
+        # ground_truth and anything else the caller attached
+        record['metadata'] = metadata
+    return record
+
+def response_content(result: RequestItem) -> Optional[str]:
+    """Answer text of a finished request (None for failures)"""
+    if result.result is None or not result.result.choices:
+        return None
+    return result.result.choices[0].message.content
+
+def record_builder(record_format: str):
+    if record_format not in RECORD_FORMATS:
+        raise ValueError(f"Unknown record format {record_format!r}, expected one of {RECORD_FORMATS}")
+    return build_compact_record if record_format == "compact" else build_result_record
+
+def record_question_id(record: Dict[str, Any]) -> Any:
+    """Question ID of a compact or full record (None when missing)"""
+    if "question_id" in record:
+        return record["question_id"]
+    return (record.get("metadata") or {}).get("question_id")
+
+def record_succeeded(record: Dict[str, Any]) -> bool:
+    if "response" in record:
+        return bool(record["response"])
+    return record.get("error") is None and record.get("content") is not None
+
+def record_content(record: Dict[str, Any]) -> Optional[str]:
+    """Model answer of a compact or full record (None for failures)"""
+    if "response" in record:
+        return record["response"]["choices"][0]["message"]["content"] if record["response"] else None
+    return record.get("content")
+
+def record_prompt(record: Dict[str, Any]) -> Optional[str]:
+    """User prompt, only stored in full records"""
+    if "request" not in record:
+        return None
+    return record["request"]["messages"][1]["content"]
+
+def sidecar_path(output_file: str) -> str:
+    """Path of the run description stored next to a results JSONL"""
+    base, _ = os.path.splitext(output_file)
+    return f"{base}.meta.json"
+
+def write_sidecar(output_file: str, record_format: str, run_info: Optional[Dict[str, Any]] = None) -> None:
+    """Store what every record of the run shares: format, sampling params, system message, template"""
+    sidecar = {
+        'record_format': record_format,
+        'params': GENERATION_PARAMS,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    sidecar.update(run_info or {})
+    with open(sidecar_path(output_file), 'w', encoding="utf-8") as f:
+        json.dump(sidecar, f, ensure_ascii=False, indent=2)
+
+def save_result(result: RequestItem, output_file: str) -> None:
+    """Save a single result to the output file"""
+    result_dict = build_result_record(result)
     
     # Use a lock to avoid concurrent writes
     with open(output_file, 'a', encoding="utf-8") as f:
         f.write(json.dumps(result_dict) + '\n')
 
-async def process_chat_request(
-    client: AsyncOpenAI,
-    request: RequestItem,
-) -> RequestItem:
-    """Process a chat completion request with retries for all errors"""
+def dead_letter_path(output_file: str) -> str:
+    """Path of the dead-letter file that sits next to a results JSONL"""
+    base, _ = os.path.splitext(output_file)
+    return f"{base}_dead_letter.jsonl"
+
+def build_dead_letter_record(result: RequestItem) -> Dict[str, Any]:
+    """Self-contained record of a permanently failed request, enough to replay it later"""
+    return {
+        'request': {
+            'model': result.model,
+            'messages': result.messages,
+            'params': result.params,
+            'option_labels': result.option_labels
+        },
+        'metadata': result.metadata,
+        'index': result.id,
+        'error': result.error,
+        'status_code': result.status_code,
+        'attempts': result.attempts
+    }
+
+def iter_dead_letter_requests(path: str) -> Iterator[Dict[str, Any]]:
+    """Turn dead-letter records back into request dictionaries"""
+    for record in iter_result_records(path):
+        yield {
+            "messages": record["request"]["messages"],
+            "model": record["request"]["model"],
+            "params": record["request"].get("params") or {},
+            "option_labels": record["request"].get("option_labels"),
+            "metadata": record.get("metadata"),
+            "index": record.get("index")
+        }
+
+def retries_exhausted(request: RequestItem) -> bool:
+    """True once a request has used up its attempts or its total retry time"""
     if request.attempts >= MAX_RETRIES:
-        logger.error(f"Request {request.id} failed after {MAX_RETRIES} attempts: {request.error}")
-        return request
-        
+        return True
+    return request.start_time is not None and time.time() - request.start_time > MAX_RETRY_TIME
+
+def request_params(request: RequestItem) -> Dict[str, Any]:
+    """Everything sent besides model and messages; part of the response cache key"""
+    return {**GENERATION_PARAMS, **request.params}
+
+def restore_stop_sequence(response: ChatCompletion, stop: Optional[List[str]]) -> None:
+    """
+    Put back the closing tag that ended the response.
+    
+    Providers drop the matched stop sequence, so "<answer>300</answer>" comes back as
+    "<answer>300". The tag whose opening is still unclosed at the end is re-appended,
+    leaving the answer in the shape the parsers expect.
+    """
+    if not stop or not response.choices:
+        return
+    choice = response.choices[0]
+    content = choice.message.content
+    if choice.finish_reason != "stop" or not content:
+        return
+    for sequence in stop:
+        if not sequence.startswith("</"):
+            continue
+        opening = "<" + sequence[2:]
+        if content.rfind(opening) > content.rfind(sequence):
+            choice.message.content = content + sequence
+            return
+
+@dataclass
+class SharedAnswer:
+    """What later copies of a prompt take from the request sent for it, without its messages"""
+    id: int
+    response_json: str  # the ChatCompletion, serialised so it holds one string instead of a model tree
+    truncated_at: Optional[int] = None
+    streamed_chars: Optional[int] = None
+    option_probs: Optional[Dict[str, float]] = None
+    option_mass: Optional[float] = None
+
+    @classmethod
+    def of(cls, request: RequestItem) -> "SharedAnswer":
+        return cls(request.id, request.result.model_dump_json(), request.truncated_at, request.streamed_chars,
+                   request.option_probs, request.option_mass)
+
+def share_result(leader: RequestItem, follower: RequestItem) -> None:
+    """Give a duplicate request the outcome of the request that was sent for it"""
+    follower.result = leader.result
+    follower.error = leader.error
+    follower.status_code = leader.status_code
+    follower.error_class = leader.error_class
+    follower.truncated_at = leader.truncated_at
+    follower.streamed_chars = leader.streamed_chars
+    follower.option_probs = leader.option_probs
+    follower.option_mass = leader.option_mass
+    follower.duplicate_of = leader.id
+    follower.end_time = time.time()
+
+def share_answer(answer: SharedAnswer, follower: RequestItem) -> None:
+    """Answer a duplicate request from a remembered success"""
+    follower.result = ChatCompletion.model_validate_json(answer.response_json)
+    follower.truncated_at = answer.truncated_at
+    follower.streamed_chars = answer.streamed_chars
+    follower.option_probs = answer.option_probs
+    follower.option_mass = answer.option_mass
+    follower.duplicate_of = answer.id
+    follower.end_time = time.time()
+
+def first_token_logprobs(logprobs: Optional[Dict[str, Any]]) -> List[tuple]:
+    """(token, logprob) alternatives for the first generated token, from OpenAI-style or legacy logprobs"""
+    if not logprobs:
+        return []
+    if logprobs.get("content"):
+        first = logprobs["content"][0]
+        alternatives = first.get("top_logprobs") or [first]
+        return [(entry["token"], entry["logprob"]) for entry in alternatives]
+    if logprobs.get("top_logprobs"):
+        # Completions-style: one {token: logprob} dict per position
+        return list(logprobs["top_logprobs"][0].items())
+    if logprobs.get("tokens"):
+        return [(logprobs["tokens"][0], logprobs["token_logprobs"][0])]
+    return []
+
+def score_options(request: RequestItem) -> None:
+    """
+    Answer an MCQ with its most likely option label.
+    
+    The first token's probability is summed per label (" A" and "A" both count for
+    A) and normalised over the labels. If no label is among the returned
+    alternatives, the generated token is kept as the answer, so it counts as a
+    format error rather than a guess.
+    """
+    if not request.option_labels or request.result is None or not request.result.choices:
+        return
+    choice = request.result.choices[0]
+    probs = {label: 0.0 for label in request.option_labels}
+    logprobs = choice.logprobs.model_dump() if choice.logprobs is not None else None
+    for token, logprob in first_token_logprobs(logprobs):
+        label = token.strip()
+        if label in probs and logprob is not None:
+            probs[label] += math.exp(logprob)
+    mass = sum(probs.values())
+    if mass == 0:
+        return
+    request.option_probs = {label: round(prob / mass, 6) for label, prob in probs.items()}
+    request.option_mass = round(mass, 6)
+    choice.message.content = max(probs, key=probs.get)
+
+def request_cache_key(request: RequestItem) -> str:
+    params = request_params(request)
+    if request.extractor is not None:
+        # A streamed answer may be cut short, so it is not interchangeable with a full one
+        params["answer_extractor"] = getattr(request.extractor, "name", repr(request.extractor))
+    return make_cache_key(request.model, request.messages, params)
+
+async def load_cached_response(request: RequestItem, cache: Optional[ResponseCache]) -> bool:
+    """Fill in request.result from the cache; True on a hit"""
+    if cache is None or not cache.readable:
+        return False
+    # SQLite reads happen off the event loop
+    cached = await asyncio.to_thread(cache.get, request_cache_key(request))
+    if cached is None:
+        return False
+    request.result = ChatCompletion.model_validate(cached)
+    score_options(request)
+    request.cached = True
+    request.end_time = time.time()
+    return True
+
+@dataclass
+class CallTrace:
+    """What one backend call of an attempt saw while it streamed; a hedged attempt has two"""
+    first_byte: Optional[float] = None
+    truncated_at: Optional[int] = None
+    streamed_chars: Optional[int] = None
+
+def make_until(extractor: Callable[[str], Optional[int]], trace: CallTrace) -> Callable[[str], Optional[int]]:
+    """Stream stop check that records where the answer ended on trace"""
+    def until(text):
+        end = extractor(text)
+        if end is not None:
+            trace.truncated_at = end
+            trace.streamed_chars = len(text)
+        return end
+    return until
+
+async def attempt_chat_request(
+    backend,
+    request: RequestItem,
+    limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    hedger: Optional[Hedger] = None,
+    breaker: Optional[CircuitBreaker] = None,
+    timeout: Optional[float] = None,
+) -> None:
+    """
+    Run a single attempt; on failure record the error and raise the classified APIException
+    
+    With a hedger, a second copy is sent if the attempt outlives the model's rolling
+    p95 latency. The copy bypasses the rate limiter's wait; the hedger's budget caps
+    it, and its tokens are charged afterwards at the winner's usage. Each call keeps
+    its own TTFB and truncation point, and only the winner's are recorded. An attempt still unanswered after `timeout` seconds fails as retryable, and the
+    outcome is reported to the model's circuit breaker.
+    """
     request.attempts += 1
-    backoff_time = 0
+    estimated_tokens = estimate_tokens(request.messages, request.params.get("max_tokens"))
     
     try:
         # Update start time for accurate duration measurement
         if request.attempts == 1:
             request.start_time = time.time()
+        
+        if rate_limiter:
+            await rate_limiter.acquire(estimated_tokens)
+        attempt_start = time.time()
+        if request.enqueued_at is not None:
+            request.queue_wait += attempt_start - request.enqueued_at
+            request.enqueued_at = None
+        request.truncated_at = request.streamed_chars = None
+        traces: List[CallTrace] = []
+        
+        async def chat():
+            # Primary and hedge each get their own trace, so the loser cannot overwrite the winner's
+            trace = CallTrace()
+            traces.append(trace)
             
-        response = await client.chat.completions.create(
-            model=request.model,
-            messages=request.messages,
-            temperature=0,
-        )
+            def on_first_byte():
+                trace.first_byte = time.time()
+            
+            until = make_until(request.extractor, trace) if request.extractor is not None else None
+            response = await backend.chat(request.model, request.messages, on_first_byte=on_first_byte, until=until, **request_params(request))
+            return response, trace
+        
+        async def send():
+            if hedger is None:
+                return await chat(), False
+            return await hedger.call(request.model, chat)
+        
+        try:
+            (response, trace), request.hedge_won = await asyncio.wait_for(send(), timeout)
+        except asyncio.TimeoutError:
+            raise APIException(f"Attempt timed out after {timeout:.0f}s")
+        restore_stop_sequence(response, request.params.get("stop"))
         
         request.result = response
-    
-    
+        request.truncated_at = trace.truncated_at
+        request.streamed_chars = trace.streamed_chars
+        score_options(request)
+        request.error = None
         request.end_time = time.time()
-        return request
+        request.ttfb = (trace.first_byte or request.end_time) - attempt_start
+        if rate_limiter:
+            actual_tokens = usage_total_tokens(response.usage)
+            rate_limiter.reconcile(estimated_tokens, actual_tokens)
+            if len(traces) > 1:
+                # The hedge copy skipped acquire(); the cancelled call's usage is unknown, so charge the winner's
+                rate_limiter.reconcile(0, actual_tokens or estimated_tokens)
+        if limiter:
+            limiter.on_success(request.end_time - attempt_start)
+        if breaker:
+            breaker.on_success()
+        if cache and cache.writable:
+            await asyncio.to_thread(cache.put, request_cache_key(request), request.model, response.model_dump())
         
     except Exception as e:
-        error_message = str(e)
-        request.error = error_message
-        
-        # Determine error type for appropriate backoff
-        is_rate_limit = "rate limit" in error_message.lower() or "429" in error_message
-        status_code = None
+        error = classify_error(e)
+        request.error = error.message
+        request.status_code = error.status_code
+        request.error_class = error.error_class
+        if rate_limiter:
+            # Failed attempts use up a request slot but no tokens
+            rate_limiter.reconcile(estimated_tokens, 0)
         
-        # Extract status code if present
-        if "status_code=" in error_message:
-            try:
-                status_code = int(error_message.split("status_code=")[1].split()[0])
-            except:
-                pass
+        if limiter:
+            if error.is_rate_limit:
+                limiter.on_rate_limit()
+            else:
+                limiter.on_error()
+        if breaker:
+            if error.endpoint_failure:
+                breaker.on_failure()
+            else:
+                breaker.on_success()
         
-        # Calculate backoff time with exponential strategy and jitter
-        if is_rate_limit:
-            # Longer backoff for rate limits (exponential with base 2)
-            backoff_time = RATE_LIMIT_INITIAL_BACKOFF * (2 ** (request.attempts - 1))
+        if error.is_rate_limit:
             logger.warning(f"Rate limit hit for request {request.id}. Attempt {request.attempts}/{MAX_RETRIES}")
+        elif error.retryable:
+            logger.warning(f"Request {request.id} failed with error: {error.message}. Attempt {request.attempts}/{MAX_RETRIES}")
         else:
-            # Shorter backoff for other errors (exponential with base 1.5)
-            backoff_time = GENERAL_ERROR_INITIAL_BACKOFF * (1.5 ** (request.attempts - 1))
-            logger.warning(f"Request {request.id} failed with error: {error_message}. Attempt {request.attempts}/{MAX_RETRIES}")
-        
-        # Add jitter to prevent synchronized retries
-        backoff_time = backoff_time * (0.8 + 0.4 * random.random())
-        
-        # Cap backoff time
-        backoff_time = min(backoff_time, 60)  # Maximum 60 second backoff
-        
-        logger.info(f"Backing off for {backoff_time:.2f}s before retry")
-        await asyncio.sleep(backoff_time)
-        
-        # Recursive retry with updated attempt count
-        return await process_chat_request(client, request)
+            logger.error(f"Request {request.id} failed with non-retryable error (status {error.status_code}): {error.message}")
+        raise error
+
+async def process_chat_request(
+    backend,
+    request: RequestItem,
+    limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+) -> RequestItem:
+    """Process a chat completion request, retrying retryable errors with backoff"""
+    if await load_cached_response(request, cache):
+        return request
+    while True:
+        try:
+            await attempt_chat_request(backend, request, limiter, rate_limiter, cache)
+            return request
+        except APIException as error:
+            if not error.retryable:
+                break
+            if retries_exhausted(request):
+                logger.error(f"Request {request.id} failed after {request.attempts} attempts: {request.error}")
+                break
+            backoff_time = retry_backoff(request, error)
+            logger.info(f"Backing off for {backoff_time:.2f}s before retry")
+            await asyncio.sleep(backoff_time)
+    
+    request.end_time = time.time()
+    return request
 
 async def process_batch(
-    batch: List[RequestItem],
-    semaphore: asyncio.Semaphore,
+    batch: Iterable[RequestItem],
+    limiters: ConcurrencyRegistry,
     pbar: tqdm,
     output_file: str,
-    file_lock: asyncio.Lock
-) -> List[RequestItem]:
-    """Process a batch of chat completion requests with concurrency control"""
-    # Initialize AsyncOpenAI client
-    client = AsyncOpenAI(
-        api_key=main_api_key,
-        base_url=BASE_URL,
-    )
+    rpm: Optional[int] = None,
+    tpm: Optional[int] = None,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    cache: Optional[ResponseCache] = None,
+    record_format: str = "compact",
+    on_result: Optional[ResultCallback] = None,
+    backend=None,
+    telemetry: Optional[RunTelemetry] = None,
+    usage_ledger: Optional[TaggedLedger] = None,
+    dedup: bool = True,
+    hedger: Optional[Hedger] = None,
+    attempt_timeout: Optional[float] = None
+) -> RunStats:
+    """
+    Stream chat completion requests through a bounded queue to a pool of workers.
     
+    `batch` is consumed lazily, so requests are only rendered shortly before a worker
+    is free, and each result is dropped once it has been written to output_file.
+    Memory therefore depends on queue_size and the concurrency limit, not on the
+    number of requests.
     
-    # Initialize an empty list to collect all results
-    all_results = []
+    Each worker makes a single attempt per dequeued request. A retryable failure is
+    put back on the queue after its backoff, so the concurrency slot goes to other
+    requests in the meantime. Requests that fail fatally or run out of retries are
+    written to output_file as failures and to the dead-letter file next to it.
+    Cache hits are answered without taking a concurrency slot or rate-limit budget.
+    on_result, if given, is called once per request when its outcome is final,
+    telemetry, if given, observes its timings and usage_ledger records its tokens.
     
-    # Create a queue to collect completed results for processing
-    result_queue = asyncio.Queue()
+    With dedup, requests are keyed like the response cache (model, messages and
+    generation params). Only the first request of a key is sent. Copies that arrive
+    while it is in flight wait for it, later copies of a successful one are answered
+    from it. Every copy is still written under its own index and question ID, marked
+    with duplicate_of. Only the serialised response of a success is remembered, for
+    the DEDUP_MAX_ANSWERS most recently used prompts; a copy of an older one is sent
+    again (or served by the response cache).
     
-    # Start a task to process results as they come in
-    async def process_results():
-        while True:
-            result = await result_queue.get()
-            
-            # Save result to file immediately with lock to prevent concurrent writes
-            async with file_lock:
-                result_dict = {
-                    'request': {
-                        'model': result.model,
-                        'messages': result.messages
-                    },
-                    'response': result.result.model_dump() if result.result else None,
-                    'error': result.error,
-                    'duration': result.duration,
-                    'attempts': result.attempts,
-                    'metadata': result.metadata
-                }
-                
-                # Append to output file
-                with open(output_file, 'a', encoding="utf-8") as f:
-                    f.write(json.dumps(result_dict) + '\n')
-            
-            # Mark task as done
-            result_queue.task_done()
+    With a hedger, slow attempts are hedged (see hedging.py) inside the same slot.
+    Each attempt gets attempt_timeout seconds. While a model's circuit breaker is
+    open its requests wait before taking a slot; once it gives up they fail
+    without being sent and go to the dead-letter file.
+    """
+    # Together through the shared pooled client unless another backend is given
+    backend = backend or make_backend("together", BASE_URL, main_api_key)
+    dead_letter_file = dead_letter_path(output_file)
+    
+    stats = RunStats()
+    request_queue = asyncio.Queue(maxsize=queue_size)
+    # One buffered writer per file; records are built and encoded off the event loop
+    writer = ResultWriter(output_file, record_builder(record_format), queue_size=queue_size).start()
+    dead_letter_writer = ResultWriter(dead_letter_file, build_dead_letter_record).start()
+    # Enough workers for the highest limit a model can reach; idle ones wait on the limiter
+    num_workers = limiters.max_limit
+    # Requests produced but not yet finished, including those waiting out a backoff
+    outstanding = 0
+    producer_done = False
+    all_done = asyncio.Event()
+    retry_tasks = set()
+    # key -> copies waiting for the request in flight; key -> successful answer, least recently used first
+    waiting: Dict[str, List[RequestItem]] = {}
+    answered: "OrderedDict[str, SharedAnswer]" = OrderedDict()
+    
+    def finish_one():
+        nonlocal outstanding
+        outstanding -= 1
+        if producer_done and outstanding == 0:
+            all_done.set()
+    
+    async def produce():
+        nonlocal outstanding, producer_done
+        for req in batch:
+            outstanding += 1
+            if dedup:
+                key = request_cache_key(req)
+                if key in answered:
+                    answered.move_to_end(key)
+                    share_answer(answered[key], req)
+                    await finish(req)
+                    continue
+                if key in waiting:
+                    waiting[key].append(req)
+                    continue
+                waiting[key] = []
+            req.enqueued_at = time.time()
+            await request_queue.put(req)
+        producer_done = True
+        if outstanding == 0:
+            all_done.set()
     
-    # Start the result processor
-    asyncio.create_task(process_results())
+    async def stop_workers():
+        await all_done.wait()
+        for _ in range(num_workers):
+            await request_queue.put(None)
     
-    async def process_with_semaphore(req: RequestItem):
-        async with semaphore:
-            result = await process_chat_request(client, req)
-            pbar.update(1)
-            duration = result.duration
+    async def requeue(req: RequestItem, delay: float):
+        await asyncio.sleep(delay)
+        req.enqueued_at = time.time()
+        await request_queue.put(req)
+    
+    async def work():
+        while True:
+            req = await request_queue.get()
+            if req is None:
+                return
+            error = None
+            if req.attempts > 0 or not await load_cached_response(req, cache):
+                rate_limiter = get_rate_limiter(backend.name, req.model, getattr(backend, "api_key", None), rpm, tpm) if (rpm or tpm) else None
+                try:
+                    async with limiters.slot(req.model) as limiter:
+                        try:
+                            await attempt_chat_request(backend, req, limiter, rate_limiter, cache, hedger,
+                                                       limiters.breaker(req.model), attempt_timeout)
+                        except APIException as e:
+                            error = e
+                except CircuitOpenError as e:
+                    error = APIException(str(e), retryable=False)
+                    req.error = error.message
+                    req.error_class = "circuit_open"
             
-            if result.error and not result.result:
-                pbar.set_description(f"Req {req.id}: {duration:.1f}s, {req.attempts} attempts (FAILED)")
-            else:
-                pbar.set_description(f"Req {req.id}: {duration:.1f}s, {req.attempts} attempts")
+            if error is not None and error.retryable and not retries_exhausted(req):
+                # Back off outside the slot so other requests keep the model busy
+                task = asyncio.create_task(requeue(req, retry_backoff(req, error)))
+                retry_tasks.add(task)
+                task.add_done_callback(retry_tasks.discard)
+                continue
             
-            # Add result to queue for processing
-            await result_queue.put(result)
-            all_results.append(result)
+            if error is not None:
+                if error.retryable:
+                    logger.error(f"Request {req.id} failed after {req.attempts} attempts: {req.error}")
+                if req.end_time is None:
+                    req.end_time = time.time()
             
-            return result
+            await finish(req)
+            if dedup:
+                key = request_cache_key(req)
+                if req.result is not None:
+                    answered[key] = SharedAnswer.of(req)
+                    if len(answered) > DEDUP_MAX_ANSWERS:
+                        answered.popitem(last=False)
+                for follower in waiting.pop(key, []):
+                    share_result(req, follower)
+                    await finish(follower)
     
-    # Create and run tasks for all requests
-    tasks = [process_with_semaphore(req) for req in batch]
-    results = await asyncio.gather(*tasks, return_exceptions=False)
+    async def finish(req: RequestItem):
+        """Report, count and write a request whose outcome is final"""
+        pbar.update(1)
+        duration = req.duration
+        
+        if req.cached:
+            pbar.set_description(f"Req {req.id}: cached")
+        elif req.duplicate_of is not None:
+            pbar.set_description(f"Req {req.id}: same prompt as {req.duplicate_of}")
+        elif req.error and not req.result:
+            pbar.set_description(f"Req {req.id}: {duration:.1f}s, {req.attempts} attempts (FAILED)")
+        else:
+            pbar.set_description(f"Req {req.id}: {duration:.1f}s, {req.attempts} attempts")
+        
+        if on_result:
+            on_result(req.id, req.metadata, req.messages, response_content(req))
+        
+        # Hand the result to the writer; it is released once persisted
+        stats.add(req)
+        if telemetry is not None:
+            observe_request(telemetry, req)
+        if usage_ledger is not None and req.result is not None:
+            usage_ledger.record(req.model, req.result.usage, cached=req.cached or req.duplicate_of is not None)
+        await writer.write(req)
+        if req.result is None:
+            await dead_letter_writer.write(req)
+        finish_one()
     
-    # Wait for all results to be processed
-    await result_queue.join()
+    tasks = [asyncio.create_task(produce()), asyncio.create_task(stop_workers())]
+    tasks += [asyncio.create_task(work()) for _ in range(num_workers)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks + list(retry_tasks):
+            task.cancel()
+        raise
+    finally:
+        # Flush whatever already completed, even on Ctrl-C
+        await writer.close()
+        await dead_letter_writer.close()
     
-    return results
+    logger.info(writer.summary())
+    if stats.failed:
+        logger.warning(f"{stats.failed} failed requests written to {dead_letter_file}")
+    return stats
+
+def observe_request(telemetry: RunTelemetry, request: RequestItem) -> None:
+    """Record a finished request's timings, usage and error class"""
+    usage = request.result.usage if request.result is not None else None
+    telemetry.model(request.model).observe(
+        queue_wait=request.queue_wait,
+        ttfb=request.ttfb,
+        total=request.duration,
+        succeeded=request.result is not None,
+        cached=request.cached,
+        deduplicated=request.duplicate_of is not None,
+        attempts=request.attempts,
+        prompt_tokens=(usage.prompt_tokens or 0) if usage else 0,
+        completion_tokens=(usage.completion_tokens or 0) if usage else 0,
+        error_class=request.error_class,
+    )
+
+def telemetry_paths(output_file: str):
+    """OpenMetrics file and JSON summary written next to a results JSONL"""
+    base, _ = os.path.splitext(output_file)
+    return f"{base}.prom", f"{base}.telemetry.json"
+
+def iter_result_records(output_file: str):
+    """Yield parsed records from a results JSONL file, skipping truncated lines"""
+    with open(output_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A crash mid-write can leave a partial last line behind
+                logger.warning(f"Skipping unreadable line in {output_file}")
+
+def load_completed_responses(output_file: str) -> Dict[Any, Optional[str]]:
+    """Map each question ID that already has a successful response in output_file to that response"""
+    completed = {}
+    if not os.path.exists(output_file):
+        return completed
+    for record in iter_result_records(output_file):
+        question_id = record_question_id(record)
+        if question_id is not None and record_succeeded(record):
+            completed[question_id] = record_content(record)
+    return completed
+
+def load_completed_question_ids(output_file: str) -> set:
+    """Collect the question IDs that already have a successful response in output_file"""
+    return set(load_completed_responses(output_file))
+
+def start_dead_letter_replay(output_file: str) -> Optional[str]:
+    """Move the dead-letter requests aside so this run can write new failures to the usual path"""
+    dead_letter_file = dead_letter_path(output_file)
+    base, _ = os.path.splitext(dead_letter_file)
+    replay_file = f"{base}.replay.jsonl"
+    if os.path.exists(dead_letter_file):
+        # Add to the requests left over from an interrupted replay, if any
+        with open(dead_letter_file, 'r', encoding="utf-8") as src, open(replay_file, 'a', encoding="utf-8") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(dead_letter_file)
+    if not os.path.exists(replay_file):
+        return None
+    return replay_file
+
+def prepare_output_file(output_file: str, resume: bool) -> None:
+    """Truncate output_file, or keep it for appending when resuming a previous run"""
+    # Failed requests are sent again either way, so the dead-letter file starts empty
+    dead_letter_file = dead_letter_path(output_file)
+    if os.path.exists(dead_letter_file):
+        os.remove(dead_letter_file)
+    if not resume or not os.path.exists(output_file):
+        with open(output_file, 'w', encoding="utf-8") as f:
+            pass
+        return
+    # Make sure appended records start on a fresh line after an interrupted write
+    with open(output_file, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
 
 async def parallel_process_chat(
-    requests: List[Dict[str, Any]],
+    requests: Iterable[Dict[str, Any]],
     output_file: str = "results.jsonl",
-    max_concurrency: int = 10
+    options: Optional[InferenceOptions] = None,
+    limiters: Optional[ConcurrencyRegistry] = None,
+    total: Optional[int] = None,
+    run_info: Optional[Dict[str, Any]] = None,
+    on_result: Optional[ResultCallback] = None,
+    backend=None,
+    extractor: Optional[Callable[[str], Optional[int]]] = None
 ) -> None:
     """
     Process multiple chat completion requests in parallel and save results to a JSONL file
     
     Args:
-        requests: List of request dictionaries containing messages and optional model
+        requests: List or lazy iterable of request dictionaries containing messages and optional model
         output_file: Path to output JSONL file
-        max_concurrency: Maximum number of concurrent requests
+        options: Concurrency, rate-limit, resume, replay and cache settings (defaults to InferenceOptions())
+        limiters: Per-model limiters shared with other concurrent runs (e.g. a sweep);
+            a private registry is created from options when omitted
+        total: Number of requests for the progress bar when `requests` is a generator
+        run_info: Fields shared by every request (system message, prompt template, ...)
+            stored once in the <output>.meta.json sidecar instead of in each record
+        on_result: Called as on_result(index, metadata, messages, content) for every
+            request, in completion order, including requests skipped because they
+            already succeeded in a resumed file (content is None for failures)
+        backend: Where requests are sent (defaults to Together, see backends.py)
+        extractor: Answer extractor (PromptType.get_gen_profile(...).extractor); with
+            options.stream, responses are streamed and closed once it finds the answer
+    
+    Each request gets an index, its 1-based position in `requests` (kept when resuming
+    or replaying), which compact records store instead of the prompt. With
+    options.schedule "longest_first" the requests are sent longest first within
+    windows of options.schedule_window (see scheduling.py).
+    Queue-wait, time-to-first-byte and total time of the requests sent in this run
+    are exported to <output>.prom (OpenMetrics) and <output>.telemetry.json.
     """
-    # Create/clear output file before starting
-    with open(output_file, 'w', encoding="utf-8") as f:
-        pass
-    
-    # Create a lock for file access
-    file_lock = asyncio.Lock()
-    
-    # Prepare request items
-    request_items = []
-    for i, req in enumerate(requests, 1):
-        request_items.append(RequestItem(
-            id=i,
+    options = options or InferenceOptions()
+    resume = options.resume
+    replay_file = None
+    if options.replay_dead_letter:
+        # Re-send only the stored failures and append to the existing results
+        resume = True
+        replay_file = start_dead_letter_replay(output_file)
+        if replay_file is None:
+            logger.info(f"No dead-letter requests to replay for {output_file}")
+            return
+        requests = iter_dead_letter_requests(replay_file)
+        total = count_lines(replay_file)
+        logger.info(f"Replaying {total} dead-letter requests from {replay_file}")
+    if total is None and isinstance(requests, list):
+        total = len(requests)
+    indexed_requests = ((req.get("index") or i, req) for i, req in enumerate(requests, 1))
+    if resume:
+        completed = load_completed_responses(output_file)
+        if completed:
+            logger.info(f"Resuming {output_file}: {len(completed)} question IDs already completed")
+            
+            def skip_completed(items):
+                for index, req in items:
+                    question_id = (req.get("metadata") or {}).get("question_id")
+                    if question_id not in completed:
+                        yield index, req
+                    elif on_result:
+                        on_result(index, req.get("metadata"), req.get("messages", []), completed[question_id])
+            
+            indexed_requests = skip_completed(indexed_requests)
+            if total is not None and replay_file is None:
+                total = max(total - len(completed), 0)
+    # Indices are fixed above, so a different send order leaves the outputs unchanged
+    indexed_requests = schedule_requests(indexed_requests, options.schedule, options.schedule_window)
+    
+    # Create/clear output file before starting (kept as-is when resuming)
+    prepare_output_file(output_file, resume)
+    if replay_file is None:
+        write_sidecar(output_file, options.record_format, run_info)
+    
+    # Request items are built lazily as the workers pull them
+    request_items = (
+        RequestItem(
+            id=index,
             messages=req.get("messages", []),
             model=req.get("model", DEFAULT_MODEL),
-            metadata=req.get("metadata")
-        ))
+            metadata=req.get("metadata"),
+            params=req.get("params") or {},
+            extractor=extractor if options.stream else None,
+            option_labels=req.get("option_labels")
+        )
+        for index, req in indexed_requests
+    )
+    
+    # Per-model adaptive concurrency control
+    shared_limiters = limiters is not None
+    if not shared_limiters:
+        limiters = options.make_limiters()
     
-    # Create semaphore for concurrency control
-    semaphore = asyncio.Semaphore(max_concurrency)
+    # Shared with every other run that uses the same cache file
+    cache = options.open_cache(output_file)
+    
+    dataset = (run_info or {}).get("dataset_name") or os.path.basename(output_file)
+    telemetry = RunTelemetry(dataset)
+    usage_ledger = options.open_usage_ledger(dataset)
+    hedger = Hedger(options.hedge_budget) if options.hedge else None
     
     # Process requests with progress bar
     total_start_time = time.time()
-    with tqdm(total=len(request_items), desc="Processing chat completions") as pbar:
-        results = await process_batch(request_items, semaphore, pbar, output_file, file_lock)
+    with tqdm(total=total, desc=os.path.basename(output_file)) as pbar:
+        stats = await process_batch(
+            request_items, limiters, pbar, output_file,
+            options.rpm, options.tpm, options.queue_size, cache, options.record_format, on_result,
+            backend, telemetry, usage_ledger, options.dedup, hedger, options.attempt_timeout
+        )
+    if usage_ledger is not None:
+        usage_ledger.flush()
+    
+    if replay_file:
+        # Every replayed request is now either in the results or back in the dead-letter file
+        os.remove(replay_file)
+    
+    if stats.count == 0:
+        logger.info(f"Nothing left to process for {output_file}")
+        return
     
     # Calculate final statistics
     total_time = time.time() - total_start_time
-    successful = sum(1 for r in results if r.result is not None)
-    failed = sum(1 for r in results if r.result is None)
-    avg_duration = sum(r.duration for r in results) / len(results)
-    avg_attempts = sum(r.attempts for r in results) / len(results)
+    avg_duration = stats.total_duration / stats.count
+    avg_attempts = stats.total_attempts / stats.count
     
     # Log summary
     logger.info(f"Processing complete in {total_time:.2f}s")
-    logger.info(f"Successful: {successful}, Failed: {failed}")
+    logger.info(f"Successful: {stats.successful}, Failed: {stats.failed}")
+    if cache:
+        cache.flush()
+        logger.info(f"Served from cache: {stats.cached}; {cache.summary()}")
+    if stats.deduplicated:
+        logger.info(f"Deduplicated: {stats.deduplicated} requests not sent, their prompts matched an earlier question")
+    if options.stream:
+        logger.info(f"Streams closed once the answer was complete: {stats.truncated}")
+    if hedger is not None:
+        hedger.log_summary()
     logger.info(f"Average request duration: {avg_duration:.2f}s")
     logger.info(f"Average attempts per request: {avg_attempts:.2f}")
-    logger.info(f"Results written to {output_file}")
+    if not shared_limiters:
+        limiters.log_summary()
+    telemetry.log_summary()
+    metrics_file, summary_file = telemetry_paths(output_file)
+    telemetry.write_openmetrics(metrics_file)
+    telemetry.write_json(summary_file)
+    logger.info(f"Results written to {output_file}; telemetry in {metrics_file} and {summary_file}")
 
 def run_parallel_chat_completions(
     requests: List[Dict[str, Any]],
     output_file: str = "results.jsonl",
-    max_concurrency: int = 5
+    max_concurrency: int = 5,
+    options: Optional[InferenceOptions] = None
 ) -> None:
     """
     Process multiple chat completion requests in parallel
@@ -292,41 +1147,158 @@ def run_parallel_chat_completions(
         # ... more requests ...
     ]
     run_parallel_chat_completions(requests, output_file="results.jsonl")
+    
+    Pass options=InferenceOptions(resume=True) to keep an interrupted output file and
+    only send the missing or failed requests (matched on metadata["question_id"]).
+    """
+    options = options or InferenceOptions(max_concurrency=max_concurrency)
+    
+    async def run():
+        try:
+            await parallel_process_chat(requests, output_file, options)
+        finally:
+            # Pooled clients belong to this event loop
+            await close_clients()
+    
+    asyncio.run(run())
+
+def save_results_to_csv(jsonl_file, csv_file, dataset_name, model_name, system_message, prompts=None, parquet_file=None):
+    """
+    Write the per-model CSV (header included) from a results JSONL file.
+    
+    `prompts`, an iterable of (question_id, prompt) rendered again from the dataset,
+    fills in the prompts that compact records do not store and puts the rows in
+    dataset order. Without it rows follow the JSONL.
     """
-    asyncio.run(parallel_process_chat(requests, output_file, max_concurrency))
-
-def save_results_to_csv(jsonl_file, csv_file, dataset_name, model_name, system_message):
-    with open(jsonl_file, "r", encoding="utf-8") as infile, open(csv_file, "a", encoding="utf-8", newline="") as outfile:
-        writer = csv.writer(outfile)
-        for line in infile:
-            data = json.loads(line.strip())
-
-            # Extract fields
-            prompt = data["request"]["messages"][1]["content"]
-            model_response = data["response"]["choices"][0]["message"]["content"] if data["response"] else "EMPTY RESPONSE" 
-            ground_truth = data["metadata"]["ground_truth"] if "metadata" in data and "ground_truth" in data["metadata"] else "None"
-            question_id = data["metadata"]["question_id"] if "metadata" in data and "question_id" in data["metadata"] else "UNKNOWN"
+    # A resumed run can hold several records per question; keep the successful one
+    rows = {}
+    for data in iter_result_records(jsonl_file):
+        # Extract fields
+        succeeded = record_succeeded(data)
+        model_response = record_content(data) if succeeded else EMPTY_RESPONSE
+        metadata = data.get("metadata") or {}
+        ground_truth = metadata.get("ground_truth", "None")
+        question_id = record_question_id(data)
+        if question_id is None:
+            question_id = "UNKNOWN"
         
-            writer.writerow([question_id, dataset_name, model_name, system_message, prompt, model_response, ground_truth])
+        key = question_id if question_id != "UNKNOWN" else len(rows)
+        if key in rows and not succeeded:
+            continue
+        rows[key] = [question_id, dataset_name, model_name, system_message, record_prompt(data), model_response, ground_truth]
+    
+    with OrderedTableWriter(csv_file, CSV_COLUMNS, parquet_file) as table:
+        index = 0
+        if prompts is not None:
+            for question_id, prompt in prompts:
+                row = rows.pop(question_id, None)
+                if row is not None:
+                    if row[4] is None:
+                        row[4] = prompt
+                    index += 1
+                    table.add(index, row)
+        # Records whose question is not in the dataset keep their JSONL order
+        for row in rows.values():
+            index += 1
+            table.add(index, row)
 
 
+def iter_questions(file_path, start=1):
+    """Lazily yield the rows of a dataset JSONL file, from the `start`-th (1-based) on"""
+    with open(file_path, "r", encoding="utf-8") as file:
+        index = 0
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            index += 1
+            # Earlier rows are counted without parsing them
+            if index >= start:
+                yield json.loads(line)
+
+def count_lines(file_path) -> int:
+    """Count non-empty rows without parsing them (for progress bars)"""
+    with open(file_path, "rb") as file:
+        return sum(1 for line in file if line.strip())
+
+def render_prompts(file_path, input_msg, process_question, start=1, first_dummy_qid=1):
+    """
+    Render prompts one question at a time: yields (prompt, ground_truth, question_id)
+    
+    Questions without an ID are numbered from first_dummy_qid. To start mid-dataset,
+    pass the number the questions before `start` leave it at (see dummy_qid_offsets).
+    """
+    qid_dummy = first_dummy_qid
+    for question in iter_questions(file_path, start):
+        input_text_model, ground_truth, qid = process_question(
+            input_msg, question
+        )
+        if qid == None:
+            qid = qid_dummy
+            qid_dummy += 1
+        yield input_text_model, ground_truth, qid
+
+def dummy_qid_offsets(file_path, input_msg, process_question, chunk_size) -> List[int]:
+    """The dummy question ID render_prompts reaches at the start of each chunk of chunk_size rows"""
+    offsets = []
+    qid_dummy = 1
+    for index, question in enumerate(iter_questions(file_path)):
+        if index % chunk_size == 0:
+            offsets.append(qid_dummy)
+        if process_question(input_msg, question)[2] is None:
+            qid_dummy += 1
+    return offsets
 
-def query_ollama(model_name, input_text, system_message):
-    try: 
-        response = ollama.chat(
-            model=model_name,
-            messages=[
+def iter_dataset_requests(file_path, model_name, system_message, input_msg, process_question, params=None,
+                          mcq_logprobs=False, start=1, first_dummy_qid=1):
+    """Lazily build the chat request of every question in a dataset, in dataset order (from row `start`)"""
+    for input_text_model, ground_truth, qid in render_prompts(file_path, input_msg, process_question, start, first_dummy_qid):
+        yield {
+            "option_labels": option_labels(input_text_model) if mcq_logprobs else None,
+            "messages": [
                 {"role": "system", "content": system_message},
-                {"role": "user", "content": input_text},
+                {"role": "user", "content": input_text_model},
             ],
-            options={"temperature":0.0}
-        )
-        return response["message"]["content"].strip()
-    except Exception as e:
-        return f"Exception: {str(e)}"
+            "model": model_name,
+            "params": params or {},
+            "metadata": {
+                "ground_truth": ground_truth,
+                "question_id": qid,
+            }
+        }
 
+def generation_settings(gen_profile, model_name, options: InferenceOptions):
+    """(params, answer extractor, logprob MCQ scoring) for one model on one dataset"""
+    if gen_profile is None:
+        return None, None, False
+    if options.mcq_logprobs and gen_profile.mcq:
+        if not is_reasoning_model(model_name):
+            return gen_profile.logprob_params(), None, True
+        logger.warning(f"{model_name} thinks before answering, so its MCQs are scored from generated text, not logprobs")
+    extractor = gen_profile.extractor.for_model(model_name) if gen_profile.extractor else None
+    return gen_profile.params(model_name), extractor, False
 
-def infer(
+def parquet_path(output_csv) -> str:
+    """Parquet copy of a per-model CSV"""
+    return os.path.splitext(output_csv)[0] + ".parquet"
+
+def results_file_path(dir_save, dataset_name, model_name) -> str:
+    """The per-model results JSONL of a dataset"""
+    return os.path.join(dir_save, f"{dataset_name}_{model_name.replace('/','-')}_results.jsonl")
+
+def make_run_info(dataset_name, file_path, model_name, system_message, input_msg, params=None) -> Dict[str, Any]:
+    """Fields shared by every request of a run, stored in the results sidecar"""
+    return {
+        "dataset_name": dataset_name,
+        "dataset_path": file_path,
+        "model": model_name,
+        "system_message": system_message,
+        "input_template": input_msg,
+        "params": {**GENERATION_PARAMS, **(params or {})},
+    }
+
+
+async def infer_async(
     dataset_name,
     model_name,
     file_path,
@@ -335,91 +1307,107 @@ def infer(
     input_msg,
     process_question,
     together,
-    dir_save
+    dir_save,
+    options=None,
+    limiters=None,
+    backend=None,
+    gen_profile=None
 ):
-
-    with open(file_path, "r", encoding="utf-8") as file:
-        questions = [json.loads(line.strip()) for line in file]
-
-    with open(output_csv, "w", encoding="utf-8", newline="") as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(
-            [
-                "Question ID",
-                "Dataset Name",
-                "Model Name",
-                "System Prompt",
-                "Prompt",
-                "Model Response",
-                "Ground Truth",
-            ]
+    """
+    Run one dataset through one model and write the per-model CSV.
+    
+    Together and local Ollama models go through the same pipeline (retries,
+    checkpointing, cache, writers). `backend` is any backends.ChatBackend; when
+    omitted, `together` picks Together or the local Ollama server.
+    `gen_profile` (PromptType.get_gen_profile) caps the answer length and sets
+    stop sequences; without it only GENERATION_PARAMS are sent. With options.stream
+    its answer extractor closes each response as soon as the answer is complete.
+    With options.mcq_logprobs, MCQ datasets ask for a single token and answer with
+    the most likely option label instead.
+    """
+    options = options or InferenceOptions()
+    backend = backend or options.make_backend("together" if together else "ollama")
+    output_parquet = parquet_path(output_csv) if options.parquet else None
+    params, extractor, mcq_logprobs = generation_settings(gen_profile, model_name, options)
+    requests = iter_dataset_requests(file_path, model_name, system_message, input_msg, process_question, params, mcq_logprobs)
+    output_file_jsonl = results_file_path(dir_save, dataset_name, model_name)
+    run_info = make_run_info(dataset_name, file_path, model_name, system_message, input_msg, params)
+    
+    if options.replay_dead_letter:
+        # Only the dead-letter requests are sent, so the table is rebuilt from the JSONL afterwards
+        await parallel_process_chat(
+            requests=requests,
+            output_file=output_file_jsonl,
+            options=options,
+            limiters=limiters,
+            run_info=run_info,
+            backend=backend,
+            extractor=extractor
         )
-    qid_order = []
-    qid_dummy = 1
-    if together:
-        requests = []
-        for question in questions:
-            input_text_model, ground_truth, qid = process_question(
-                input_msg, question
-            )
-            if qid == None:
-                qid = qid_dummy
-                qid_dummy += 1
-            
-            qid_order.append(qid)
-            request = {
-                "messages": [
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": input_text_model},
-                ],
-                "model": model_name,
-                "metadata": {
-                    "ground_truth": ground_truth,
-                    "question_id": qid,
-                }
-            }
-            requests.append(request)
-        
-        output_file_jsonl = os.path.join(dir_save, f"{dataset_name}_{model_name.replace('/','-')}_results.jsonl")
-        run_parallel_chat_completions(
+        # Keep the event loop free for other jobs of a sweep
+        prompts = ((qid, input_text_model) for input_text_model, _, qid in render_prompts(file_path, input_msg, process_question))
+        await asyncio.to_thread(
+            save_results_to_csv, output_file_jsonl, output_csv, dataset_name, model_name,
+            system_message, prompts, output_parquet
+        )
+        return
+    
+    # Rows are committed in dataset order as soon as every earlier question is done
+    table = OrderedTableWriter(output_csv, CSV_COLUMNS, output_parquet).open()
+    
+    def on_result(index, metadata, messages, content):
+        metadata = metadata or {}
+        table.add(index, [
+            metadata.get("question_id"),
+            dataset_name,
+            model_name,
+            system_message,
+            messages[1]["content"],
+            content if content is not None else EMPTY_RESPONSE,
+            metadata.get("ground_truth"),
+        ])
+    
+    try:
+        await parallel_process_chat(
             requests=requests, 
             output_file=output_file_jsonl,
-            max_concurrency=10
+            options=options,
+            limiters=limiters,
+            total=count_lines(file_path),
+            run_info=run_info,
+            on_result=on_result,
+            backend=backend,
+            extractor=extractor
         )
-            
-        save_results_to_csv(output_file_jsonl, output_csv,dataset_name, model_name, system_message)
-    else:
-        for question in tqdm(questions, desc=f"Inferencing with {model_name}"):
-            input_text_model, ground_truth, qid = process_question(
-                input_msg, question
+    finally:
+        table.close()
+
+
+def infer(
+    dataset_name,
+    model_name,
+    file_path,
+    output_csv,
+    system_message,
+    input_msg,
+    process_question,
+    together,
+    dir_save,
+    options=None,
+    gen_profile=None
+):
+    """Synchronous entry point; runs infer_async() in its own event loop"""
+    async def run():
+        try:
+            await infer_async(
+                dataset_name, model_name, file_path, output_csv, system_message,
+                input_msg, process_question, together, dir_save, options, gen_profile=gen_profile
             )
-            if qid == None:
-                qid = qid_dummy
-                qid_dummy += 1
-                
-            qid_order.append(qid)
-            response = query_ollama(
-                model_name, input_msg, system_message
-            ).strip()
-            with open(output_csv, "a", encoding="utf-8", newline="") as csv_file:
-                writer = csv.writer(csv_file)
-                writer.writerow(
-                    [
-                        qid,
-                        dataset_name,
-                        model_name,
-                        system_message,
-                        input_text_model,
-                        response,
-                        ground_truth,
-                    ]
-
-                )
-    df = pd.read_csv(path_csv, encoding="utf-8")
-    df["Question ID"] = pd.Categorical(df["Question ID"], categories=qid_order, ordered=True)
-    df_sorted = df.sort_values("Question ID")
-    df_sorted.to_csv(f"{path_csv}", index=False)
-       
+        finally:
+            await close_clients()
+    
+    asyncio.run(run())
+
 
 
 if __name__ == "__main__":
@@ -430,14 +1418,112 @@ if __name__ == "__main__":
     import argparse
     import os
     from score import calculate_scores
+    # Imported here: batch_infer builds on this module
+    from batch_infer import batch_infer_async, DEFAULT_COMPLETION_WINDOW, DEFAULT_POLL_INTERVAL
+    from shard_infer import ShardJob, shard_infer, DEFAULT_CHUNK_SIZE, DEFAULT_LEASE_SECONDS
 
     parser = argparse.ArgumentParser()
     
-    parser.add_argument('--dataset_name')
-    parser.add_argument('--dataset_path')
+    parser.add_argument('--dataset_name', nargs='+',
+                        help='One or more dataset names, paired in order with --dataset_path')
+    parser.add_argument('--dataset_path', nargs='+')
     parser.add_argument('--dir_save')
     parser.add_argument('--language', default='en')
-    parser.add_argument('--together', action='store_true')
+    parser.add_argument('--together', action='store_true',
+                        help='Shorthand for --backend together')
+    parser.add_argument('--backend', choices=BACKEND_KINDS, default=None,
+                        help='Model provider (default: together with --together, otherwise ollama)')
+    parser.add_argument('--base_url', type=str, default=None,
+                        help='Endpoint for an OpenAI-compatible backend, e.g. a llama.cpp server on another port')
+    parser.add_argument('--mock_latency', type=float, default=0.05,
+                        help='Mean latency in seconds of the mock backend')
+    parser.add_argument('--mock_error_rate', type=float, default=0.0,
+                        help='Fraction of mock requests failing with a 500')
+    parser.add_argument('--mock_rate_limit_rate', type=float, default=0.0,
+                        help='Fraction of mock requests answered with a 429')
+    parser.add_argument('--mock_capacity', type=int, default=None,
+                        help='Mock backend answers 429 beyond this many in-flight requests')
+    parser.add_argument('--mock_tail_rate', type=float, default=0.0,
+                        help='Fraction of mock attempts that take --mock_tail_latency, like a slow endpoint')
+    parser.add_argument('--mock_tail_latency', type=float, default=5.0,
+                        help='Seconds taken by the slow mock attempts')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Run every (model, dataset) job concurrently in one event loop')
+    parser.add_argument('--global_concurrency', type=int, default=None,
+                        help='Cap on in-flight requests across all models of a sweep')
+    parser.add_argument('--resume', action='store_true',
+                        help='Reuse existing <dataset>_<model>_results.jsonl and only request missing or failed question IDs '
+                             '(with --shard_workers: reopen the chunks with failed questions)')
+    parser.add_argument('--replay_dead_letter', action='store_true',
+                        help='Only re-send the requests in <dataset>_<model>_results_dead_letter.jsonl, then rebuild the CSV')
+    parser.add_argument('--max_concurrency', type=int, default=10,
+                        help='Starting number of in-flight requests per model')
+    parser.add_argument('--concurrency_ceiling', type=int, default=64,
+                        help='Upper bound for the adaptive (AIMD) per-model concurrency')
+    parser.add_argument('--fixed_concurrency', action='store_true',
+                        help='Disable AIMD and keep exactly --max_concurrency requests in flight')
+    parser.add_argument('--rpm', type=int, default=None,
+                        help='Requests-per-minute budget per model for the provider')
+    parser.add_argument('--tpm', type=int, default=None,
+                        help='Tokens-per-minute budget per model for the provider')
+    parser.add_argument('--record_format', choices=['compact', 'full'], default='compact',
+                        help='compact keeps only the answer, usage and timing per row; full also keeps the request and raw response')
+    parser.add_argument('--ollama_host', type=str, default=None,
+                        help='Ollama server URL (default: OLLAMA_HOST or localhost:11434)')
+    parser.add_argument('--ollama_parallel', type=int, default=DEFAULT_OLLAMA_PARALLEL,
+                        help='Requests in flight against Ollama; match OLLAMA_NUM_PARALLEL on the server')
+    parser.add_argument('--ollama_keep_alive', type=str, default=DEFAULT_OLLAMA_KEEP_ALIVE,
+                        help='How long Ollama keeps a model loaded between requests')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Also write <dataset>_<model>_responses.parquet (needs pyarrow)')
+    parser.add_argument('--cache', choices=['readwrite', 'write', 'off'], default='off',
+                        help='Response cache: serve and store (readwrite), only store (write) or bypass (off)')
+    parser.add_argument('--cache_path', type=str, default=None,
+                        help='SQLite response cache (default: <dir_save>/response_cache.sqlite)')
+    parser.add_argument('--cache_max_mb', type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help='Evict least recently used responses beyond this size')
+    parser.add_argument('--usage_ledger', type=str, default=None,
+                        help='SQLite token usage ledger (default: <dir_save>/usage_ledger.sqlite)')
+    parser.add_argument('--no_usage_ledger', action='store_true',
+                        help='Do not record token usage')
+    parser.add_argument('--no_gen_profile', action='store_true',
+                        help="Send only temperature, without the dataset's max_tokens and stop sequences")
+    parser.add_argument('--no_dedup', action='store_true',
+                        help='Send every question, even when its prompt matches an earlier one')
+    parser.add_argument('--mcq_logprobs', action='store_true',
+                        help='Score MCQ datasets from the label logprobs of a single generated token')
+    parser.add_argument('--hedge', action='store_true',
+                        help="Send a second copy of requests slower than the model's rolling p95 latency; the first answer wins")
+    parser.add_argument('--hedge_budget', type=float, default=DEFAULT_HEDGE_BUDGET,
+                        help='Most hedges per attempt sent, per model (default 0.1)')
+    parser.add_argument('--attempt_timeout', type=float, default=DEFAULT_ATTEMPT_TIMEOUT,
+                        help='Seconds before an unanswered attempt is abandoned and retried (0 waits for the client)')
+    parser.add_argument('--breaker_threshold', type=int, default=DEFAULT_BREAKER_THRESHOLD,
+                        help="Consecutive timeouts/5xx that open a model's circuit breaker and park its requests (0 disables)")
+    parser.add_argument('--probe_interval', type=float, default=DEFAULT_PROBE_INTERVAL,
+                        help='Seconds between probe requests to a model whose circuit is open')
+    parser.add_argument('--breaker_give_up', type=float, default=DEFAULT_BREAKER_GIVE_UP,
+                        help="Seconds a model's circuit may stay open before its requests go to the dead-letter file")
+    parser.add_argument('--schedule', choices=SCHEDULES, default='fifo',
+                        help='Request order: dataset order, or longest estimated prompt first to shorten the run')
+    parser.add_argument('--schedule_window', type=int, default=DEFAULT_SCHEDULE_WINDOW,
+                        help='Requests reordered together by --schedule longest_first')
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream responses and close each one as soon as the dataset's answer is complete")
+    parser.add_argument('--batch', action='store_true',
+                        help="Submit each job through the provider's batch API instead of live requests")
+    parser.add_argument('--batch_completion_window', type=str, default=DEFAULT_COMPLETION_WINDOW,
+                        help='Completion window requested for batch jobs')
+    parser.add_argument('--batch_poll_interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help='Initial seconds between batch status checks (grows to 60s)')
+    parser.add_argument('--shard_workers', type=int, default=0,
+                        help='Split each job across this many worker processes; run the same command on other '
+                             'machines sharing --dir_save to add theirs (0 runs in this process). --rpm and --tpm '
+                             'are shared by all the workers of a job, on every machine')
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Questions per chunk claimed by a shard worker')
+    parser.add_argument('--lease_seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help="Seconds without a heartbeat before a shard worker's chunk is claimed again")
     
     parser.add_argument(
             '--model', nargs='+',
@@ -471,40 +1557,142 @@ if __name__ == "__main__":
         )
 
     args = parser.parse_args()
+    if len(args.dataset_name) != len(args.dataset_path):
+        parser.error("--dataset_name and --dataset_path need the same number of values")
+    if args.stream and (args.batch or args.no_gen_profile):
+        parser.error("--stream needs the dataset's generation profile and cannot be combined with --batch")
+    if args.mcq_logprobs and (args.no_gen_profile or args.stream or args.backend == "ollama"
+                              or (args.backend is None and not args.together)):
+        parser.error("--mcq_logprobs needs the dataset's generation profile, an OpenAI-compatible or mock backend, "
+                     "and no --stream")
+    if args.hedge and args.batch:
+        parser.error("--hedge cannot be combined with --batch")
+    if args.shard_workers and args.sweep:
+        parser.error("--shard_workers cannot be combined with --sweep: each job's workers have their own "
+                     "--rpm/--tpm budget, so jobs run side by side would exceed it")
+    if args.shard_workers and (args.batch or args.replay_dead_letter):
+        parser.error("--shard_workers cannot be combined with --batch or --replay_dead_letter "
+                     "(a sharded run re-sends its failed questions with --resume)")
+    if args.batch and (args.backend in ("ollama", "mock") or (args.backend is None and not args.together)):
+        parser.error("--batch needs an OpenAI-compatible backend (--together or --backend together/openai/llamacpp)")
     lang = args.language
     pt = PromptType(lang)
-    SYSTEM_MESSAGE = pt.get_sys_msg(args.dataset_name)
-    INPUT_MESSAGE = pt.get_inp_msg(args.dataset_name)
-    
-    process_question = pt.get_process_func(args.dataset_name)
-    dataset_folder = f"{args.dataset_name}-{args.language}"
-    _dir_save = os.path.join(args.dir_save, dataset_folder)
-    print('creating save dir ', _dir_save)
-    os.makedirs(_dir_save, exist_ok = True)
-    
-    for model_name in args.model:
-        model_name_file = model_name
-        if args.together:
-            model_name_file = model_name_file.replace("/", "-")
+    
+    options = InferenceOptions(
+        max_concurrency=args.max_concurrency,
+        adaptive=not args.fixed_concurrency,
+        concurrency_ceiling=args.concurrency_ceiling,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        resume=args.resume,
+        replay_dead_letter=args.replay_dead_letter,
+        record_format=args.record_format,
+        parquet=args.parquet,
+        cache_mode=args.cache,
+        cache_path=args.cache_path or os.path.join(args.dir_save, DEFAULT_CACHE_FILENAME),
+        cache_max_bytes=args.cache_max_mb * 1024 ** 2,
+        stream=args.stream,
+        dedup=not args.no_dedup,
+        mcq_logprobs=args.mcq_logprobs,
+        hedge=args.hedge,
+        hedge_budget=args.hedge_budget,
+        attempt_timeout=args.attempt_timeout or None,
+        breaker_threshold=args.breaker_threshold or None,
+        probe_interval=args.probe_interval,
+        breaker_give_up=args.breaker_give_up,
+        schedule=args.schedule,
+        schedule_window=args.schedule_window,
+        usage_ledger_path=None if args.no_usage_ledger else (args.usage_ledger or os.path.join(args.dir_save, DEFAULT_LEDGER_FILENAME)),
+        language=args.language,
+        backend=args.backend or ("together" if args.together else "ollama"),
+        base_url=args.base_url,
+        ollama_host=args.ollama_host,
+        ollama_keep_alive=args.ollama_keep_alive,
+        mock_options={
+            "latency": args.mock_latency,
+            "error_rate": args.mock_error_rate,
+            "rate_limit_rate": args.mock_rate_limit_rate,
+            "capacity": args.mock_capacity,
+            "tail_rate": args.mock_tail_rate,
+            "tail_latency": args.mock_tail_latency,
+        },
+        global_concurrency=args.global_concurrency
+    )
+    if options.backend == "ollama":
+        # A local server has a fixed number of parallel slots; more in flight only queues
+        options.max_concurrency = args.ollama_parallel
+        options.adaptive = False
+    # One registry for the whole run: per-model budgets shared across datasets, one global cap
+    limiters = options.make_limiters()
+    backend = options.make_backend()
+    
+    async def run_job(model_name, dataset_name, dataset_path):
+        SYSTEM_MESSAGE = pt.get_sys_msg(dataset_name)
+        INPUT_MESSAGE = pt.get_inp_msg(dataset_name)
+        
+        process_question = pt.get_process_func(dataset_name)
+        gen_profile = None if args.no_gen_profile else pt.get_gen_profile(dataset_name)
+        dataset_folder = f"{dataset_name}-{args.language}"
+        _dir_save = os.path.join(args.dir_save, dataset_folder)
+        print('creating save dir ', _dir_save)
+        os.makedirs(_dir_save, exist_ok = True)
+        
+        model_name_file = model_name.replace("/", "-")
             
-        output_csv = f"{args.dataset_name}_{model_name_file}_responses.csv"
+        output_csv = f"{dataset_name}_{model_name_file}_responses.csv"
         path_csv = os.path.join(_dir_save, output_csv)
-        infer(
-            args.dataset_name,
-            model_name,
-            args.dataset_path,
-            path_csv,
-            SYSTEM_MESSAGE,
-            INPUT_MESSAGE,
-            process_question,
-            args.together,
-            _dir_save
-        )
+        if args.shard_workers:
+            job = ShardJob(
+                dataset_name,
+                dataset_path,
+                model_name,
+                args.language,
+                _dir_save,
+                path_csv,
+                options,
+                use_gen_profile=not args.no_gen_profile,
+                chunk_size=args.chunk_size,
+                lease_seconds=args.lease_seconds
+            )
+            # The workers are separate processes; this loop only waits for them
+            await asyncio.to_thread(shard_infer, job, args.shard_workers)
+        elif args.batch:
+            await batch_infer_async(
+                dataset_name,
+                model_name,
+                dataset_path,
+                path_csv,
+                SYSTEM_MESSAGE,
+                INPUT_MESSAGE,
+                process_question,
+                _dir_save,
+                options,
+                args.batch_completion_window,
+                args.batch_poll_interval,
+                gen_profile
+            )
+        else:
+            await infer_async(
+                dataset_name,
+                model_name,
+                dataset_path,
+                path_csv,
+                SYSTEM_MESSAGE,
+                INPUT_MESSAGE,
+                process_question,
+                options.backend != "ollama",
+                _dir_save,
+                options,
+                limiters,
+                backend,
+                gen_profile
+            )
         
         
-        resp = parse_response(path_csv, "Model Response")
-        gt = parse_response(path_csv, "Ground Truth")
-        resp_rer = parse_response_rer(path_csv)
+        # Parsed in a thread: in a sweep the other jobs share this event loop
+        resp = await asyncio.to_thread(parse_response, path_csv, "Model Response")
+        gt = await asyncio.to_thread(parse_response, path_csv, "Ground Truth")
+        resp_rer = await asyncio.to_thread(parse_response_rer, path_csv)
 
         # acc, rer = calculate_scores(resp, resp_rer, gt, args.language, args.dataset_name)
         
@@ -515,9 +1703,41 @@ if __name__ == "__main__":
         # with open(path_score, "w", encoding="utf-8") as file:
         #     file.write(f"Accuracy = {acc * 100:.2f}%\n")
         #     file.write(f"Response Error Rate = {rer * 100:.2f}%\n")
-            
-       
-
-
-
-
+    
+    async def run_jobs(jobs):
+        if args.sweep:
+            sweep_start = time.time()
+            outcomes = await asyncio.gather(*(run_job(*job) for job in jobs), return_exceptions=True)
+            for job, outcome in zip(jobs, outcomes):
+                if isinstance(outcome, Exception):
+                    logger.error(f"Job {job[0]} / {job[1]} failed: {outcome!r}")
+            logger.info(f"Sweep of {len(jobs)} jobs finished in {time.time() - sweep_start:.2f}s")
+        else:
+            for job in jobs:
+                await run_job(*job)
+    
+    async def run_models():
+        """Run every (model, dataset) job in one event loop so pooled connections are reused"""
+        datasets = list(zip(args.dataset_name, args.dataset_path))
+        try:
+            if options.backend != "ollama":
+                await run_jobs([
+                    (model_name, dataset_name, dataset_path)
+                    for model_name in args.model
+                    for dataset_name, dataset_path in datasets
+                ])
+            else:
+                # Model-major: load each local model once, run all datasets on it, then unload it
+                for model_name in args.model:
+                    await backend.prepare(model_name)
+                    try:
+                        await run_jobs([(model_name, dataset_name, dataset_path) for dataset_name, dataset_path in datasets])
+                    finally:
+                        await backend.release(model_name)
+        finally:
+            limiters.log_summary()
+            if isinstance(backend, MockBackend):
+                logger.info(backend.summary())
+            await close_clients()
+    
+    asyncio.run(run_models())
@@ -18,6 +18,8 @@ Requirements:
 
 Environment Variables:
     - OPENAI_API_KEY: Your OpenAI API key
+    - JUDGE_RPM / JUDGE_TPM: Optional request and token per-minute budgets for the judge model
+    - USAGE_LEDGER: Token usage ledger (default: usage_ledger.sqlite next to the judged folder)
 """
 
 import logging
@@ -25,19 +27,23 @@ import backoff
 import requests
 import os
 import sys
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 from pydantic import BaseModel
-from openai import OpenAI
 from dotenv import load_dotenv, find_dotenv
 import pandas as pd
 import concurrent.futures
 import re
+from rate_limiter import get_rate_limiter, estimate_tokens, usage_total_tokens
+from clients import get_client
+from usage_ledger import TaggedLedger, get_usage_ledger, DEFAULT_LEDGER_FILENAME
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 # Constants
 MAX_TRIES = 10
+JUDGE_MODEL = "gpt-4o-mini-2024-07-18"
+JUDGE_MAX_WORKERS = 512
 
 # Load environment variables from .env file
 load_dotenv(find_dotenv())
@@ -71,8 +77,13 @@ def handle_errors(func):
             raise
     return wrapper
 
-# Initialize the OpenAI client
-client = OpenAI()
+# Shared pooled OpenAI client, sized for the judge's worker threads
+client = get_client(max_connections=JUDGE_MAX_WORKERS)
+
+# Shared request/token budget for all judge worker threads
+JUDGE_RPM = int(os.getenv("JUDGE_RPM", "5000"))
+JUDGE_TPM = int(os.getenv("JUDGE_TPM", "2000000"))
+judge_rate_limiter = get_rate_limiter("openai", JUDGE_MODEL, client.api_key, JUDGE_RPM, JUDGE_TPM)
 
 class Evaluation(BaseModel):
     """
@@ -161,7 +172,8 @@ Output only the JSON object.
 """
     return prompt
 
-def evaluate_llm_answer(prompt_from_response: str, correct_answer: str, llm_answer: str) -> Evaluation:
+def evaluate_llm_answer(prompt_from_response: str, correct_answer: str, llm_answer: str,
+                        usage_ledger: Optional[TaggedLedger] = None) -> Evaluation:
     """
     Evaluates an LLM's answer using the judge LLM.
     """
@@ -175,16 +187,26 @@ def evaluate_llm_answer(prompt_from_response: str, correct_answer: str, llm_answ
     )
     @handle_errors
     def _make_api_call():
-        completion = client.beta.chat.completions.parse(
-            model="gpt-4o-mini-2024-07-18",
-            messages=[
-                {"role": "system", "content": "You are an impartial judge tasked with evaluating the accuracy of an AI language model's (LLM) response to a question. Your goal is to determine whether the LLM's answer is correct, even if it does not exactly match the ground truth wording, as long as it conveys the same exact meaning."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0,
-            response_format=Evaluation,
-            seed=42,
-        )
+        messages = [
+            {"role": "system", "content": "You are an impartial judge tasked with evaluating the accuracy of an AI language model's (LLM) response to a question. Your goal is to determine whether the LLM's answer is correct, even if it does not exactly match the ground truth wording, as long as it conveys the same exact meaning."},
+            {"role": "user", "content": prompt}
+        ]
+        estimated_tokens = estimate_tokens(messages)
+        judge_rate_limiter.acquire_sync(estimated_tokens)
+        try:
+            completion = client.beta.chat.completions.parse(
+                model=JUDGE_MODEL,
+                messages=messages,
+                temperature=0.0,
+                response_format=Evaluation,
+                seed=42,
+            )
+        except Exception:
+            judge_rate_limiter.reconcile(estimated_tokens, 0)
+            raise
+        judge_rate_limiter.reconcile(estimated_tokens, usage_total_tokens(completion.usage))
+        if usage_ledger is not None:
+            usage_ledger.record(JUDGE_MODEL, completion.usage)
         return completion
 
     try:
@@ -196,7 +218,7 @@ def evaluate_llm_answer(prompt_from_response: str, correct_answer: str, llm_answ
         logger.error(f"Evaluation failed: {e}")
         raise
 
-def process_row(idx, row, csv_file):
+def process_row(idx, row, csv_file, usage_ledger=None):
     """
     Process a single row: parse the prompt and evaluate the LLM's answer.
     Returns a tuple: (verdict, reasoning, error, judge_prompt)
@@ -213,7 +235,7 @@ def process_row(idx, row, csv_file):
     try:
         # Generate the judge prompt that will be sent to the LLM judge.
         judge_prompt = get_eval_prompt(prompt_from_response, correct_answer, llm_answer)
-        evaluation = evaluate_llm_answer(prompt_from_response, correct_answer, llm_answer)
+        evaluation = evaluate_llm_answer(prompt_from_response, correct_answer, llm_answer, usage_ledger)
         logger.info(f"Row {idx} in file {csv_file}: Successfully evaluated question.")
         return evaluation.verdict, evaluation.reasoning, "", judge_prompt
     except Exception as e:
@@ -254,6 +276,12 @@ def main():
         logger.warning("No CSV files with '_responses.csv' found in the folder.")
         sys.exit(0)
     
+    # Inference writes <dir_save>/<dataset>-<language>/, with the ledger in <dir_save>
+    ledger_path = os.getenv("USAGE_LEDGER") or os.path.join(os.path.dirname(os.path.abspath(folder_path)), DEFAULT_LEDGER_FILENAME)
+    folder_name = os.path.basename(os.path.normpath(folder_path))
+    dataset_name, _, language = folder_name.rpartition("-")
+    usage_ledger = get_usage_ledger(ledger_path).tagged("judge", dataset_name or folder_name, language or None)
+    
     for csv_file in csv_files:
         csv_path = os.path.join(folder_path, csv_file)
         
@@ -280,10 +308,10 @@ def main():
             logger.info(f"Judge output files for {csv_file} already exist. Skipping processing.")
             continue
 
-        max_workers = 512
+        max_workers = JUDGE_MAX_WORKERS
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
             future_to_idx = {
-                executor.submit(process_row, idx, row, csv_file): idx
+                executor.submit(process_row, idx, row, csv_file, usage_ledger): idx
                 for idx, row in df.iterrows()
             }
             for future in concurrent.futures.as_completed(future_to_idx):
@@ -300,6 +328,7 @@ def main():
                     judge_reasonings[idx] = ""
                     judge_errors[idx] = str(e)
                     judge_prompts[idx] = ""
+        usage_ledger.flush()
         
         # Append new columns to the DataFrame
         df["Judge Verdict"] = judge_verdicts
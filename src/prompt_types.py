@@ -1,6 +1,102 @@
 import csv
 import re
 import ast
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+# Models that think in a <think> block before answering, whatever the prompt asks
+REASONING_MODEL_PATTERN = re.compile(r"deepseek-r1|qwq", re.IGNORECASE)
+
+def is_reasoning_model(model_name):
+    return bool(REASONING_MODEL_PATTERN.search(model_name or ""))
+
+class AnswerExtractor():
+    """
+    Finds where the final answer ends in a partial response, for closing a stream early.
+    
+    Called with the text streamed so far; returns the offset just past the answer,
+    or None while no complete answer has arrived. Everything up to the last </think>
+    is reasoning, whether or not an opening <think> tag was sent (the R1 distills
+    often leave it out), so labels or tags mentioned while thinking do not count.
+    """
+    def __init__(self, name, pattern, anchored=False, thinks=False):
+        self.name = name
+        self.pattern = re.compile(pattern, re.DOTALL)
+        self.anchored = anchored  # the answer must be the first thing after any <think> block
+        self.thinks = thinks  # the model always reasons first, so nothing counts before a </think>
+    
+    def for_model(self, model_name):
+        """This extractor for one model; a reasoning model's answer only counts after its </think>"""
+        if not is_reasoning_model(model_name):
+            return self
+        return AnswerExtractor(self.name, self.pattern.pattern, self.anchored, thinks=True)
+    
+    def __call__(self, text):
+        close = text.rfind("</think>")
+        if close != -1:
+            start = close + len("</think>")
+        elif self.thinks or text.lstrip().startswith("<think>"):
+            return None
+        else:
+            start = 0
+        if self.anchored:
+            match = self.pattern.match(text, start)
+        else:
+            match = self.pattern.search(text, start)
+        return match.end() if match else None
+
+# A label is only final once something other than more letters follows it ("A." / "A)" / "ক\n"),
+# otherwise "A" could still become "Answer: C"
+LABEL_EXTRACTOR = AnswerExtractor(
+    "label", r"\s*(?:[A-N]|[ক-ঢ]|true|false|সত্য|মিথ্যা)(?=[.,:;)\]\n])", anchored=True
+)
+# Datasets answered with a single option label, which can be scored from the first token's logprobs
+MCQ_DATASETS = ('openbookqa', 'arc-easy', 'arc-challenge', 'commonsenseqa', 'mmlu', 'hellaswag', 'piqa', 'winogrande')
+MCQ_TOP_LOGPROBS = 20  # the most providers return
+# Option lines of a rendered prompt, "A: ...", "B. ...", "ক: ..."
+OPTION_LINE_PATTERN = re.compile(r"^(\S{1,2})[.:] ", re.MULTILINE)
+OPTIONS_HEADERS = ("Options:\n", "বিকল্পসমূহ:\n")
+
+def option_labels(prompt):
+    """Labels of the options listed in a rendered MCQ prompt, in order"""
+    for header in OPTIONS_HEADERS:
+        start = prompt.rfind(header)
+        if start != -1:
+            return OPTION_LINE_PATTERN.findall(prompt, start + len(header))
+    return []
+
+LABEL_LIST_EXTRACTOR = AnswerExtractor("label_list", r"\s*\[[^\]]*\]", anchored=True)
+TAGGED_ANSWER_EXTRACTOR = AnswerExtractor("tagged_answer", r"<answer>.*?</answer>|<উত্তর>.*?</উত্তর>")
+
+@dataclass
+class GenerationProfile:
+    """How long a dataset's answers may be and where they end"""
+    max_tokens: Optional[int] = 32  # labels, even in Bengali, fit with room to spare
+    stop: List[str] = field(default_factory=list)
+    allow_reasoning: bool = True  # give reasoning models reasoning_budget more tokens for their <think> block
+    reasoning_budget: int = 4096
+    extractor: Optional[AnswerExtractor] = LABEL_EXTRACTOR  # ends a streamed response once its answer is complete
+    mcq: bool = False  # a single option label, so it can be scored from label logprobs instead
+
+    def params(self, model_name) -> Dict[str, Any]:
+        """Generation parameters for one model"""
+        max_tokens = self.max_tokens
+        stop = self.stop
+        if self.allow_reasoning and is_reasoning_model(model_name):
+            if max_tokens is not None:
+                max_tokens += self.reasoning_budget
+            # The answer tags are often quoted while thinking, which would end the response there
+            stop = []
+        params = {}
+        if max_tokens is not None:
+            params["max_tokens"] = max_tokens
+        if stop:
+            params["stop"] = list(stop)
+        return params
+    
+    def logprob_params(self) -> Dict[str, Any]:
+        """One token with its most likely alternatives, for scoring an MCQ by label probability"""
+        return {"max_tokens": 1, "logprobs": True, "top_logprobs": MCQ_TOP_LOGPROBS}
 
 class PromptType():
     def __init__(self,language = "en"):
@@ -177,6 +273,17 @@ class PromptType():
             #     'truthfulqa-ml': self.acc_func_truthfulqa_ml,
             #     'commonsenseqa': self.acc_func_commonsenseqa,
             # }
+        
+        # label-only answers by default, overwrite for datasets with longer answers
+        self.gen_profile = {key: GenerationProfile() for key in self.process_funcs.keys()}
+        for key in MCQ_DATASETS:
+            self.gen_profile[key] = GenerationProfile(mcq=True)
+        self.gen_profile['truthfulqa-ml'] = GenerationProfile(max_tokens=96, extractor=LABEL_LIST_EXTRACTOR)
+        self.gen_profile['boolq'] = GenerationProfile(max_tokens=16)
+        # steps in <reason>, then the number in <answer>; stop once it is closed
+        self.gen_profile['gsm8k-main'] = GenerationProfile(
+            max_tokens=1024, stop=["</answer>", "</উত্তর>"], reasoning_budget=8192, extractor=TAGGED_ANSWER_EXTRACTOR
+        )
 
 
     ###############################
@@ -731,6 +838,9 @@ class PromptType():
     
     def get_inp_msg(self, dataset_name):
         return self.inp_msg[dataset_name]
+    
+    def get_gen_profile(self, dataset_name):
+        return self.gen_profile[dataset_name]
     # def get_acc_func(self, dataset_name):
     #     return self.acc_func[dataset_name]
     # def get_rer_func(self, dataset_name):
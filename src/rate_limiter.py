@@ -0,0 +1,220 @@
+"""
+Shared request/token rate limiting for every script that calls an LLM API.
+
+Providers enforce two budgets per minute: requests (RPM) and tokens (TPM). A
+RateLimiter holds one token bucket for each and is shared by everything that
+talks to the same provider/model/API key, whether it runs in an asyncio event
+loop (infer.py) or in worker threads (llm_eval_judge.py, the translation
+scripts). Prompt tokens are estimated before sending and the estimate is
+reconciled with `response.usage` afterwards, so the token bucket tracks what the
+provider actually billed. Processes that split one budget between them (sharded
+runs) each call set_rate_share with their fraction of it.
+
+Usage:
+    limiter = get_rate_limiter("openai", "gpt-4o-mini-2024-07-18", api_key, rpm=5000, tpm=2_000_000)
+
+    # async
+    estimate = estimate_tokens(messages, max_tokens=16)
+    await limiter.acquire(estimate)
+    response = await client.chat.completions.create(...)
+    limiter.reconcile(estimate, usage_total_tokens(response.usage))
+
+    # threads / plain functions: drop-in for @sleep_and_retry + @limits(...)
+    @rate_limited(limiter, estimate=lambda entry, idx, output_dir: estimate_tokens(build_messages(entry)))
+    def translate_single_entry(entry, idx, output_dir): ...
+"""
+
+import asyncio
+import functools
+import hashlib
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+ONE_MINUTE = 60
+MESSAGE_OVERHEAD_TOKENS = 4  # role/separator tokens added per chat message
+DEFAULT_COMPLETION_TOKENS = 256  # reserved when the caller does not cap max_tokens
+
+
+class TokenBucket:
+    """Continuously refilling bucket of `capacity` units per minute"""
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / ONE_MINUTE
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available (requests larger than the bucket wait for a full one)"""
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def resize(self, capacity: float) -> None:
+        self.refill(time.monotonic())
+        self.capacity = float(capacity)
+        self.rate = self.capacity / ONE_MINUTE
+        self.tokens = min(self.tokens, self.capacity)
+
+    def consume(self, amount: float) -> None:
+        # May go negative when usage turns out higher than estimated; the debt is paid by refill
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budget for one provider/model/key"""
+
+    def __init__(self, name: str, rpm: Optional[int] = None, tpm: Optional[int] = None, share: float = 1.0):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm * share) if rpm else None
+        self.token_bucket = TokenBucket(tpm * share) if tpm else None
+        # Guards both buckets; shared by event-loop callers and worker threads
+        self._lock = threading.Lock()
+        self.total_wait = 0.0
+
+    def _reserve(self, tokens: int) -> float:
+        """Take one request and `tokens` tokens if both are available, else return the wait time"""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.requests:
+                self.requests.refill(now)
+                wait = max(wait, self.requests.wait_time(1))
+            if self.token_bucket:
+                self.token_bucket.refill(now)
+                wait = max(wait, self.token_bucket.wait_time(tokens))
+            if wait == 0.0:
+                if self.requests:
+                    self.requests.consume(1)
+                if self.token_bucket:
+                    self.token_bucket.consume(tokens)
+            return wait
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Wait in the event loop until the request fits both budgets"""
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0.0:
+                return
+            self.total_wait += wait
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens: int = 0) -> None:
+        """Blocking variant of acquire() for threaded callers"""
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0.0:
+                return
+            self.total_wait += wait
+            time.sleep(wait)
+
+    def reconcile(self, estimated: int, actual: Optional[int]) -> None:
+        """Correct the token bucket once the provider reports real usage (None or 0 refunds the estimate)"""
+        if not self.token_bucket:
+            return
+        with self._lock:
+            self.token_bucket.consume((actual or 0) - estimated)
+
+    def set_share(self, share: float) -> None:
+        """Use `share` of the rpm and tpm budgets from now on"""
+        with self._lock:
+            if self.requests:
+                self.requests.resize(self.rpm * share)
+            if self.token_bucket:
+                self.token_bucket.resize(self.tpm * share)
+
+
+_limiters: Dict[Tuple[str, str, str], RateLimiter] = {}
+_registry_lock = threading.Lock()
+_share = 1.0  # fraction of every budget this process may use
+
+
+def set_rate_share(share: float) -> None:
+    """Let this process use `share` of every limiter's budget, e.g. 1/N when N processes split it"""
+    global _share
+    with _registry_lock:
+        if share == _share:
+            return
+        _share = share
+        for limiter in _limiters.values():
+            limiter.set_share(share)
+
+
+def get_rate_limiter(
+    provider: str,
+    model: str,
+    api_key: Optional[str] = None,
+    rpm: Optional[int] = None,
+    tpm: Optional[int] = None,
+) -> RateLimiter:
+    """Return the process-wide limiter for (provider, model, key), creating it on first use"""
+    key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12] if api_key else ""
+    key = (provider, model, key_id)
+    with _registry_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(f"{provider}/{model}", rpm, tpm, _share)
+            logger.info(f"Rate limiter for {provider}/{model}: rpm={rpm}, tpm={tpm}"
+                        + (f", this process's share {_share:.2g}" if _share != 1.0 else ""))
+        return _limiters[key]
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Cheap upper-leaning token estimate without loading a tokenizer.
+
+    English BPE averages about 4 characters per token, while Bangla characters
+    (3 UTF-8 bytes each) usually cost about one token apiece.
+    """
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def estimate_tokens(
+    messages: Union[str, List[Dict[str, Any]]],
+    max_tokens: Optional[int] = None,
+) -> int:
+    """Estimate prompt tokens plus the completion budget that providers count against TPM"""
+    if isinstance(messages, str):
+        prompt_tokens = estimate_text_tokens(messages)
+    else:
+        prompt_tokens = sum(
+            estimate_text_tokens(str(message.get("content") or "")) + MESSAGE_OVERHEAD_TOKENS
+            for message in messages
+        )
+    completion_tokens = max_tokens if max_tokens is not None else DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + completion_tokens
+
+
+def usage_total_tokens(usage: Any) -> Optional[int]:
+    """Read total_tokens from an SDK usage object or a raw response dict"""
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get("total_tokens")
+    return getattr(usage, "total_tokens", None)
+
+
+def rate_limited(limiter: RateLimiter, estimate: Optional[Callable[..., int]] = None):
+    """Decorator for synchronous API calls; reconciles when the call returns a response with usage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tokens = estimate(*args, **kwargs) if estimate else 0
+            limiter.acquire_sync(tokens)
+            result = func(*args, **kwargs)
+            usage = result.get("usage") if isinstance(result, dict) else getattr(result, "usage", None)
+            if usage is not None:
+                limiter.reconcile(tokens, usage_total_tokens(usage))
+            return result
+        return wrapper
+    return decorator
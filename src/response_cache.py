@@ -0,0 +1,283 @@
+"""
+On-disk cache of chat completion responses.
+
+Benchmarks are run at temperature 0, so re-running a dataset after a parsing fix,
+a new metric or a crash asks the provider for completions we already paid for.
+ResponseCache stores every successful response in SQLite under a content hash of
+(model, messages, sampling params) and can serve it back instead of calling the API.
+
+Modes:
+    readwrite  serve hits from the cache and store new responses (read-through)
+    write      always call the API but store the responses, e.g. to warm a cache
+    off        bypass the cache entirely
+
+The database is bounded by size with least-recently-used eviction. Hits only
+note their last-use time in memory; the times are written in one transaction
+every TOUCH_BATCH hits or TOUCH_INTERVAL seconds, and before eviction.
+
+The file uses WAL unless it is opened with journal_mode="DELETE", which sharded
+runs do: WAL needs shared memory that network filesystems do not provide. Other
+processes then write to the same file, so the size is re-read every
+SIZE_RESYNC_WRITES writes before deciding whether to evict. Entries
+can be exported to / imported from JSONL to warm the cache on another machine:
+
+    python response_cache.py export results/response_cache.sqlite cache.jsonl
+    python response_cache.py import results/response_cache.sqlite cache.jsonl
+    python response_cache.py stats results/response_cache.sqlite
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = ("readwrite", "write", "off")
+DEFAULT_CACHE_FILENAME = "response_cache.sqlite"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GiB
+EVICTION_TARGET = 0.9  # evict down to 90% of max_bytes so eviction does not run on every insert
+TOUCH_BATCH = 256  # hits whose last_used is written together
+TOUCH_INTERVAL = 5.0  # seconds a hit's last_used may wait before it is written
+SIZE_RESYNC_WRITES = 256  # writes between re-reading the size of a cache other processes write to
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+def make_cache_key(model: str, messages: List[Dict[str, Any]], params: Optional[Dict[str, Any]] = None) -> str:
+    """Content hash of everything that determines a completion"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed response cache, safe to share between the event loop and worker threads"""
+
+    def __init__(self, path: str, mode: str = "readwrite", max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+                 journal_mode: str = "WAL"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, expected one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.shared = journal_mode.upper() != "WAL"  # written by other processes, maybe on other machines
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # key -> last hit, not written yet
+        self._touched: Dict[str, float] = {}
+        self._touched_since = time.time()
+        self._conn = sqlite3.connect(path, timeout=60 if self.shared else 5, check_same_thread=False)
+        # WAL keeps readers and the writer from blocking each other and makes commits cheap
+        self._conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._resync_size()
+
+    def _resync_size(self) -> None:
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @property
+    def readable(self) -> bool:
+        return self.mode == "readwrite"
+
+    @property
+    def writable(self) -> bool:
+        return self.mode in ("readwrite", "write")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached response for key, or None on a miss (always None unless reading is enabled)"""
+        if not self.readable:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if not self._touched:
+                self._touched_since = time.time()
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH or time.time() - self._touched_since >= TOUCH_INTERVAL:
+                self._flush_touches()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def _flush_touches(self) -> None:
+        """Write the pending last_used times; caller holds the lock"""
+        if not self._touched:
+            return
+        self._conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                               [(used, key) for key, used in self._touched.items()])
+        self._conn.commit()
+        self._touched.clear()
+
+    def put(self, key: str, model: str, response: Dict[str, Any]) -> None:
+        """Store a response (a no-op unless writing is enabled)"""
+        if not self.writable:
+            return
+        data = json.dumps(response, ensure_ascii=False)
+        with self._lock:
+            self._insert(key, model, data, time.time(), replace=True)
+            self._conn.commit()
+            self.writes += 1
+            if self.shared and self.writes % SIZE_RESYNC_WRITES == 0:
+                # Our running total misses what the other processes added or evicted
+                self._resync_size()
+            self._evict()
+
+    def _insert(self, key: str, model: str, data: str, created: float, replace: bool) -> bool:
+        size = len(data.encode("utf-8"))
+        row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            if not replace:
+                return False
+            self._total_bytes -= row[0]
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, data, size, created, time.time()),
+        )
+        self._total_bytes += size
+        return True
+
+    def _evict(self) -> None:
+        """Drop least recently used entries once the cache outgrows max_bytes; caller holds the lock"""
+        if not self.max_bytes or self._total_bytes <= self.max_bytes:
+            return
+        # Recent hits must count before choosing what to evict
+        self._flush_touches()
+        target = self.max_bytes * EVICTION_TARGET
+        evicted = 0
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        for key, size in rows:
+            if self._total_bytes <= target:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._total_bytes -= size
+            evicted += 1
+        self._conn.commit()
+        logger.info(f"Evicted {evicted} cached responses from {self.path} ({self._total_bytes / 1024 ** 2:.1f} MiB left)")
+
+    def export_jsonl(self, output_file: str) -> int:
+        """Write every entry to a JSONL file; returns the number of entries"""
+        count = 0
+        with self._lock, open(output_file, "w", encoding="utf-8") as f:
+            for key, model, data, created in self._conn.execute(
+                "SELECT key, model, response, created FROM responses ORDER BY created"
+            ):
+                f.write(json.dumps({"key": key, "model": model, "response": json.loads(data), "created": created}, ensure_ascii=False) + "\n")
+                count += 1
+        return count
+
+    def import_jsonl(self, input_file: str) -> int:
+        """Add the entries of an exported JSONL file, keeping local entries on conflict; returns the number added"""
+        added = 0
+        with self._lock, open(input_file, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                data = json.dumps(entry["response"], ensure_ascii=False)
+                if self._insert(entry["key"], entry["model"], data, entry.get("created", time.time()), replace=False):
+                    added += 1
+            self._conn.commit()
+            self._evict()
+        return added
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            "path": self.path,
+            "mode": self.mode,
+            "entries": entries,
+            "bytes": self._total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+        }
+
+    def summary(self) -> str:
+        return (
+            f"Response cache {self.path} ({self.mode}): {self.hits} hits, {self.misses} misses, "
+            f"{self.writes} writes, {self._total_bytes / 1024 ** 2:.1f} MiB"
+        )
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_touches()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touches()
+            self._conn.close()
+
+
+_caches: Dict[str, ResponseCache] = {}
+_registry_lock = threading.Lock()
+
+
+def get_response_cache(path: str, mode: str = "readwrite", max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+                       journal_mode: str = "WAL") -> Optional[ResponseCache]:
+    """Return the process-wide cache for path (None when mode is "off"), opening it on first use"""
+    if mode == "off":
+        return None
+    key = os.path.abspath(path)
+    with _registry_lock:
+        if key not in _caches:
+            _caches[key] = ResponseCache(path, mode, max_bytes, journal_mode)
+            logger.info(f"Opened response cache {path} (mode={mode})")
+        return _caches[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect, export or import a response cache.")
+    parser.add_argument("command", choices=["stats", "export", "import"])
+    parser.add_argument("cache_path", type=str, help="Path to the SQLite cache file")
+    parser.add_argument("jsonl_path", type=str, nargs="?", help="JSONL file to export to or import from")
+    parser.add_argument("--max_mb", type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help="Size limit applied after importing")
+    args = parser.parse_args()
+
+    if args.command != "stats" and not args.jsonl_path:
+        parser.error(f"{args.command} needs a JSONL path")
+
+    cache = ResponseCache(args.cache_path, "readwrite", args.max_mb * 1024 ** 2)
+    if args.command == "export":
+        count = cache.export_jsonl(args.jsonl_path)
+        print(f"Exported {count} responses to {args.jsonl_path}")
+    elif args.command == "import":
+        count = cache.import_jsonl(args.jsonl_path)
+        print(f"Imported {count} new responses from {args.jsonl_path}")
+    else:
+        print(json.dumps(cache.stats(), indent=2))
+    cache.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,278 @@
+"""
+Buffered JSONL writer for inference results.
+
+Workers hand finished requests to a ResultWriter instead of appending to the
+results file themselves. A single writer task collects them and flushes in
+batches, either every `flush_records` records or `flush_interval` seconds after
+the first unflushed one, whichever comes first. Record building, JSON encoding
+and file I/O run in a worker thread so the event loop keeps serving requests.
+The file stays open for the whole run and is fsynced at checkpoints: every
+`fsync_interval` seconds and on close.
+
+orjson is used for encoding when it is installed, stdlib json otherwise.
+
+OrderedTableWriter produces the per-model CSV (and optionally Parquet) in
+dataset order while results still arrive out of order, via a ReorderBuffer
+keyed by request index.
+"""
+
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import orjson
+except ImportError:  # optional, only makes encoding faster
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for Parquet output
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_RECORDS = 256
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds
+DEFAULT_FSYNC_INTERVAL = 30.0  # seconds
+DEFAULT_WRITER_QUEUE_SIZE = 1024
+
+_CLOSE = object()
+
+
+def encode_line(record: Dict[str, Any]) -> bytes:
+    """One JSONL line, with orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(record) + "\n").encode("utf-8")
+
+
+class ResultWriter:
+    """Single writer task that batches records into an append-only JSONL file"""
+
+    def __init__(
+        self,
+        path: str,
+        to_record: Optional[Callable[[Any], Dict[str, Any]]] = None,
+        flush_records: int = DEFAULT_FLUSH_RECORDS,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+        queue_size: int = DEFAULT_WRITER_QUEUE_SIZE,
+    ):
+        self.path = path
+        # Turns a queued item into a dict; runs in the flush thread
+        self.to_record = to_record or (lambda item: item)
+        self.flush_records = max(1, flush_records)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._task: Optional[asyncio.Task] = None
+        # Opened on the first flush, so a writer that never gets a record leaves no file behind
+        self._file = None
+        self._last_fsync = time.monotonic()
+        self._started = time.monotonic()
+        self.records = 0
+        self.bytes = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self.busy_time = 0.0  # seconds spent encoding and writing
+
+    def start(self) -> "ResultWriter":
+        if self._task is None:
+            self._started = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def write(self, item: Any) -> None:
+        """Queue an item; waits only when the writer has fallen queue_size items behind"""
+        await self._queue.put(item)
+
+    async def close(self) -> None:
+        """Flush everything queued so far, fsync and close the file"""
+        if self._task is None:
+            return
+        await self._queue.put(_CLOSE)
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        buffer: List[Any] = []
+        deadline = 0.0
+        closing = False
+        while not closing:
+            timeout = max(deadline - loop.time(), 0.0) if buffer else None
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+            if item is _CLOSE:
+                closing = True
+            elif item is not None:
+                if not buffer:
+                    deadline = loop.time() + self.flush_interval
+                buffer.append(item)
+                # Take whatever else is already waiting without another round trip through the loop
+                while len(buffer) < self.flush_records and not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if item is _CLOSE:
+                        closing = True
+                        break
+                    buffer.append(item)
+                if len(buffer) < self.flush_records and loop.time() < deadline and not closing:
+                    continue
+            if buffer or closing:
+                batch, buffer = buffer, []
+                await asyncio.to_thread(self._flush, batch, closing)
+
+    def _flush(self, batch: List[Any], final: bool = False) -> None:
+        start = time.monotonic()
+        if batch:
+            data = b"".join(encode_line(self.to_record(item)) for item in batch)
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.write(data)
+            self._file.flush()
+            self.records += len(batch)
+            self.bytes += len(data)
+            self.flushes += 1
+        if self._file is not None and (final or start - self._last_fsync >= self.fsync_interval):
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+            self.fsyncs += 1
+        if final and self._file is not None:
+            self._file.close()
+            self._file = None
+        self.busy_time += time.monotonic() - start
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self._started
+        busy_rate = self.records / self.busy_time if self.busy_time > 0 else 0.0
+        overall_rate = self.records / elapsed if elapsed > 0 else 0.0
+        return (
+            f"Wrote {self.records} records ({self.bytes / 1024 ** 2:.1f} MiB) to {os.path.basename(self.path)} "
+            f"in {self.flushes} flushes, {self.fsyncs} fsyncs; "
+            f"{busy_rate:.0f} records/s while writing, {overall_rate:.1f} records/s overall"
+        )
+
+
+class ReorderBuffer:
+    """Releases items in index order as soon as every lower index has arrived"""
+
+    def __init__(self, first_index: int = 1):
+        self.next_index = first_index
+        self._pending: Dict[int, Any] = {}
+        self.peak = 0  # most items held at once
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def push(self, index: int, item: Any) -> List[Any]:
+        """Add an item and return the run of items that is now complete, in order"""
+        if index < self.next_index or index in self._pending:
+            logger.warning(f"Ignoring duplicate item for index {index}")
+            return []
+        self._pending[index] = item
+        self.peak = max(self.peak, len(self._pending))
+        ready = []
+        while self.next_index in self._pending:
+            ready.append(self._pending.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+    def drain(self) -> List[Any]:
+        """Everything still held, in index order, skipping over missing indices"""
+        ready = [self._pending[index] for index in sorted(self._pending)]
+        self._pending.clear()
+        return ready
+
+
+class OrderedTableWriter:
+    """
+    Streams rows to a CSV file, and optionally a Parquet file, in index order.
+
+    Rows may be added in any order. A ReorderBuffer holds them until every lower
+    index has arrived, so each file is written once from front to back.
+    """
+
+    def __init__(
+        self,
+        csv_path: str,
+        columns: List[str],
+        parquet_path: Optional[str] = None,
+        first_index: int = 1,
+        parquet_batch_rows: int = 1024,
+    ):
+        if parquet_path and pq is None:
+            raise ImportError("Writing Parquet output requires pyarrow (pip install pyarrow)")
+        self.csv_path = csv_path
+        self.columns = columns
+        self.parquet_path = parquet_path
+        self.parquet_batch_rows = parquet_batch_rows
+        self.rows = 0
+        self._buffer = ReorderBuffer(first_index)
+        self._csv_file = None
+        self._csv_writer = None
+        self._parquet_writer = None
+        self._parquet_rows: List[List[Any]] = []
+        self._schema = pa.schema([(column, pa.string()) for column in columns]) if parquet_path else None
+
+    def open(self) -> "OrderedTableWriter":
+        self._csv_file = open(self.csv_path, "w", encoding="utf-8", newline="")
+        # "\n" like the pandas to_csv pass this writer replaced, so outputs diff cleanly against older runs
+        self._csv_writer = csv.writer(self._csv_file, lineterminator="\n")
+        self._csv_writer.writerow(self.columns)
+        if self.parquet_path:
+            self._parquet_writer = pq.ParquetWriter(self.parquet_path, self._schema)
+        return self
+
+    def add(self, index: int, row: List[Any]) -> None:
+        self._write(self._buffer.push(index, row))
+
+    def close(self) -> None:
+        """Write whatever is still held back (rows after a missing index) and close the files"""
+        if self._csv_file is None:
+            return
+        if len(self._buffer):
+            logger.info(f"{len(self._buffer)} rows of {os.path.basename(self.csv_path)} were waiting on missing indices")
+        self._write(self._buffer.drain())
+        self._flush_parquet()
+        self._csv_file.close()
+        self._csv_file = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        logger.info(f"Wrote {self.rows} rows to {self.csv_path} (reorder buffer peak {self._buffer.peak})")
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _write(self, rows: List[List[Any]]) -> None:
+        if not rows:
+            return
+        self._csv_writer.writerows(rows)
+        self.rows += len(rows)
+        if self._parquet_writer is not None:
+            self._parquet_rows.extend(rows)
+            if len(self._parquet_rows) >= self.parquet_batch_rows:
+                self._flush_parquet()
+
+    def _flush_parquet(self) -> None:
+        if self._parquet_writer is None or not self._parquet_rows:
+            return
+        columns = list(zip(*self._parquet_rows))
+        table = pa.table(
+            {name: [None if value is None else str(value) for value in values] for name, values in zip(self.columns, columns)},
+            schema=self._schema,
+        )
+        self._parquet_writer.write_table(table)
+        self._parquet_rows = []
@@ -0,0 +1,132 @@
+"""
+Length-aware ordering of inference requests.
+
+Prompt lengths within a dataset vary by more than 10x: BoolQ passages and
+HellaSwag contexts are long, ARC questions short, and Bangla prompts cost more
+tokens per row than English ones. Sent in dataset order, a few long requests
+that happen to come last keep the run going after the other workers are idle.
+Sending the longest requests first (LPT list scheduling) lets the short ones
+fill in the gaps at the end.
+
+The order is only changed within windows of `window` requests. Requests are
+still rendered lazily, and results still come back close enough to dataset
+order for the ordered CSV writer to hold at most about one window of rows.
+Each request keeps its dataset index, so the outputs are the same as in FIFO
+order.
+
+The makespan gain can be estimated offline from a recorded run. The latency of
+each request in a results JSONL is replayed on a fixed number of workers, in
+dataset order and in scheduled order:
+
+    python src/scheduling.py results/mmlu-en/mmlu_<model>_results.jsonl --workers 10
+"""
+
+import argparse
+import heapq
+import json
+import logging
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple, TypeVar
+
+from rate_limiter import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+SCHEDULES = ("fifo", "longest_first")
+DEFAULT_SCHEDULE_WINDOW = 1024  # requests reordered together
+
+
+def request_cost(request: Dict[str, Any]) -> int:
+    """Estimated tokens of a request dict: prompt plus completion budget"""
+    return estimate_tokens(request.get("messages") or [], (request.get("params") or {}).get("max_tokens"))
+
+
+def longest_first(items: Iterable[T], cost: Callable[[T], float], window: int) -> Iterator[T]:
+    """Yield items in descending cost within consecutive windows of `window` items; ties keep their order"""
+    chunk = []
+    for item in items:
+        chunk.append((cost(item), item))
+        if len(chunk) >= window:
+            yield from (item for _, item in sorted(chunk, key=lambda entry: entry[0], reverse=True))
+            chunk = []
+    yield from (item for _, item in sorted(chunk, key=lambda entry: entry[0], reverse=True))
+
+
+def schedule_requests(
+    indexed_requests: Iterable[Tuple[int, Dict[str, Any]]],
+    schedule: str = "fifo",
+    window: int = DEFAULT_SCHEDULE_WINDOW,
+) -> Iterable[Tuple[int, Dict[str, Any]]]:
+    """Reorder (index, request dict) pairs as `schedule` says"""
+    if schedule == "fifo":
+        return indexed_requests
+    if schedule == "longest_first":
+        return longest_first(indexed_requests, lambda pair: request_cost(pair[1]), window)
+    raise ValueError(f"Unknown schedule {schedule!r}; expected one of {SCHEDULES}")
+
+
+def simulate_makespan(durations: Sequence[float], workers: int) -> float:
+    """Wall time for `workers` to run `durations` in order, each taking the next as soon as it is free"""
+    free_at = [0.0] * max(1, workers)
+    for duration in durations:
+        start = heapq.heappop(free_at)
+        heapq.heappush(free_at, start + duration)
+    return max(free_at)
+
+
+def load_trace(results_file: str) -> List[Tuple[int, int, float]]:
+    """
+    (index, prompt tokens, latency) of every request sent and answered in a results JSONL
+
+    Full records carry no index and are taken in file order.
+    """
+    trace = []
+    with open(results_file, encoding="utf-8") as f:
+        for position, line in enumerate(f, 1):
+            record = json.loads(line)
+            if record.get("error") or record.get("cached") or record.get("duplicate_of") is not None:
+                continue
+            usage = record.get("usage") or (record.get("response") or {}).get("usage") or {}
+            latency = record.get("latency", record.get("duration"))
+            trace.append((record.get("index", position), usage.get("prompt_tokens") or 0, latency))
+    trace.sort()
+    return trace
+
+
+def compare_schedules(trace: List[Tuple[int, int, float]], workers: int, window: int) -> Dict[str, float]:
+    """Simulated makespan of a trace in dataset order and longest first, with the ideal as reference"""
+    latencies = [latency for _, _, latency in trace]
+    scheduled = [latency for _, _, latency in longest_first(trace, lambda entry: entry[1], window)]
+    return {
+        "requests": len(trace),
+        "workers": workers,
+        "window": window,
+        "fifo": round(simulate_makespan(latencies, workers), 2),
+        "longest_first": round(simulate_makespan(scheduled, workers), 2),
+        # No schedule beats perfect balance or the single slowest request
+        "lower_bound": round(max(sum(latencies) / max(1, workers), max(latencies, default=0.0)), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded run's latencies to compare request schedules.")
+    parser.add_argument("results", nargs="+", help="Results JSONL files written by infer.py")
+    parser.add_argument("--workers", type=int, default=10, help="Requests in flight at once")
+    parser.add_argument("--window", type=int, default=DEFAULT_SCHEDULE_WINDOW, help="Requests reordered together")
+    args = parser.parse_args()
+
+    for results_file in args.results:
+        report = compare_schedules(load_trace(results_file), args.workers, args.window)
+        gain = 1 - report["longest_first"] / report["fifo"] if report["fifo"] else 0.0
+        logger.info(
+            f"{results_file}: {report['requests']} requests on {report['workers']} workers; makespan "
+            f"FIFO {report['fifo']:.1f}s, longest first {report['longest_first']:.1f}s ({gain:.1%} shorter), "
+            f"lower bound {report['lower_bound']:.1f}s"
+        )
+        print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    main()
@@ -0,0 +1,617 @@
+"""
+Sharded inference over several processes or machines.
+
+A single process tops out at what one event loop and one connection pool can
+push. For the big sweeps the dataset is split into chunks of `chunk_size`
+questions that worker processes claim from a work ledger, an SQLite file in
+<dataset>_<model>_results_shards/ next to the usual outputs. Workers on other
+machines join the same run by pointing at the same directory on a shared
+filesystem.
+
+A claim is a lease: the worker renews it while the chunk runs, and a chunk
+whose lease ran out (the worker crashed, was killed or lost the filesystem) is
+claimed again by the next free worker. Every claim writes its own
+chunk_<n>_<claim>.jsonl, and a new claim skips the questions an earlier claim
+of the chunk already answered. Once every chunk is done, one worker merges
+the chunk files into <dataset>_<model>_results.jsonl and the per-model CSV,
+keeping one record per question (the successful one if any), and rebuilds the
+job's telemetry (.prom and .telemetry.json) from every request the claims sent.
+The merging worker renews its merge lease the same way.
+
+The ledger uses a rollback journal rather than WAL, because WAL needs shared
+memory that network filesystems do not provide. The workers open the usage
+ledger and response cache, which they all write to, the same way.
+
+Usage:
+    python src/infer.py ... --shard_workers 4  # on every machine, same --dir_save
+    python src/shard_infer.py results/mmlu-en/mmlu_<model>_results_shards  # progress
+
+The ledger is kept after the merge, so running the command again leaves the
+outputs as they are. With --resume, the chunks with failed questions are
+reopened, their failures sent again and the job merged again. Delete the
+_shards folder to start the model and dataset over.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from glob import glob
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from clients import close_clients
+from infer import (InferenceOptions, count_lines, dead_letter_path, dummy_qid_offsets, generation_settings,
+                   iter_dataset_requests, iter_result_records, load_completed_question_ids, make_run_info,
+                   parallel_process_chat, parquet_path, record_question_id, record_succeeded, render_prompts,
+                   results_file_path, save_results_to_csv, telemetry_paths, write_sidecar)
+from prompt_types import PromptType
+from rate_limiter import set_rate_share
+from result_writer import encode_line
+from telemetry import RunTelemetry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500  # questions per claim
+DEFAULT_LEASE_SECONDS = 120.0  # a chunk not renewed for this long is claimed again
+IDLE_POLL_INTERVAL = 5.0  # seconds between lease renewals, budget re-counts and checks for abandoned chunks
+LEDGER_FILENAME = "ledger.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk INTEGER PRIMARY KEY,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    claims INTEGER NOT NULL DEFAULT 0,
+    done_at REAL,
+    first_dummy_qid INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def shard_dir(output_file: str) -> str:
+    """Folder holding the work ledger and chunk files of a results JSONL"""
+    base, _ = os.path.splitext(output_file)
+    return f"{base}_shards"
+
+
+def chunk_file(folder: str, chunk: int, claim: int) -> str:
+    return os.path.join(folder, f"chunk_{chunk:05d}_{claim}.jsonl")
+
+
+def chunk_files(folder: str, chunk: int) -> List[str]:
+    """Results files of every claim of a chunk, oldest claim first"""
+    files = glob(os.path.join(folder, f"chunk_{chunk:05d}_*.jsonl"))
+    files = [path for path in files if not path.endswith("_dead_letter.jsonl")]
+    return sorted(files, key=lambda path: int(os.path.splitext(path)[0].rsplit("_", 1)[1]))
+
+
+def worker_name() -> str:
+    """Unique across the machines sharing a ledger"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkLedger:
+    """Chunks of one dataset and model, their state and leases, in an SQLite file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Isolation level None: transactions are opened explicitly with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # Takes the write lock up front, so two workers never read the same pending chunk
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _meta(self, conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def initialized(self) -> bool:
+        return self._meta(self._conn, "total") is not None
+
+    def initialize(self, total: int, chunk_size: int, first_dummy_qids: Optional[List[int]] = None) -> None:
+        """
+        Create the chunks on first use; later workers check they are splitting the same dataset.
+
+        first_dummy_qids (dummy_qid_offsets) lets a chunk number its questions without
+        an ID as a single run would, without rendering the rows before it.
+        """
+        with self._transaction() as conn:
+            known = self._meta(conn, "total"), self._meta(conn, "chunk_size")
+            if known == (None, None):
+                conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                 [("total", str(total)), ("chunk_size", str(chunk_size))])
+                conn.executemany(
+                    "INSERT INTO chunks (chunk, start, stop, first_dummy_qid) VALUES (?, ?, ?, ?)",
+                    [(chunk, start, min(start + chunk_size, total + 1),
+                      first_dummy_qids[chunk] if first_dummy_qids else 1)
+                     for chunk, start in enumerate(range(1, total + 1, chunk_size))]
+                )
+            elif known != (str(total), str(chunk_size)):
+                raise ValueError(
+                    f"{self.path} splits {known[0]} questions into chunks of {known[1]}, not {total} into "
+                    f"chunks of {chunk_size}; delete {os.path.dirname(self.path)} to start over"
+                )
+
+    def claim(self, worker: str, lease_seconds: float) -> Optional[Tuple[int, int, int, int, int]]:
+        """Lease the next pending or abandoned chunk: (chunk, start, stop, first dummy qid, claim), or None"""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT chunk, start, stop, first_dummy_qid, state, worker, claims FROM chunks "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) ORDER BY chunk LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            chunk, start, stop, first_dummy_qid, state, previous, claims = row
+            conn.execute(
+                "UPDATE chunks SET state = 'leased', worker = ?, lease_until = ?, claims = ? WHERE chunk = ?",
+                (worker, now + lease_seconds, claims + 1, chunk)
+            )
+        if state == "leased":
+            logger.warning(f"Reclaimed chunk {chunk} from {previous}, whose lease expired")
+        return chunk, start, stop, first_dummy_qid, claims + 1
+
+    def renew(self, chunk: int, claim: int, worker: str, lease_seconds: float) -> bool:
+        """Extend a lease; False if it expired and the chunk was claimed by someone else"""
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE chunks SET lease_until = ? WHERE chunk = ? AND worker = ? AND claims = ? AND state = 'leased'",
+                (time.time() + lease_seconds, chunk, worker, claim)
+            ).rowcount
+        return updated == 1
+
+    def complete(self, chunk: int, claim: int, worker: str) -> bool:
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE chunks SET state = 'done', lease_until = NULL, done_at = ? "
+                "WHERE chunk = ? AND worker = ? AND claims = ? AND state = 'leased'",
+                (time.time(), chunk, worker, claim)
+            ).rowcount
+        return updated == 1
+
+    def running_workers(self) -> int:
+        """Workers holding a live lease, which split the rpm and tpm budgets"""
+        return self._conn.execute(
+            "SELECT COUNT(DISTINCT worker) FROM chunks WHERE state = 'leased' AND lease_until >= ?", (time.time(),)
+        ).fetchone()[0]
+
+    def chunks(self) -> List[int]:
+        return [row[0] for row in self._conn.execute("SELECT chunk FROM chunks ORDER BY chunk")]
+
+    def done_chunks(self) -> List[Tuple[int, int, int]]:
+        """(chunk, start, stop) of every finished chunk"""
+        return self._conn.execute("SELECT chunk, start, stop FROM chunks WHERE state = 'done' ORDER BY chunk").fetchall()
+
+    def reopen(self, chunks: List[int]) -> None:
+        """Make finished chunks claimable again, and the job due for a new merge"""
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE chunks SET state = 'pending', worker = NULL, lease_until = NULL, done_at = NULL "
+                "WHERE chunk = ? AND state = 'done'",
+                [(chunk,) for chunk in chunks]
+            )
+            conn.execute("DELETE FROM meta WHERE key IN ('merged_at', 'merge_worker', 'merge_lease_until')")
+
+    def progress(self) -> Dict[str, Any]:
+        counts = dict(self._conn.execute("SELECT state, COUNT(*) FROM chunks GROUP BY state").fetchall())
+        workers = [row[0] for row in self._conn.execute(
+            "SELECT DISTINCT worker FROM chunks WHERE state = 'leased' AND lease_until >= ?", (time.time(),)
+        )]
+        reclaimed = self._conn.execute("SELECT COUNT(*) FROM chunks WHERE claims > 1").fetchone()[0]
+        return {
+            "chunks": sum(counts.values()),
+            "pending": counts.get("pending", 0),
+            "leased": counts.get("leased", 0),
+            "done": counts.get("done", 0),
+            "reclaimed": reclaimed,
+            "active_workers": workers,
+            "merged_at": self._meta(self._conn, "merged_at"),
+        }
+
+    def all_done(self) -> bool:
+        return self._conn.execute("SELECT COUNT(*) FROM chunks WHERE state != 'done'").fetchone()[0] == 0
+
+    def claim_merge(self, worker: str, lease_seconds: float) -> bool:
+        """Become the one worker that merges, unless the merge is done or another worker holds it"""
+        now = time.time()
+        with self._transaction() as conn:
+            if self._meta(conn, "merged_at") is not None:
+                return False
+            until = self._meta(conn, "merge_lease_until")
+            if until is not None and float(until) >= now:
+                return False
+            conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                             [("merge_worker", worker), ("merge_lease_until", str(now + lease_seconds))])
+        return True
+
+    def renew_merge(self, worker: str, lease_seconds: float) -> bool:
+        """Extend the merge lease; False if it expired and another worker took the merge over"""
+        with self._transaction() as conn:
+            if self._meta(conn, "merge_worker") != worker:
+                return False
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('merge_lease_until', ?)",
+                         (str(time.time() + lease_seconds),))
+        return True
+
+    def mark_merged(self) -> None:
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('merged_at', ?)",
+                         (time.strftime('%Y-%m-%dT%H:%M:%S'),))
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+@dataclass
+class ShardJob:
+    """One model on one dataset, in a form a spawned worker process can rebuild the run from"""
+    dataset_name: str
+    dataset_path: str
+    model_name: str
+    language: str
+    dir_save: str  # the <dataset>-<language> folder
+    output_csv: str
+    options: InferenceOptions
+    use_gen_profile: bool = True
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    lease_seconds: float = DEFAULT_LEASE_SECONDS
+
+    @property
+    def output_file(self) -> str:
+        return results_file_path(self.dir_save, self.dataset_name, self.model_name)
+
+    @property
+    def shard_dir(self) -> str:
+        return shard_dir(self.output_file)
+
+    @property
+    def ledger_path(self) -> str:
+        return os.path.join(self.shard_dir, LEDGER_FILENAME)
+
+    def prompts(self):
+        """(system message, input template, question processor, generation profile) of the dataset"""
+        pt = PromptType(self.language)
+        gen_profile = pt.get_gen_profile(self.dataset_name) if self.use_gen_profile else None
+        return (pt.get_sys_msg(self.dataset_name), pt.get_inp_msg(self.dataset_name),
+                pt.get_process_func(self.dataset_name), gen_profile)
+
+
+def chunk_requests(job: ShardJob, start: int, stop: int, first_dummy_qid: int, skip: set,
+                   prompts, params, mcq_logprobs) -> List[Dict[str, Any]]:
+    """Requests of dataset rows [start, stop), with their dataset index, minus already answered questions"""
+    system_message, input_msg, process_question, _ = prompts
+    requests = iter_dataset_requests(job.dataset_path, job.model_name, system_message, input_msg, process_question,
+                                     params, mcq_logprobs, start, first_dummy_qid)
+    chunk = []
+    for index, request in enumerate(islice(requests, stop - start), start):
+        if request["metadata"]["question_id"] not in skip:
+            request["index"] = index
+            chunk.append(request)
+    return chunk
+
+
+async def run_chunk(job: ShardJob, chunk: int, start: int, stop: int, first_dummy_qid: int, claim: int,
+                    limiters, backend) -> None:
+    prompts = job.prompts()
+    system_message, input_msg, _, gen_profile = prompts
+    params, extractor, mcq_logprobs = generation_settings(gen_profile, job.model_name, job.options)
+    # Questions an earlier, abandoned claim of this chunk already answered are not sent again
+    answered = set()
+    for path in chunk_files(job.shard_dir, chunk):
+        answered |= load_completed_question_ids(path)
+    await parallel_process_chat(
+        requests=chunk_requests(job, start, stop, first_dummy_qid, answered, prompts, params, mcq_logprobs),
+        output_file=chunk_file(job.shard_dir, chunk, claim),
+        options=replace(job.options, resume=False, replay_dead_letter=False),
+        limiters=limiters,
+        run_info=make_run_info(job.dataset_name, job.dataset_path, job.model_name, system_message, input_msg, params),
+        backend=backend,
+        extractor=extractor
+    )
+
+
+def update_rate_share(job: ShardJob, ledger: WorkLedger, worker: str, running: int) -> int:
+    """Give this worker its share of the rpm and tpm budgets; returns the running workers it was split between"""
+    if not (job.options.rpm or job.options.tpm):
+        return running
+    now_running = max(1, ledger.running_workers())
+    if now_running != running:
+        set_rate_share(1 / now_running)
+        logger.info(f"{worker}: {now_running} workers running, using 1/{now_running} of the rpm/tpm budget")
+    return now_running
+
+
+async def work(job: ShardJob, worker: str) -> int:
+    """
+    Claim and run chunks until every chunk of the job is done; returns the chunks this worker finished.
+
+    The rpm and tpm budgets are divided between the workers, on any machine, that
+    hold a lease, re-counted every few seconds as workers join and leave.
+    """
+    ledger = WorkLedger(job.ledger_path)
+    limiters = job.options.make_limiters()
+    backend = job.options.make_backend()
+    heartbeat = min(job.lease_seconds / 3, IDLE_POLL_INTERVAL)
+    finished = 0
+    running = 1
+    try:
+        while True:
+            lease = ledger.claim(worker, job.lease_seconds)
+            if lease is None:
+                if ledger.all_done():
+                    return finished
+                # Other workers hold the rest; wait in case one of them dies
+                await asyncio.sleep(heartbeat)
+                continue
+            chunk, start, stop, first_dummy_qid, claim = lease
+            logger.info(f"{worker} running chunk {chunk} (questions {start}-{stop - 1}, claim {claim})")
+            running = update_rate_share(job, ledger, worker, running)
+            task = asyncio.create_task(run_chunk(job, chunk, start, stop, first_dummy_qid, claim, limiters, backend))
+            lost = False
+            while not task.done():
+                await asyncio.wait({task}, timeout=heartbeat)
+                if task.done():
+                    break
+                if not ledger.renew(chunk, claim, worker, job.lease_seconds):
+                    logger.warning(f"{worker} lost the lease on chunk {chunk}; leaving it to its new owner")
+                    lost = True
+                    task.cancel()
+                    await asyncio.wait({task})
+                    break
+                running = update_rate_share(job, ledger, worker, running)
+            if lost:
+                continue
+            task.result()  # a failed chunk stops this worker; its lease runs out and another claims it
+            if ledger.complete(chunk, claim, worker):
+                finished += 1
+    finally:
+        ledger.close()
+        await close_clients()
+
+
+def reopen_failed_chunks(job: ShardJob, ledger: WorkLedger) -> int:
+    """Reopen the finished chunks with questions that never got an answer; returns how many"""
+    failed = []
+    for chunk, start, stop in ledger.done_chunks():
+        answered = set()
+        for path in chunk_files(job.shard_dir, chunk):
+            answered |= load_completed_question_ids(path)
+        if len(answered) < stop - start:
+            failed.append(chunk)
+    if failed:
+        ledger.reopen(failed)
+    return len(failed)
+
+
+def renew_merge_lease(job: ShardJob, worker: str, merged: threading.Event) -> None:
+    """Keep the merge lease until `merged` is set"""
+    ledger = WorkLedger(job.ledger_path)
+    try:
+        while not merged.wait(job.lease_seconds / 3):
+            if not ledger.renew_merge(worker, job.lease_seconds):
+                logger.warning(f"{worker} lost the merge lease of {job.output_file}; another worker merges it too")
+                return
+    finally:
+        ledger.close()
+
+
+def run_worker(job: ShardJob) -> None:
+    """Entry point of a worker process"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    worker = worker_name()
+    finished = asyncio.run(work(job, worker))
+    logger.info(f"{worker} finished {finished} chunks")
+
+
+def iter_chunk_records(path: str) -> Iterator[Dict[str, Any]]:
+    if os.path.exists(path):
+        yield from iter_result_records(path)
+
+
+def observe_record(telemetry: RunTelemetry, model: str, record: Dict[str, Any]) -> None:
+    """Add a finished request, as written to a results JSONL, to a run's telemetry"""
+    usage = record.get("usage") or (record.get("response") or {}).get("usage") or {}
+    telemetry.model(model).observe(
+        queue_wait=record.get("queue_wait"),
+        ttfb=record.get("ttfb"),
+        total=record.get("latency", record.get("duration")) or 0.0,
+        succeeded=record_succeeded(record),
+        cached=bool(record.get("cached")),
+        deduplicated=record.get("duplicate_of") is not None,
+        attempts=record.get("attempts") or 0,
+        prompt_tokens=usage.get("prompt_tokens") or 0,
+        completion_tokens=usage.get("completion_tokens") or 0,
+        error_class=record.get("error_class"),
+    )
+
+
+def telemetry_started(paths: List[str]) -> Optional[float]:
+    """Earliest start among the chunk telemetry summaries"""
+    starts = []
+    for path in paths:
+        try:
+            with open(telemetry_paths(path)[1], encoding="utf-8") as f:
+                starts.append(time.mktime(time.strptime(json.load(f)["started"], "%Y-%m-%dT%H:%M:%S")))
+        except (OSError, ValueError, KeyError):
+            continue
+    return min(starts, default=None)
+
+
+def merge_shards(job: ShardJob) -> None:
+    """
+    Write the results JSONL, dead-letter file, sidecar, CSV and telemetry of a job from its chunk files.
+
+    The telemetry covers every request the claims sent, so the timings of a chunk
+    that was claimed again include the abandoned claim's requests.
+    """
+    ledger = WorkLedger(job.ledger_path)
+    try:
+        chunks = ledger.chunks()
+    finally:
+        ledger.close()
+    # One record per question, in chunk order: the first success, else the latest failure
+    records: Dict[Any, Dict[str, Any]] = {}
+    dead_letters: Dict[Any, Dict[str, Any]] = {}
+    telemetry = RunTelemetry(job.dataset_name)
+    claim_files = []
+    for chunk in chunks:
+        for path in chunk_files(job.shard_dir, chunk):
+            claim_files.append(path)
+            for record in iter_chunk_records(path):
+                observe_record(telemetry, job.model_name, record)
+                key = record_question_id(record)
+                if key is None:
+                    key = ("index", record.get("index", len(records)))
+                if key not in records or not record_succeeded(records[key]):
+                    records[key] = record
+            for record in iter_chunk_records(dead_letter_path(path)):
+                dead_letters[record_question_id(record)] = record
+
+    output_file = job.output_file
+    failures = [record for key, record in dead_letters.items() if key not in records or not record_succeeded(records[key])]
+    # Written aside and moved into place, so a crashed merge never leaves half a results file
+    for path, lines in ((output_file, records.values()), (dead_letter_path(output_file), failures)):
+        if path != output_file and not lines:
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            for record in lines:
+                f.write(encode_line(record))
+        os.replace(tmp_path, path)
+
+    system_message, input_msg, process_question, gen_profile = job.prompts()
+    params, _, _ = generation_settings(gen_profile, job.model_name, job.options)
+    write_sidecar(output_file, job.options.record_format,
+                  make_run_info(job.dataset_name, job.dataset_path, job.model_name, system_message, input_msg, params))
+    prompts = ((qid, input_text_model) for input_text_model, _, qid in render_prompts(job.dataset_path, input_msg, process_question))
+    save_results_to_csv(output_file, job.output_csv, job.dataset_name, job.model_name, system_message, prompts,
+                        parquet_path(job.output_csv) if job.options.parquet else None)
+    telemetry.started = telemetry_started(claim_files) or telemetry.started
+    telemetry.log_summary()
+    metrics_file, summary_file = telemetry_paths(output_file)
+    telemetry.write_openmetrics(metrics_file)
+    telemetry.write_json(summary_file)
+    failed = sum(1 for record in records.values() if not record_succeeded(record))
+    logger.info(f"Merged {len(chunks)} chunks into {output_file} and {job.output_csv}: "
+                f"{len(records) - failed} answered, {failed} failed")
+
+
+def shard_infer(job: ShardJob, workers: int) -> None:
+    """
+    Run a job with `workers` local processes, joining any other machines on the same ledger,
+    and merge the outputs if this machine is the one to finish last. With options.resume,
+    finished chunks whose questions did not all succeed are run again first.
+
+    The rpm and tpm budgets are for the whole job: every worker, on any machine,
+    uses its share of them (see work).
+    """
+    os.makedirs(job.shard_dir, exist_ok=True)
+    ledger = WorkLedger(job.ledger_path)
+    try:
+        if not ledger.initialized():
+            # One pass over the dataset, so no chunk has to render the rows before it
+            _, input_msg, process_question, _ = job.prompts()
+            offsets = dummy_qid_offsets(job.dataset_path, input_msg, process_question, job.chunk_size)
+            ledger.initialize(count_lines(job.dataset_path), job.chunk_size, offsets)
+        else:
+            ledger.initialize(count_lines(job.dataset_path), job.chunk_size)
+        if job.options.resume:
+            reopened = reopen_failed_chunks(job, ledger)
+            logger.info(f"Resuming {job.output_file}: {reopened} finished chunks have failed questions to send again")
+    finally:
+        ledger.close()
+
+    # Every worker on every machine writes the same usage ledger and cache
+    worker_job = replace(job, options=replace(job.options, journal_mode="DELETE"))
+    # Spawned, not forked: each worker builds its own event loop, clients and SQLite connections
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(worker_job,), daemon=False) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            logger.error(f"Worker process {process.pid} exited with code {process.exitcode}; "
+                         f"its chunk is claimed again once the lease runs out")
+
+    ledger = WorkLedger(job.ledger_path)
+    try:
+        progress = ledger.progress()
+        if not ledger.all_done():
+            logger.error(f"{job.output_file}: {progress['done']} of {progress['chunks']} chunks done and no local "
+                         f"worker left; run the command again to finish")
+            return
+        if progress["merged_at"] is not None:
+            logger.info(f"{job.output_file} was merged at {progress['merged_at']}")
+            return
+        worker = worker_name()
+        if not ledger.claim_merge(worker, job.lease_seconds):
+            logger.info(f"{job.output_file} is being merged by another worker")
+            return
+        # Renewed from a thread with its own connection, so a long merge keeps the lease
+        merging = threading.Event()
+        heartbeat = threading.Thread(target=renew_merge_lease, args=(job, worker, merging), daemon=True)
+        heartbeat.start()
+        try:
+            merge_shards(job)
+        finally:
+            merging.set()
+            heartbeat.join()
+        ledger.mark_merged()
+    finally:
+        ledger.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the progress of a sharded inference run.")
+    parser.add_argument("shard_dirs", nargs="+", help="<dataset>_<model>_results_shards folders")
+    args = parser.parse_args()
+
+    for folder in args.shard_dirs:
+        if not os.path.exists(os.path.join(folder, LEDGER_FILENAME)):
+            parser.error(f"No work ledger in {folder}")
+        ledger = WorkLedger(os.path.join(folder, LEDGER_FILENAME))
+        try:
+            progress = ledger.progress()
+        finally:
+            ledger.close()
+        logger.info(
+            f"{folder}: {progress['done']} of {progress['chunks']} chunks done, {progress['leased']} running on "
+            f"{len(progress['active_workers'])} workers, {progress['reclaimed']} reclaimed"
+            + (f", merged at {progress['merged_at']}" if progress["merged_at"] else "")
+        )
+        print(json.dumps(progress))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    main()
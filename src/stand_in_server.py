@@ -0,0 +1,525 @@
+"""
+Local OpenAI-compatible stand-in for benchmarking the inference engine.
+
+Serves POST /v1/chat/completions over HTTP/1.1 keep-alive connections, like a
+hosted provider, but answers from a script instead of a model:
+
+    latency      drawn per request from a distribution, e.g. "lognormal:0.4:0.5"
+                 (median seconds, sigma), "uniform:0.1:0.8", "exp:0.3" (mean) or
+                 "const:0.2"; per-model overrides as "model=spec"
+    rpm          requests per minute accepted before answering 429 with Retry-After
+    capacity     concurrent requests accepted before answering 429
+    error_rate   fraction of requests answered with a 500
+    token_delay  seconds per word of the answer; with "stream": true the words are
+                 sent as server-sent events as they are "generated", and streams
+                 the client closes early are counted
+    prompt_delay extra seconds per 1000 prompt characters, so long prompts are
+                 slower like they are on a real server (prefill)
+    outage       per-model windows, "model=START:DURATION" in seconds from server
+                 start, during which that model answers every request with a 503
+
+It also fakes the batch API (POST /v1/files, POST /v1/batches, GET
+/v1/batches/{id}, GET /v1/files/{id}/content) for testing `infer.py --batch`.
+A batch moves through validating and in_progress to completed over
+`batch_delay` seconds. Failed lines, drawn with the same error rate, go to the
+error file.
+
+Outcomes are drawn from one seeded random stream, so two runs with the same
+settings see the same mix of latencies and failures. Run it on its own and
+point infer.py at it with `--backend llamacpp --base_url http://127.0.0.1:8080/v1`:
+
+    python stand_in_server.py --port 8080 --latency lognormal:0.4:0.5 --rpm 1200
+"""
+
+import argparse
+import email.parser
+import email.policy
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY = "lognormal:0.4:0.5"
+DEFAULT_ANSWERS = ["A", "B", "C", "D"]
+RATE_LIMIT_WINDOW = 60.0  # seconds
+DEFAULT_BATCH_DELAY = 2.0  # seconds from batch creation to completion
+
+
+class LatencyDistribution:
+    """Latency in seconds drawn from a named distribution"""
+
+    KINDS = ("const", "uniform", "exp", "lognormal")
+
+    def __init__(self, kind: str, params: List[float]):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution {kind!r}, expected one of {self.KINDS}")
+        expected = {"const": 1, "uniform": 2, "exp": 1, "lognormal": 2}[kind]
+        if len(params) != expected:
+            raise ValueError(f"{kind} latency takes {expected} parameters, got {len(params)}")
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyDistribution":
+        """Parse "kind:param[:param]", e.g. "lognormal:0.4:0.5" """
+        kind, *params = spec.split(":")
+        return cls(kind, [float(param) for param in params])
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "const":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "exp":
+            return rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        median, sigma = self.params
+        return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+    def __str__(self) -> str:
+        return ":".join([self.kind] + [f"{param:g}" for param in self.params])
+
+
+class StandInState:
+    """Script and counters shared by the request handler threads"""
+
+    def __init__(
+        self,
+        latency: str = DEFAULT_LATENCY,
+        model_latency: Optional[Dict[str, str]] = None,
+        rpm: Optional[int] = None,
+        capacity: Optional[int] = None,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        answers: Optional[List[str]] = None,
+        batch_delay: float = DEFAULT_BATCH_DELAY,
+        token_delay: float = 0.0,
+        outages: Optional[Dict[str, Tuple[float, float]]] = None,
+        prompt_delay: float = 0.0,
+    ):
+        self.batch_delay = batch_delay
+        self.prompt_delay = prompt_delay
+        self.outages = outages or {}  # model -> (start, duration) seconds after start
+        self._start = time.monotonic()
+        self.token_delay = token_delay
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.latency = LatencyDistribution.parse(latency)
+        self.model_latency = {model: LatencyDistribution.parse(spec) for model, spec in (model_latency or {}).items()}
+        self.rpm = rpm
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.answers = answers or DEFAULT_ANSWERS
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._accepted = deque()  # start times of requests in the rate-limit window
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.outage_errors = 0
+        self.streams_closed_early = 0
+
+    def admit(self, model: str):
+        """Decide a request's fate: (status, retry_after, latency)"""
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self._accepted and now - self._accepted[0] >= RATE_LIMIT_WINDOW:
+                self._accepted.popleft()
+            if self.rpm and len(self._accepted) >= self.rpm:
+                self.rate_limited += 1
+                return 429, RATE_LIMIT_WINDOW - (now - self._accepted[0]), 0.0
+            if self.capacity and self.in_flight >= self.capacity:
+                self.rate_limited += 1
+                return 429, 1.0, 0.0
+            self._accepted.append(now)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            latency = self.model_latency.get(model, self.latency).sample(self._rng)
+            if model in self.outages:
+                start, duration = self.outages[model]
+                if start <= now - self._start < start + duration:
+                    self.outage_errors += 1
+                    return 503, None, latency
+            if self._rng.random() < self.error_rate:
+                self.errors += 1
+                return 500, None, latency
+            return 200, None, latency
+
+    def done(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def fails(self) -> bool:
+        """Draw whether a batch line fails"""
+        with self._lock:
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        info = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self._lock:
+            self.files[file_id] = {"info": info, "content": content}
+        return info
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> Dict[str, Any]:
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self._run_batch, args=(batch,), daemon=True).start()
+        return dict(batch)
+
+    def _run_batch(self, batch: Dict[str, Any]) -> None:
+        """Answer every line of the input file, then complete after batch_delay"""
+        started = time.monotonic()
+        content = self.files[batch["input_file_id"]]["content"].decode("utf-8")
+        lines = [json.loads(line) for line in content.splitlines() if line.strip()]
+        with self._lock:
+            batch["status"] = "in_progress"
+            batch["in_progress_at"] = int(time.time())
+            batch["request_counts"]["total"] = len(lines)
+        outputs, errors = [], []
+        for line in lines:
+            body = line.get("body") or {}
+            result = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": line.get("custom_id"), "error": None}
+            if self.fails():
+                result["response"] = {"status_code": 500, "body": {"error": {"message": "Internal server error", "type": "server_error"}}}
+                errors.append(result)
+            else:
+                result["response"] = {"status_code": 200, "body": completion_body(body.get("model", ""), body.get("messages") or [], self.answers)}
+                outputs.append(result)
+        time.sleep(max(0.0, self.batch_delay - (time.monotonic() - started)))
+        encode = lambda rows: "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+        output_file = self.add_file(f"{batch['id']}_output.jsonl", "batch_output", encode(outputs)) if outputs else None
+        error_file = self.add_file(f"{batch['id']}_error.jsonl", "batch_output", encode(errors)) if errors else None
+        with self._lock:
+            batch["output_file_id"] = output_file["id"] if output_file else None
+            batch["error_file_id"] = error_file["id"] if error_file else None
+            batch["request_counts"].update(completed=len(outputs), failed=len(errors))
+            batch["status"] = "completed"
+            batch["completed_at"] = int(time.time())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "errors": self.errors,
+                "outage_errors": self.outage_errors,
+                "peak_in_flight": self.peak_in_flight,
+                "batches": len(self.batches),
+                "streams_closed_early": self.streams_closed_early,
+            }
+
+
+def completion_body(model: str, messages: List[Dict[str, Any]], answers: List[str]) -> Dict[str, Any]:
+    """OpenAI chat.completion payload with a stable answer per prompt"""
+    prompt = "".join(str(message.get("content") or "") for message in messages)
+    content = answers[sum(prompt.encode("utf-8")) % len(answers)]
+    # Same rough estimate as rate_limiter.estimate_text_tokens
+    prompt_tokens = max(1, len(prompt) // 4)
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        "id": f"standin-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": content},
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so the client's connection pool is exercised
+    server_version = "StandIn/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body: Dict[str, Any], include_usage: bool) -> None:
+        """Send a completion as server-sent events, one word per chunk, token_delay apart"""
+        state: StandInState = self.server.state
+        content = body["choices"][0]["message"]["content"]
+        chunk = {key: body[key] for key in ("id", "created", "model")}
+        chunk["object"] = "chat.completion.chunk"
+        events = [{**chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}]
+        events += [
+            {**chunk, "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            for word in re.findall(r"\s*\S+", content)
+        ]
+        events.append({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if include_usage:
+            events.append({**chunk, "choices": [], "usage": body["usage"]})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, event in enumerate(events):
+                if 1 < i < len(events) - 1:
+                    time.sleep(state.token_delay)
+                self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            with state._lock:
+                state.streams_closed_early += 1
+            self.close_connection = True
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_error(self, status: int, message: str, error_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self._send_json(status, {"error": {"message": message, "type": error_type, "code": status}}, headers)
+
+    def _route(self) -> List[str]:
+        """Path segments after the /v1 prefix"""
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        return parts[1:] if parts[:1] == ["v1"] else parts
+
+    def do_GET(self):
+        state: StandInState = self.server.state
+        route = self._route()
+        if route == ["stats"]:
+            self._send_json(200, state.stats())
+        elif len(route) == 2 and route[0] == "batches" and route[1] in state.batches:
+            with state._lock:
+                batch = dict(state.batches[route[1]])
+            self._send_json(200, batch)
+        elif len(route) >= 2 and route[0] == "files" and route[1] in state.files:
+            stored = state.files[route[1]]
+            if route[2:] == ["content"]:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(stored["content"])))
+                self.end_headers()
+                self.wfile.write(stored["content"])
+            else:
+                self._send_json(200, stored["info"])
+        else:
+            self._send_error(404, f"No route for GET {self.path}", "invalid_request_error")
+
+    def _upload_file(self, body: bytes) -> None:
+        """multipart/form-data upload with `file` and `purpose` fields"""
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode("utf-8") + body
+        )
+        fields, filename, content = {}, "upload.jsonl", None
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                filename = part.get_filename() or filename
+                content = part.get_payload(decode=True)
+            elif name:
+                fields[name] = part.get_content().strip()
+        if content is None:
+            self._send_error(400, "Missing file field", "invalid_request_error")
+            return
+        self._send_json(200, self.server.state.add_file(filename, fields.get("purpose", "batch"), content))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        route = self._route()
+        if route == ["files"]:
+            self._upload_file(body)
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            self._send_error(400, "Request body is not valid JSON", "invalid_request_error")
+            return
+        if route == ["batches"]:
+            if payload.get("input_file_id") not in self.server.state.files:
+                self._send_error(404, f"No such file {payload.get('input_file_id')}", "invalid_request_error")
+                return
+            self._send_json(200, self.server.state.create_batch(
+                payload["input_file_id"], payload.get("endpoint", "/v1/chat/completions"), payload.get("completion_window", "24h")
+            ))
+            return
+        if route != ["chat", "completions"]:
+            self._send_error(404, f"No route for POST {self.path}", "invalid_request_error")
+            return
+
+        state: StandInState = self.server.state
+        model = payload.get("model", "")
+        status, retry_after, latency = state.admit(model)
+        if status == 429:
+            self._send_error(429, "Rate limit exceeded", "rate_limit_error", {"Retry-After": f"{retry_after:.0f}"})
+            return
+        prompt_chars = sum(len(str(message.get("content") or "")) for message in payload.get("messages") or [])
+        try:
+            time.sleep(latency + state.prompt_delay * prompt_chars / 1000)
+        finally:
+            state.done()
+        if status == 500:
+            self._send_error(500, "Internal server error", "server_error")
+            return
+        if status == 503:
+            self._send_error(503, f"Model {model} is unavailable", "server_error")
+            return
+        body = completion_body(model, payload.get("messages") or [], state.answers)
+        if payload.get("stream"):
+            self._send_stream(body, bool((payload.get("stream_options") or {}).get("include_usage")))
+            return
+        # Generated at the same pace as a stream, just sent at once
+        time.sleep(state.token_delay * len(body["choices"][0]["message"]["content"].split()))
+        self._send_json(200, body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer carrying the shared StandInState; port 0 picks a free port"""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, state: Optional[StandInState] = None):
+        super().__init__((host, port), StandInHandler)
+        self.state = state or StandInState()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def serve_in_process(conn, host: str = "127.0.0.1", port: int = 0, state_options: Optional[Dict[str, Any]] = None) -> None:
+    """multiprocessing target: start a server, send its base URL through conn, serve until terminated"""
+    server = StandInServer(host, port, StandInState(**(state_options or {})))
+    conn.send(server.base_url)
+    conn.close()
+    server.serve_forever()
+
+
+def fetch_stats(base_url: str) -> Dict[str, Any]:
+    """Counters of a running stand-in"""
+    with urllib.request.urlopen(f"{base_url}/stats", timeout=10) as response:
+        return json.loads(response.read())
+
+
+def parse_model_latency(values: Optional[List[str]]) -> Dict[str, str]:
+    """["model=spec", ...] -> {model: spec}"""
+    overrides = {}
+    for value in values or []:
+        model, sep, spec = value.rpartition("=")
+        if not sep:
+            raise ValueError(f"Expected model=spec, got {value!r}")
+        overrides[model] = spec
+    return overrides
+
+
+def parse_outages(values: Optional[List[str]]) -> Dict[str, Tuple[float, float]]:
+    """["model=START:DURATION", ...] -> {model: (start, duration)}"""
+    outages = {}
+    for value in values or []:
+        model, sep, window = value.rpartition("=")
+        start, colon, duration = window.partition(":")
+        if not sep or not colon:
+            raise ValueError(f"Expected model=START:DURATION, got {value!r}")
+        outages[model] = (float(start), float(duration))
+    return outages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve scripted OpenAI-compatible chat completions.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=str, default=DEFAULT_LATENCY,
+                        help="Latency distribution: const:S, uniform:LO:HI, exp:MEAN or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--model_latency", nargs="*", default=None,
+                        help="Per-model overrides as model=spec")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute before answering 429")
+    parser.add_argument("--capacity", type=int, default=None, help="Concurrent requests before answering 429")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_delay", type=float, default=DEFAULT_BATCH_DELAY,
+                        help="Seconds from batch creation to completion")
+    parser.add_argument("--token_delay", type=float, default=0.0,
+                        help="Seconds between words of a streamed response")
+    parser.add_argument("--answers", nargs="+", default=None,
+                        help="Responses to pick from per prompt (default: A B C D)")
+    parser.add_argument("--prompt_delay", type=float, default=0.0,
+                        help="Extra seconds per 1000 prompt characters")
+    parser.add_argument("--outage", nargs="*", default=None,
+                        help="Per-model outages as model=START:DURATION (seconds from start), answered with 503")
+    args = parser.parse_args()
+
+    state = StandInState(
+        latency=args.latency,
+        model_latency=parse_model_latency(args.model_latency),
+        rpm=args.rpm,
+        capacity=args.capacity,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        answers=args.answers,
+        batch_delay=args.batch_delay,
+        token_delay=args.token_delay,
+        outages=parse_outages(args.outage),
+        prompt_delay=args.prompt_delay,
+    )
+    server = StandInServer(args.host, args.port, state)
+    logger.info(f"Serving {server.base_url} (latency {state.latency}, rpm {args.rpm}, capacity {args.capacity})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Stand-in stats: {json.dumps(state.stats())}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,199 @@
+"""
+Per-request telemetry for inference runs.
+
+Every finished request is observed with three timings:
+
+    queue_wait  time spent queued before an attempt was sent: waiting for a
+                worker, a concurrency slot and rate-limit budget (summed over attempts)
+    ttfb        time from sending the final attempt until the first byte of the response
+    total       time from the first attempt until the final outcome, backoff included
+
+along with its token usage and, if any attempt failed, its error class
+(rate_limit, timeout, connection or http_<status>).
+
+RunTelemetry keeps them per model for one dataset. At the end of a run it writes
+an OpenMetrics text file (cumulative histograms and counters, labelled by model
+and dataset, ready for a node_exporter textfile collector or promtool) and a JSON
+summary with exact percentiles. Nightly runs can then be compared without
+grepping logs.
+"""
+
+import json
+import logging
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "bnllm"
+# Histogram bucket upper bounds in seconds (+Inf is implied)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+TIMINGS = ("queue_wait", "ttfb", "total")
+TIMING_HELP = {
+    "queue_wait": "Time queued before attempts were sent (worker, concurrency slot, rate limit)",
+    "ttfb": "Time from sending the final attempt to the first response byte",
+    "total": "Time from the first attempt to the final outcome, retries and backoff included",
+}
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(q / 100 * len(sorted_values) + 0.5 - 1e-9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def distribution(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99/mean/max of a list of values"""
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    return {
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "mean": round(sum(values) / len(values), 4),
+        "max": round(values[-1], 4),
+    }
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class ModelTelemetry:
+    """Timings, tokens and outcomes of one model's requests"""
+
+    def __init__(self):
+        self.timings: Dict[str, List[float]] = {name: [] for name in TIMINGS}
+        self.outcomes: Counter = Counter()
+        self.error_classes: Counter = Counter()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.attempts = 0
+
+    def observe(
+        self,
+        queue_wait: Optional[float],
+        ttfb: Optional[float],
+        total: float,
+        succeeded: bool,
+        cached: bool = False,
+        deduplicated: bool = False,
+        attempts: int = 0,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        error_class: Optional[str] = None,
+    ) -> None:
+        self.outcomes["cached" if cached else "deduplicated" if deduplicated else "success" if succeeded else "failure"] += 1
+        if error_class:
+            self.error_classes[error_class] += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.attempts += attempts
+        if cached or deduplicated:
+            # Answered from the cache or another request: no provider timing to speak of
+            return
+        for name, value in (("queue_wait", queue_wait), ("ttfb", ttfb), ("total", total)):
+            if value is not None:
+                self.timings[name].append(max(0.0, value))
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "requests": sum(self.outcomes.values()),
+            "outcomes": dict(self.outcomes),
+            "attempts": self.attempts,
+            "error_classes": dict(self.error_classes),
+            "tokens": {"prompt": self.prompt_tokens, "completion": self.completion_tokens},
+            **{name: distribution(values) for name, values in self.timings.items()},
+        }
+
+
+class RunTelemetry:
+    """Telemetry of one dataset's run, per model"""
+
+    def __init__(self, dataset: str):
+        self.dataset = dataset
+        self.models: Dict[str, ModelTelemetry] = {}
+        self.started = time.time()
+
+    def model(self, name: str) -> ModelTelemetry:
+        if name not in self.models:
+            self.models[name] = ModelTelemetry()
+        return self.models[name]
+
+    def __len__(self) -> int:
+        return sum(sum(model.outcomes.values()) for model in self.models.values())
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "dataset": self.dataset,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration": round(time.time() - self.started, 3),
+            "models": {name: model.summary() for name, model in self.models.items()},
+        }
+
+    def write_json(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def openmetrics(self) -> str:
+        """All metrics in the OpenMetrics text format"""
+        lines = []
+        for timing in TIMINGS:
+            family = f"{METRIC_PREFIX}_request_{timing}_seconds"
+            lines += [f"# TYPE {family} histogram", f"# UNIT {family} seconds", f"# HELP {family} {TIMING_HELP[timing]}."]
+            for name, model in self.models.items():
+                values = model.timings[timing]
+                for bound in LATENCY_BUCKETS:
+                    count = sum(1 for value in values if value <= bound)
+                    lines.append(f"{family}_bucket{_labels(model=name, dataset=self.dataset, le=bound)} {count}")
+                lines.append(f"{family}_bucket{_labels(model=name, dataset=self.dataset, le='+Inf')} {len(values)}")
+                lines.append(f"{family}_count{_labels(model=name, dataset=self.dataset)} {len(values)}")
+                lines.append(f"{family}_sum{_labels(model=name, dataset=self.dataset)} {sum(values):.6f}")
+
+        family = f"{METRIC_PREFIX}_requests"
+        lines += [f"# TYPE {family} counter", f"# HELP {family} Finished requests by outcome."]
+        for name, model in self.models.items():
+            for outcome, count in sorted(model.outcomes.items()):
+                lines.append(f"{family}_total{_labels(model=name, dataset=self.dataset, outcome=outcome)} {count}")
+
+        family = f"{METRIC_PREFIX}_request_attempts"
+        lines += [f"# TYPE {family} counter", f"# HELP {family} Attempts sent to the provider."]
+        for name, model in self.models.items():
+            lines.append(f"{family}_total{_labels(model=name, dataset=self.dataset)} {model.attempts}")
+
+        family = f"{METRIC_PREFIX}_request_errors"
+        lines += [f"# TYPE {family} counter", f"# HELP {family} Requests with a failed attempt, by error class of the last failure."]
+        for name, model in self.models.items():
+            for error_class, count in sorted(model.error_classes.items()):
+                lines.append(f"{family}_total{_labels(model=name, dataset=self.dataset, error_class=error_class)} {count}")
+
+        family = f"{METRIC_PREFIX}_tokens"
+        lines += [f"# TYPE {family} counter", f"# HELP {family} Tokens reported by the provider."]
+        for name, model in self.models.items():
+            lines.append(f"{family}_total{_labels(model=name, dataset=self.dataset, kind='prompt')} {model.prompt_tokens}")
+            lines.append(f"{family}_total{_labels(model=name, dataset=self.dataset, kind='completion')} {model.completion_tokens}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_openmetrics(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.openmetrics())
+
+    def log_summary(self) -> None:
+        for name, model in self.models.items():
+            total, ttfb, queue_wait = (distribution(model.timings[timing]) for timing in ("total", "ttfb", "queue_wait"))
+            if total["p50"] is None:
+                continue
+            logger.info(
+                f"[{name}] {self.dataset}: total p50 {total['p50']:.2f}s / p95 {total['p95']:.2f}s / p99 {total['p99']:.2f}s, "
+                f"ttfb p50 {ttfb['p50'] or 0:.2f}s / p95 {ttfb['p95'] or 0:.2f}s, queue wait p95 {queue_wait['p95'] or 0:.2f}s"
+            )
@@ -0,0 +1,404 @@
+"""
+Token usage and cost ledger shared by inference, judging and translation.
+
+Every API call's prompt and completion tokens are recorded in SQLite, tagged with
+the pipeline stage (translate, parse_errors, infer, judge), dataset, model and
+language. A price table turns them into spend, so we can see which datasets and
+models dominate cost before planning the next sweep:
+
+    python usage_ledger.py report results/usage_ledger.sqlite --by stage model
+    python usage_ledger.py report results/usage_ledger.sqlite --by dataset --stage infer
+
+infer.py records into <dir_save>/usage_ledger.sqlite by default and the judge
+into the same file next to the folder it judges (or $USAGE_LEDGER). Translation
+scripts already keep every raw response in api_responses/; import them with
+
+    python usage_ledger.py import translation/openbookqa/test/api_responses results/usage_ledger.sqlite \
+        --dataset openbookqa/test
+
+Each file is imported once, recognised by a hash of its content. A file whose
+content changed since an earlier import was rewritten by a parse_errors retry
+and is recorded under that stage; one rewritten unchanged is skipped.
+Responses served from the response cache are recorded as cached and cost nothing.
+Calls made through a provider's batch API are recorded in the "batch" price tier
+and cost BATCH_DISCOUNT of the live price.
+"""
+
+import argparse
+import atexit
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("translate", "parse_errors", "infer", "judge")
+DEFAULT_LEDGER_FILENAME = "usage_ledger.sqlite"
+COMMIT_EVERY = 256  # rows buffered before they are written in one transaction
+GROUP_KEYS = ("stage", "dataset", "model", "language", "tier")
+TIERS = ("live", "batch")
+BATCH_DISCOUNT = 0.5  # batch API price as a fraction of the live price
+
+# USD per million (prompt, completion) tokens; list prices when these runs were planned.
+# Override or extend with --prices prices.json ({"model": [prompt, completion], ...}).
+PRICES_PER_MILLION: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini-2024-07-18": (0.15, 0.60),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo": (0.18, 0.18),
+    "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": (0.88, 0.88),
+    "meta-llama/Llama-3.2-3B-Instruct-Turbo": (0.06, 0.06),
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo": (0.88, 0.88),
+    "deepseek-ai/DeepSeek-R1-Distill-Qwen-14B": (1.60, 1.60),
+    "deepseek-ai/DeepSeek-R1-Distill-Llama-70B": (2.00, 2.00),
+    "Qwen/Qwen2.5-7B-Instruct-Turbo": (0.30, 0.30),
+    "Qwen/Qwen2.5-72B-Instruct-Turbo": (1.20, 1.20),
+    "mistralai/Mistral-7B-Instruct-v0.3": (0.20, 0.20),
+    "mistralai/Mistral-Small-24B-Instruct-2501": (0.80, 0.80),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    stage TEXT NOT NULL,
+    dataset TEXT,
+    model TEXT NOT NULL,
+    language TEXT,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cached INTEGER NOT NULL DEFAULT 0,
+    tier TEXT NOT NULL DEFAULT 'live',
+    source TEXT,
+    source_mtime REAL,
+    source_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS usage_tags ON usage (stage, dataset, model);
+"""
+# Created after the migrations, which add source_hash to older ledgers
+SOURCE_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS usage_source_hash ON usage (source, source_hash) WHERE source IS NOT NULL"
+
+
+def file_hash(path: str) -> str:
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def usage_tokens(usage: Any) -> Tuple[int, int]:
+    """(prompt, completion) tokens from an SDK usage object or a raw response dict"""
+    if usage is None:
+        return 0, 0
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+    return getattr(usage, "prompt_tokens", None) or 0, getattr(usage, "completion_tokens", None) or 0
+
+
+def call_cost(model: str, prompt_tokens: int, completion_tokens: int,
+              prices: Optional[Dict[str, Tuple[float, float]]] = None, tier: str = "live") -> Optional[float]:
+    """Spend in USD, or None when the model is not in the price table"""
+    price = (prices or PRICES_PER_MILLION).get(model)
+    if price is None:
+        return None
+    cost = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6
+    return cost * BATCH_DISCOUNT if tier == "batch" else cost
+
+
+class UsageLedger:
+    """SQLite usage ledger, safe to share between the event loop and worker threads"""
+
+    def __init__(self, path: str, commit_every: int = COMMIT_EVERY, journal_mode: str = "WAL"):
+        self.path = path
+        self.commit_every = commit_every
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Buffered in memory, not in an open transaction, so other processes sharing the file can write meanwhile
+        self._pending: List[Tuple] = []
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # DELETE when other machines share the file: WAL needs shared memory that network filesystems lack
+        self._conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(usage)")]
+        if "tier" not in columns:
+            # Ledgers created before price tiers were recorded hold live calls only
+            self._conn.execute("ALTER TABLE usage ADD COLUMN tier TEXT NOT NULL DEFAULT 'live'")
+        if "source_hash" not in columns:
+            # Imports were keyed on mtime, which any rewrite changes; rows imported then are matched by mtime once
+            self._conn.execute("ALTER TABLE usage ADD COLUMN source_hash TEXT")
+            self._conn.execute("DROP INDEX IF EXISTS usage_source")
+        self._conn.execute(SOURCE_INDEX)
+        self._conn.commit()
+
+    def record(
+        self,
+        stage: str,
+        model: str,
+        usage: Any = None,
+        dataset: Optional[str] = None,
+        language: Optional[str] = None,
+        cached: bool = False,
+        tier: str = "live",
+    ) -> None:
+        """Add one call's usage (an SDK usage object or dict); committed in batches"""
+        prompt_tokens, completion_tokens = usage_tokens(usage)
+        with self._lock:
+            self._pending.append(
+                (time.time(), stage, dataset, model, language, prompt_tokens, completion_tokens, int(cached), tier)
+            )
+            if len(self._pending) >= self.commit_every:
+                self._commit()
+
+    def tagged(self, stage: str, dataset: Optional[str] = None, language: Optional[str] = None,
+               tier: str = "live") -> "TaggedLedger":
+        return TaggedLedger(self, stage, dataset, language, tier)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._commit()
+
+    def _commit(self) -> None:
+        if self._pending:
+            self._conn.executemany(
+                "INSERT INTO usage (ts, stage, dataset, model, language, prompt_tokens, completion_tokens, cached, tier) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._pending,
+            )
+            self._conn.commit()
+            self._pending = []
+
+    def import_responses(self, directory: str, dataset: Optional[str] = None, language: Optional[str] = "bn",
+                         stage: str = "translate") -> Dict[str, int]:
+        """
+        Record the raw API responses saved as JSON files in directory.
+
+        New files are recorded under `stage`. A file imported before is skipped if its
+        content is unchanged; otherwise it was rewritten by a parse_errors retry and is
+        recorded under that stage.
+        """
+        counts = {"imported": 0, "retries": 0, "skipped": 0}
+        with self._lock:
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.abspath(os.path.join(directory, name))
+                try:
+                    mtime = os.path.getmtime(path)
+                    content_hash = file_hash(path)
+                    seen = self._conn.execute("SELECT id, source_mtime, source_hash FROM usage WHERE source = ?",
+                                              (path,)).fetchall()
+                    if any(row[2] == content_hash for row in seen):
+                        counts["skipped"] += 1
+                        continue
+                    legacy = [row[0] for row in seen if row[2] is None and row[1] == mtime]
+                    if legacy:
+                        # Imported before content hashes were kept, and untouched since
+                        self._conn.execute("UPDATE usage SET source_hash = ? WHERE id = ?", (content_hash, legacy[0]))
+                        counts["skipped"] += 1
+                        continue
+                    with open(path, "r", encoding="utf-8") as f:
+                        response = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    logger.warning(f"Skipping unreadable response {path}: {e}")
+                    continue
+                if not isinstance(response, dict) or "usage" not in response:
+                    counts["skipped"] += 1
+                    continue
+                prompt_tokens, completion_tokens = usage_tokens(response["usage"])
+                file_stage = "parse_errors" if seen else stage
+                self._conn.execute(
+                    "INSERT INTO usage (ts, stage, dataset, model, language, prompt_tokens, completion_tokens, cached, "
+                    "source, source_mtime, source_hash) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                    (response.get("created") or mtime, file_stage, dataset, response.get("model") or "unknown",
+                     language, prompt_tokens, completion_tokens, path, mtime, content_hash),
+                )
+                counts["retries" if seen else "imported"] += 1
+            self._conn.commit()
+        return counts
+
+    def report(
+        self,
+        group_by: Iterable[str] = ("stage", "model"),
+        stage: Optional[str] = None,
+        since: Optional[float] = None,
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Calls, tokens and cost per group, most expensive first"""
+        keys = [key for key in group_by if key in GROUP_KEYS]
+        if not keys:
+            raise ValueError(f"group_by needs at least one of {GROUP_KEYS}")
+        # Grouped by model and tier as well, since the price depends on them
+        columns = list(dict.fromkeys(keys + ["model", "tier"]))
+        conditions, params = [], []
+        if stage:
+            conditions.append("stage = ?")
+            params.append(stage)
+        if since:
+            conditions.append("ts >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = (
+            f"SELECT {', '.join(columns)}, cached, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens) "
+            f"FROM usage {where} GROUP BY {', '.join(columns)}, cached"
+        )
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        groups: Dict[Tuple, Dict[str, Any]] = {}
+        for row in rows:
+            tags = dict(zip(columns, row[:len(columns)]))
+            cached, calls, prompt_tokens, completion_tokens = row[len(columns):]
+            group_key = tuple(tags[key] for key in keys)
+            group = groups.setdefault(group_key, {
+                **{key: tags[key] for key in keys},
+                "calls": 0, "cached_calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "cost": 0.0, "unpriced_models": [],
+            })
+            if cached:
+                # Served from the response cache: no tokens billed
+                group["cached_calls"] += calls
+                continue
+            group["calls"] += calls
+            group["prompt_tokens"] += prompt_tokens
+            group["completion_tokens"] += completion_tokens
+            cost = call_cost(tags["model"], prompt_tokens, completion_tokens, prices, tags["tier"])
+            if cost is None:
+                if tags["model"] not in group["unpriced_models"]:
+                    group["unpriced_models"].append(tags["model"])
+            else:
+                group["cost"] += cost
+        return sorted(groups.values(), key=lambda group: (-group["cost"], -group["prompt_tokens"]))
+
+    def close(self) -> None:
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+
+class TaggedLedger:
+    """A ledger with stage, dataset and language filled in, for one run"""
+
+    def __init__(self, ledger: UsageLedger, stage: str, dataset: Optional[str] = None, language: Optional[str] = None,
+                 tier: str = "live"):
+        self.ledger = ledger
+        self.stage = stage
+        self.dataset = dataset
+        self.language = language
+        self.tier = tier
+
+    def record(self, model: str, usage: Any = None, cached: bool = False) -> None:
+        self.ledger.record(self.stage, model, usage, self.dataset, self.language, cached, self.tier)
+
+    def flush(self) -> None:
+        self.ledger.flush()
+
+
+_ledgers: Dict[str, UsageLedger] = {}
+_registry_lock = threading.Lock()
+
+
+def get_usage_ledger(path: str, journal_mode: str = "WAL") -> UsageLedger:
+    """Return the process-wide ledger for path, opening it on first use"""
+    key = os.path.abspath(path)
+    with _registry_lock:
+        if key not in _ledgers:
+            _ledgers[key] = UsageLedger(path, journal_mode=journal_mode)
+            logger.info(f"Recording token usage in {path}")
+        return _ledgers[key]
+
+
+def close_usage_ledgers() -> None:
+    with _registry_lock:
+        while _ledgers:
+            _, ledger = _ledgers.popitem()
+            ledger.close()
+
+
+atexit.register(close_usage_ledgers)
+
+
+def load_prices(path: Optional[str]) -> Dict[str, Tuple[float, float]]:
+    """The built-in price table, overridden by a JSON file of {model: [prompt, completion]}"""
+    prices = dict(PRICES_PER_MILLION)
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            prices.update({model: tuple(price) for model, price in json.load(f).items()})
+    return prices
+
+
+def format_report(rows: List[Dict[str, Any]], keys: List[str]) -> str:
+    header = keys + ["calls", "cached", "prompt_tok", "completion_tok", "cost_usd"]
+    table = [header]
+    for row in rows:
+        cost = f"{row['cost']:.4f}" + ("*" if row["unpriced_models"] else "")
+        table.append([str(row[key]) for key in keys] + [
+            str(row["calls"]), str(row["cached_calls"]), f"{row['prompt_tokens']:,}", f"{row['completion_tokens']:,}", cost,
+        ])
+    total_cost = sum(row["cost"] for row in rows)
+    table.append(["TOTAL"] + [""] * (len(keys) - 1) + [
+        str(sum(row["calls"] for row in rows)),
+        str(sum(row["cached_calls"] for row in rows)),
+        f"{sum(row['prompt_tokens'] for row in rows):,}",
+        f"{sum(row['completion_tokens'] for row in rows):,}",
+        f"{total_cost:.4f}",
+    ])
+    widths = [max(len(line[i]) for line in table) for i in range(len(header))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(line, widths)) for line in table]
+    unpriced = sorted({model for row in rows for model in row["unpriced_models"]})
+    if unpriced:
+        lines.append(f"* excludes models without a price: {', '.join(unpriced)}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report or import token usage.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    report_parser = subparsers.add_parser("report", help="Aggregate tokens and cost")
+    report_parser.add_argument("ledger_path", type=str)
+    report_parser.add_argument("--by", nargs="+", choices=GROUP_KEYS, default=["stage", "model"])
+    report_parser.add_argument("--stage", choices=STAGES, default=None)
+    report_parser.add_argument("--since", type=str, default=None, help="Only calls on or after this date (YYYY-MM-DD)")
+    report_parser.add_argument("--prices", type=str, default=None, help="JSON file of {model: [prompt, completion]} USD per million tokens")
+    report_parser.add_argument("--json", action="store_true", help="Print the rows as JSON")
+
+    import_parser = subparsers.add_parser("import", help="Record saved API responses (e.g. a translation api_responses/ folder)")
+    import_parser.add_argument("responses_dir", type=str)
+    import_parser.add_argument("ledger_path", type=str)
+    import_parser.add_argument("--dataset", type=str, default=None,
+                               help="Dataset tag (default: <dataset>/<split> from the folder layout)")
+    import_parser.add_argument("--language", type=str, default="bn")
+    import_parser.add_argument("--stage", choices=STAGES, default="translate")
+    args = parser.parse_args()
+
+    ledger = UsageLedger(args.ledger_path)
+    if args.command == "import":
+        dataset = args.dataset
+        if dataset is None:
+            # translation/<dataset>/<split>/api_responses
+            split_dir = os.path.dirname(os.path.abspath(args.responses_dir))
+            dataset = f"{os.path.basename(os.path.dirname(split_dir))}/{os.path.basename(split_dir)}"
+        counts = ledger.import_responses(args.responses_dir, dataset, args.language, args.stage)
+        print(f"Imported {counts['imported']} responses and {counts['retries']} parse_errors retries "
+              f"for {dataset} ({counts['skipped']} already imported or without usage)")
+    else:
+        since = time.mktime(time.strptime(args.since, "%Y-%m-%d")) if args.since else None
+        rows = ledger.report(args.by, args.stage, since, load_prices(args.prices))
+        print(json.dumps(rows, indent=2) if args.json else format_report(rows, args.by))
+    ledger.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()